@@ -2,6 +2,7 @@ cdef class IOEventHandlerInterface # forward declaration
 cdef class AbstractIOEventHandler(IOEventHandlerInterface)
 
 from dss.net.IOEventReactor cimport IOEventReactorInterface
+from dss.sys.lock cimport RLock
 from dss.net.IOEventReactor import REACTOR_SHUTDOWN_EVENT
 
 cdef class IOEventHandlerInterface:
@@ -14,7 +15,8 @@ cdef class IOEventHandlerInterface:
 cdef class AbstractIOEventHandler(IOEventHandlerInterface):
     cdef readonly unsigned long event_count
     cdef readonly double last_event_time
-    cdef public object _mutex, _log_channel
+    cdef public RLock _mutex
+    cdef public object _log_channel
 
     cpdef _handle_read_event(self, fd)
     cpdef _handle_write_event(self, fd)
@@ -64,7 +64,7 @@ that same thread, the reactor is out of service while the handlers do
 their thing.  So do it fast or delegate to a threadpool!
 
 """
-from threading import RLock
+from dss.sys.lock cimport RLock
 from dss.net.event_flags import (
     META_REACTOR_SHUTDOWN_EV
     , META_READ_EV
@@ -14,6 +14,7 @@ cdef class IOEventReactorInterface(Service):
     cdef readonly double last_event_time
 
     cpdef object register_handler(self, fd, handler, eventmask=*)
+    cpdef object register_queue(self, queue, callback, int maxitems=*)
     cpdef object unregister(self, fd, int flush=*)
     cpdef object get_handler(self, fd)
 
@@ -93,6 +93,15 @@ cdef class IOEventReactorInterface(Service):
     cpdef object unregister(self, fd, int flush=True):
         raise NotImplementedError
 
+    cpdef object register_queue(self, queue, callback, int maxitems=0):
+        """Registers a `dss.sys.PollableQueue.PollableQueue`.  Whenever
+        items are put on it, `callback(items)` is called in the event
+        loop with batches of up to `maxitems` (0=all) queued items.
+
+        This lets other threads hand work to the reactor thread.
+        """
+        self.register_handler(queue, _QueueDrainHandler(queue, callback, maxitems))
+
     cpdef object get_handler(self, fd):
         raise NotImplementedError
 
@@ -327,6 +336,31 @@ cdef class IOEventReactor(IOEventReactorInterface):
                     if self._log_channel:
                         self._log_channel.exception()
 
+cdef class _QueueDrainHandler(IOEventHandlerInterface):
+    """Drains a PollableQueue into a callback each time it's signalled.
+    Used by `IOEventReactor.register_queue`.
+    """
+    cdef object queue
+    cdef object callback
+    cdef int maxitems
+
+    def __init__(self, queue, callback, int maxitems=0):
+        self.queue = queue
+        self.callback = callback
+        self.maxitems = maxitems
+
+    cpdef handle_event(self,
+                       IOEventReactorInterface reactor,
+                       object fd,
+                       object eventmask,
+                       double timestamp):
+        if eventmask == META_REACTOR_SHUTDOWN_EV:
+            return True
+        items = self.queue.drain(self.maxitems)
+        if items:
+            self.callback(items)
+        return False
+
 cdef class _IOEventHandlerCallbackWrapper(IOEventHandlerInterface):
     """This simple wrapper is used to adapt generic python callables
     to the IOEventHandlerInterface that IOEventReactor expects
@@ -12,6 +12,8 @@ cdef class AbstractAsyncMsgDispatcher:
     cdef public int _running
     cdef public object _mutex
     cdef readonly int _max_queue_size
+    cdef readonly long long _max_queue_bytes
+    cdef readonly object _msg_sizer
     cdef readonly double last_dispatch_time
     cdef readonly long long message_count # set on queuing of new msg
     cdef readonly long long _dispatch_count # set after successful
@@ -73,6 +73,8 @@ cdef class MessageBus(Service):
         self._settings.update(dict(
             use_dedicated_thread_mode=False,
             max_queue_size=0,
+            max_queue_bytes=0, # requires msg_sizer
+            msg_sizer=None, # msg_sizer(msg) -> approx. bytes held by msg
             initial_subscriptions=(),
             channel_class=_Channel,
             channel_name_separator='.',
@@ -110,7 +112,9 @@ cdef class MessageBus(Service):
                 if self._settings['use_dedicated_thread_mode']:
                     self._dispatcher = DedicatedThreadMsgDispather(
                         internal_log_channel=self._internal_log_channel,
-                        max_queue_size=self._settings['max_queue_size'])
+                        max_queue_size=self._settings['max_queue_size'],
+                        max_queue_bytes=self._settings['max_queue_bytes'],
+                        msg_sizer=self._settings['msg_sizer'])
                 else:
                     self._dispatcher = NonThreadedMsgDispather(
                         internal_log_channel=self._internal_log_channel,
@@ -239,7 +243,9 @@ cdef class MessageBus(Service):
             self._dispatcher.stop()
             self._dispatcher = DedicatedThreadMsgDispather(
                 internal_log_channel=self._internal_log_channel,
-                max_queue_size=self._settings['max_queue_size'])
+                max_queue_size=self._settings['max_queue_size'],
+                max_queue_bytes=self._settings['max_queue_bytes'],
+                msg_sizer=self._settings['msg_sizer'])
         finally:
             self._mutex.release()
 
@@ -318,11 +324,28 @@ def _log_internal_exception(msg, source_channel=None, internal_log_channel=None)
 ################################################################################
 ## Dispatchers
 ## I plan to add a zeromq and threadpool dispatcher as well.
+cdef class _QueuedMsgSizer:
+    """Applies the `msg_sizer` setting to the msg in each (msg,
+    orig_channel, orig_thread) entry on a dispatcher's queue."""
+    cdef object sizer
+
+    def __init__(self, sizer):
+        self.sizer = sizer
+
+    def __call__(self, entry):
+        msg = entry[0]
+        if msg is _shutdownMsg:
+            return 0
+        return self.sizer(msg)
+
 cdef class AbstractAsyncMsgDispatcher:
 
-    def __init__(self, internal_log_channel, max_queue_size=0):
+    def __init__(self, internal_log_channel, max_queue_size=0,
+                 max_queue_bytes=0, msg_sizer=None):
         self._internal_log_channel = internal_log_channel
         self._max_queue_size = max_queue_size
+        self._max_queue_bytes = max_queue_bytes
+        self._msg_sizer = msg_sizer
         self._mutex = RLock()
         self.last_dispatch_time = 0
         self.message_count = 0
@@ -352,11 +375,16 @@ cdef class NonThreadedMsgDispather(AbstractAsyncMsgDispatcher):
 
 cdef class DedicatedThreadMsgDispather(AbstractAsyncMsgDispatcher):
 
-    def __init__(self, internal_log_channel, max_queue_size=0):
+    def __init__(self, internal_log_channel, max_queue_size=0,
+                 max_queue_bytes=0, msg_sizer=None):
         super(DedicatedThreadMsgDispather,
-              self).__init__(internal_log_channel, max_queue_size)
+              self).__init__(internal_log_channel, max_queue_size,
+                             max_queue_bytes, msg_sizer)
 
-        self._msg_queue = BlockingQueue(self._max_queue_size)
+        self._msg_queue = BlockingQueue(
+            self._max_queue_size,
+            (_QueuedMsgSizer(msg_sizer) if msg_sizer is not None else None),
+            self._max_queue_bytes)
         self._running = True
         self._dispatch_thread_state = _NOT_RUNNING
         self._dispatch_thread_exit_event = Event()
@@ -21,23 +21,154 @@ cdef class CacheNode:
     cdef double _last_update_time
     cdef long _access_count
     cdef long _update_count
+    cdef double _expiry_time
+    cdef int _segment
+    cdef bint _referenced
+    cdef long long _weight
     cdef _record_access(self)
+    cdef bint _is_expired(self, double now)
 
 cdef class _NullCacheNode(CacheNode):
      pass
 
+cdef class _PendingComputation:
+    cdef long _owner
+    cdef Lock _done
+    cdef object _result
+    cdef object _exc_info
+
+    cdef object _set_result(self, object result, object exc_info)
+    cdef object _wait(self)
+
 cdef class LRUCache:
     cdef public int _use_bulk_purge
     cdef public float _proportion_remaining_after_purge
     cdef public int _maxsize
     cdef public object _node_map
+    cdef object _pending
+    cdef public double _ttl
+    cdef public object _weigher
+    cdef public long long _max_weight
+    cdef long long _total_weight
     cdef int be_thread_safe
 
+    cdef public int _collect_stats
+    cdef unsigned long long _hits, _misses, _inserts
+    cdef unsigned long long _evictions, _expirations, _purges
+    cdef double _purge_time
+    cdef object __weakref__
+
+    cdef public object _removal_listener
+    cdef public object _loader
+    cdef public float _refresh_ahead
+    cdef public object _thread_pool
+    cdef object _refreshing
+    cdef list _pending_removals
+    cdef list _pending_refreshes
+    cdef int _has_deferred
+
     cdef CacheNode _youngest
     cdef CacheNode _oldest
+    cdef CacheNode _sweep_cursor
     cdef Lock _lock
 
+    cdef bint _contains(self, object key)
+    cdef object _set(self, object key, object val, double ttl)
+    cdef long long _weigh(self, object key, object val) except? -1
+    cdef CacheNode _lookup(self, object key)
+    cdef object _set_node(self, object key, object val, double ttl, long long weight)
+    cdef bint _is_due_for_refresh(self, CacheNode node, double now)
+    cdef object _schedule_refresh(self, CacheNode node)
+    cdef object _defer_removal(self, object key, object val, int cause)
+    cdef object _run_deferred(self)
+    cdef bint _is_over_budget(self)
+    cdef object _get_or_call(self, object key, object func, tuple args, dict kws,
+                             double ttl)
+    cdef list _snapshot_entries(self)
+    cdef object _load_entries(self, list entries)
+    cdef object _finish_computation(self, object key, _PendingComputation pending,
+                                    object result, object exc_info)
     cdef object c__delitem__(self, object key)
     cdef object _clear(self)
+    cdef object _clear_links(self)
+    cdef CacheNode _first_node(self)
+    cdef CacheNode _next_node(self, CacheNode node)
+    cdef CacheNode _eviction_victim(self)
+    cdef object _record_miss(self, object key)
+    cdef object _reset_stats(self)
+    cdef object _unlink(self, CacheNode node)
+    cdef object _remove_node(self, CacheNode node, int cause)
     cdef object _record_access(self, CacheNode node)
     cdef int _purge(self) except -1
+
+cdef class SegmentedLRUCache(LRUCache):
+    cdef public int _protected_maxsize
+    cdef int _protected_size
+    cdef CacheNode _protected_youngest
+    cdef CacheNode _protected_oldest
+
+    cdef object _link_protected(self, CacheNode node)
+
+cdef class _FrequencySketch:
+    cdef unsigned char *_table
+    cdef unsigned long long _width_mask
+    cdef long _width
+    cdef long _additions
+    cdef long _sample_size
+
+    cdef int increment(self, object key) except -1
+    cdef int estimate(self, object key) except -1
+    cdef object _reset(self)
+
+cdef class TinyLFUCache(SegmentedLRUCache):
+    cdef _FrequencySketch _sketch
+    cdef CacheNode _candidate
+
+cdef class ClockLRUCache(LRUCache):
+    pass
+
+cdef class CompactLRUCache:
+    cdef public int _use_bulk_purge
+    cdef public float _proportion_remaining_after_purge
+    cdef int _maxsize
+    cdef public double _ttl
+    cdef int be_thread_safe
+    cdef object __weakref__
+
+    cdef object _slot_map
+    cdef list _keys
+    cdef list _values
+    cdef list _slot_numbers
+    cdef int *_prev
+    cdef int *_next
+    cdef double *_last_access_time
+    cdef double *_expiry_time
+    cdef int _oldest
+    cdef int _youngest
+    cdef int _free_head
+    cdef Lock _lock
+
+    cdef bint _contains(self, object key)
+    cdef object _set(self, object key, object val, double ttl)
+    cdef object _reset_slots(self)
+    cdef inline void _unlink(self, int slot)
+    cdef inline void _link_youngest(self, int slot)
+    cdef inline void _move_to_youngest(self, int slot)
+    cdef object _remove_slot(self, int slot)
+    cdef int _purge(self) except -1
+
+cdef class ExpirySweepTask:
+    cdef object _cache_ref
+    cdef object _thread_pool
+    cdef public double interval
+    cdef public int max_nodes
+    cdef readonly int cancelled
+
+cdef class ShardedLRUCache:
+    cdef readonly int num_shards
+    cdef object __weakref__
+    cdef int _maxsize
+    cdef object _shards
+
+    cdef LRUCache _get_shard(self, object key)
+    cdef object _group_by_shard(self, object seq, int is_items=?)
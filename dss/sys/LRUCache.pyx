@@ -1,5 +1,15 @@
+import os
+import sys
+import weakref
+from functools import update_wrapper, partial
+from traceback import print_exc
+import cPickle
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from libc.string cimport memset
+
 from dss.sys.time_of_day cimport time_of_day
-from dss.sys.lock cimport Lock
+from dss.sys.lock cimport Lock, PyThread_get_thread_ident
 from dss.sys.Unspecified import Unspecified
 
 cdef class CacheNode:
@@ -8,6 +18,8 @@ cdef class CacheNode:
         self._value = val
         self._creation_time = self._last_update_time = self._last_access_time = time_of_day()
         self._access_count = self._update_count = 0
+        self._expiry_time = 0
+        self._weight = 1
         self.next = _NULLNODE
         self.prev = _NULLNODE
 
@@ -18,6 +30,9 @@ cdef class CacheNode:
         self._last_access_time = time_of_day()
         self._access_count = self._access_count + 1
 
+    cdef bint _is_expired(self, double now):
+        return self._expiry_time != 0 and self._expiry_time <= now
+
     property key:
         def __get__(self):
             return self._key
@@ -54,6 +69,14 @@ cdef class CacheNode:
         def __get__(self):
             return self._last_update_time
 
+    property expiry_time:
+        def __get__(self):
+            return self._expiry_time
+
+    property weight:
+        def __get__(self):
+            return self._weight
+
 cdef class _NullCacheNode(CacheNode):
     def __init__(self):
         self.next = self
@@ -65,6 +88,41 @@ cdef class _NullCacheNode(CacheNode):
 cdef CacheNode _NULLNODE
 _NULLNODE = _NullCacheNode()
 
+# the causes passed to an LRUCache removal listener
+cdef int _EVICTED=1, _EXPIRED=2, _DELETED=3, _REPLACED=4, _CLEARED=5
+EVICTED = _EVICTED
+EXPIRED = _EXPIRED
+DELETED = _DELETED
+REPLACED = _REPLACED
+CLEARED = _CLEARED
+
+cdef class _PendingComputation:
+    """The in-flight result of a `get_or_compute` factory call, which
+    other threads asking for the same key wait on."""
+    def __init__(self):
+        self._owner = PyThread_get_thread_ident()
+        self._done = Lock()
+        self._done.acquire() # released once the result is available
+        self._result = None
+        self._exc_info = None
+
+    cdef object _set_result(self, object result, object exc_info):
+        self._result = result
+        self._exc_info = exc_info
+        self._done.release()
+
+    cdef object _wait(self):
+        if self._owner == PyThread_get_thread_ident():
+            raise RuntimeError(
+                'recursive get_or_compute for a key whose factory is running '
+                'in this thread')
+        # each waiter passes the lock on to the next one
+        self._done.acquire()
+        self._done.release()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
 cdef class LRUCache:
     """
     A Least Recently Used Cache implementation that provides a dictionary-like
@@ -83,7 +141,46 @@ cdef class LRUCache:
       else:
           val = cache[key] = ... create it
 
-    The latter is not completely thread-safe.
+    The latter is not completely thread-safe.  Both can still create
+    the value more than once when several threads miss on the same
+    key at the same time.  If that's expensive, use:
+      val = cache.get_or_compute(key, create_it)
+
+    Entries can optionally expire.  `ttl` sets a default time-to-live,
+    in seconds, for every entry and `set(key, val, ttl)` overrides it
+    per entry.  Expired entries are rejected when read and removed
+    lazily.  Entries that are never read again are reclaimed by
+    `sweep_expired`, which can be run periodically on a ThreadPool
+    via `schedule_expiry_sweeps`.
+
+    The cache can also be bounded by weight rather than just by entry
+    count.  `weigher(key, val)` returns the weight of an entry (e.g. its
+    size in bytes) and the least recently used entries are purged
+    whenever the total weight exceeds `max_weight`.  Without a weigher
+    every entry weighs 1.  An entry heavier than `max_weight` on its
+    own is never cached: it's passed straight to the removal listener
+    as EVICTED, the other entries are left alone and any existing entry
+    for its key is removed as REPLACED.
+
+    With `collect_stats`=1 the cache counts hits, misses, inserts,
+    evictions, expirations and purges, and times its purges.  `stats()`
+    returns a snapshot of the counters.
+
+    `removal_listener(key, val, cause)` is called whenever an entry
+    leaves the cache or its value is replaced, with `cause` one of
+    EVICTED, EXPIRED, DELETED, REPLACED or CLEARED.  Listeners are
+    called after the cache's lock has been released, so they may use
+    the cache, but not necessarily by the thread whose operation
+    removed the entry: the queued removals are passed to the listener
+    by whichever thread next finishes an operation on the cache.
+    Exceptions raised by a listener are printed and ignored.
+
+    With a `loader` and a ttl, `refresh_ahead` turns on refresh-ahead:
+    a hit on an entry that has used up more than that proportion of
+    its ttl returns the current value and queues `loader(key)` on
+    `thread_pool` to replace it before it expires.  Hot entries then
+    never expire and readers never wait for the loader.  Only one
+    refresh per key is queued at a time.
 
     It's based on ideas from
     http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/252524
@@ -95,24 +192,54 @@ cdef class LRUCache:
     def __init__(self, int maxsize=1024,
                  int use_bulk_purge=1,
                  float proportion_remaining_after_purge=.9,
-                 int be_thread_safe=1
+                 int be_thread_safe=1,
+                 double ttl=0,
+                 object weigher=None,
+                 long long max_weight=0,
+                 int collect_stats=0,
+                 object removal_listener=None,
+                 object loader=None,
+                 float refresh_ahead=0,
+                 object thread_pool=None
                  ):
+        assert max_weight >= 0
+        assert 0 <= refresh_ahead < 1
+        if refresh_ahead:
+            assert loader is not None and thread_pool is not None
         self._node_map = PyDict_New()
+        self._pending = PyDict_New()
         self._oldest = _NULLNODE
         self._youngest = _NULLNODE
+        self._sweep_cursor = _NULLNODE
 
         self._use_bulk_purge = use_bulk_purge
         self._maxsize = maxsize
         self._proportion_remaining_after_purge = proportion_remaining_after_purge
+        self._ttl = ttl
+        self._weigher = weigher
+        self._max_weight = max_weight
+        self._total_weight = 0
+
+        self._collect_stats = collect_stats
+        self._reset_stats()
+
+        self._removal_listener = removal_listener
+        self._loader = loader
+        self._refresh_ahead = refresh_ahead
+        self._thread_pool = thread_pool
+        self._refreshing = PyDict_New()
+        self._pending_removals = []
+        self._pending_refreshes = []
+        self._has_deferred = 0
 
         self.be_thread_safe = be_thread_safe
-        self._lock = <Lock>Lock()
+        self._lock = <Lock>Lock(type(self).__name__+'._lock')
 
     def __contains__(self, key):
-        return PyDict_Contains(self._node_map, key)
+        return self._contains(key)
 
     def has_key(self, key):
-        return PyDict_Contains(self._node_map, key)
+        return self._contains(key)
 
     def get(self, key, default=Unspecified):
         try:
@@ -124,38 +251,112 @@ cdef class LRUCache:
                 raise
 
     def __getitem__(self, key):
-        cdef void *nodepointer
         cdef CacheNode node
         if self.be_thread_safe: self._lock.acquire()
         try:
-            nodepointer = PyDict_GetItem(self._node_map, key)
-            if nodepointer is NULL:
+            node = self._lookup(key)
+            if node is _NULLNODE:
                 raise KeyError(key)
-            node = <CacheNode>nodepointer
-            node._record_access()
-            self._record_access(node)
-            return node.value
+            return node._value
         finally:
             if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
 
-    def __setitem__(self, key, val):
-        if self.be_thread_safe:
-            self._lock.acquire()
+    def get_many(self, keys):
+        """Looks up all of `keys` while holding the lock once.
+
+        Returns a tuple of a dict of the keys that were found and their
+        values and a list of the keys that were not."""
+        cdef CacheNode node
+        hits = {}
+        misses = []
+        if self.be_thread_safe: self._lock.acquire()
         try:
-            if PyDict_Contains(self._node_map, key):
-                node = self._node_map[key]
-                node.value = val
-            else:
-                node = CacheNode(key, val)
-                PyDict_SetItem(self._node_map, key, node)
+            for key in keys:
+                node = self._lookup(key)
+                if node is _NULLNODE:
+                    misses.append(key)
+                else:
+                    hits[key] = node._value
+        finally:
+            if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
+        return hits, misses
 
-            self._record_access(node)
+    def set_many(self, items, ttl=Unspecified):
+        """Stores many entries, from a dict or a sequence of (key, val)
+        pairs, while holding the lock once.  The cache is purged, if
+        needed, once at the end."""
+        cdef list weights = None
+        cdef int i = 0
+        if ttl is Unspecified:
+            ttl = self._ttl
+        if isinstance(items, dict):
+            items = items.items()
+        elif not isinstance(items, (list, tuple)):
+            items = list(items)
+        if self._weigher is not None:
+            weights = [self._weigh(key, val) for key, val in items]
 
-            if PyDict_Size(self._node_map) > self._maxsize:
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            for key, val in items:
+                self._set_node(key, val, ttl, (weights[i] if weights is not None else 1))
+                i += 1
+            if self._is_over_budget():
                 self._purge()
         finally:
-            if self.be_thread_safe:
-                self._lock.release()
+            if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
+
+    def delete_many(self, keys):
+        """Deletes all of `keys` that are present while holding the
+        lock once and returns the number deleted. Missing keys are
+        ignored."""
+        cdef void *nodepointer
+        cdef CacheNode node
+        cdef int deleted = 0
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            for key in keys:
+                nodepointer = PyDict_GetItem(self._node_map, key)
+                if nodepointer is not NULL:
+                    node = <CacheNode>nodepointer
+                    self._remove_node(node, _DELETED)
+                    deleted += 1
+        finally:
+            if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
+        return deleted
+
+    def __setitem__(self, key, val):
+        self._set(key, val, self._ttl)
+
+    def set(self, key, val, ttl=Unspecified):
+        """Equivalent to `cache[key] = val`, but allows the cache's
+        default `ttl` to be overridden for this entry.  A `ttl` of 0
+        means the entry never expires."""
+        if ttl is Unspecified:
+            ttl = self._ttl
+        self._set(key, val, ttl)
+
+    def get_or_compute(self, key, factory, ttl=Unspecified):
+        """Returns the value for `key`, calling `factory(key)` to
+        create and cache it if it's missing or expired.
+
+        Only one thread runs the factory for a given key at a time.
+        Other threads asking for the same key while it's running wait
+        for its result rather than calling the factory themselves.  If
+        the factory raises an exception, it is raised in all of those
+        threads and nothing is cached.
+
+        A factory that asks for its own key, directly or via another
+        get_or_compute call, would wait for itself forever, so that
+        raises RuntimeError instead.
+        """
+        if ttl is Unspecified:
+            ttl = self._ttl
+        return self._get_or_call(key, factory, (key,), None, ttl)
 
     def __delitem__(self, key):
         self.c__delitem__(key)
@@ -174,89 +375,1375 @@ cdef class LRUCache:
         """ Clears the cache """
         self._clear()
 
-    cdef object c__delitem__(self, object key):
+    def dump(self, path):
+        """Writes the cache's entries to the file at `path`, from least
+        to most recently used, and returns the number written.
+
+        The lock is only held while the entries are collected, not
+        while they're pickled.  The file is written to a temporary
+        path first and renamed into place."""
+        return _write_snapshot(path, self._snapshot_entries())
+
+    def load(self, path, int batch_size=1000):
+        """Adds the entries in a file written by `dump`, preserving
+        their recency order, and returns the number loaded.
+
+        The file is streamed and loaded in batches of `batch_size`
+        entries, so it's never held in memory as a whole.  Entries that
+        have expired since they were dumped are skipped."""
+        cdef int count = 0
+        for batch in _read_snapshot(path, batch_size):
+            self._load_entries(batch)
+            count += len(batch)
+        return count
+
+    def sweep_expired(self, int max_nodes=1000):
+        """Removes expired entries, examining at most `max_nodes`
+        entries per call, and returns the number removed.
+
+        Each call resumes where the previous one stopped, so frequent
+        small sweeps eventually visit the whole cache without holding
+        the lock for long."""
+        cdef CacheNode node, next_node
+        cdef double now
+        cdef int checked = 0, removed = 0
+
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            now = time_of_day()
+            node = self._sweep_cursor
+            if not node:
+                node = self._first_node()
+            while node and checked < max_nodes:
+                next_node = self._next_node(node)
+                if node._is_expired(now):
+                    self._remove_node(node, _EXPIRED)
+                    removed += 1
+                node = next_node
+                checked += 1
+            self._sweep_cursor = node
+            if self._collect_stats: self._expirations += removed
+        finally:
+            if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
+        return removed
+
+    def schedule_expiry_sweeps(self, thread_pool, double interval=5, int max_nodes=1000):
+        """Runs `sweep_expired(max_nodes)` every `interval` seconds
+        as a scheduled task on `thread_pool`.  Returns the task, which
+        can be cancelled."""
+        task = ExpirySweepTask(self, thread_pool, interval, max_nodes)
+        task.schedule()
+        return task
+
+    def stats(self):
+        """Returns a snapshot of the cache's statistics as a dict.
+        The counters are only updated when `collect_stats` is on."""
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            return dict(
+                size=PyDict_Size(self._node_map),
+                maxsize=self._maxsize,
+                weight=self._total_weight,
+                hits=self._hits,
+                misses=self._misses,
+                hit_ratio=((<double>self._hits / (self._hits + self._misses))
+                           if (self._hits + self._misses) else 0.0),
+                inserts=self._inserts,
+                evictions=self._evictions,
+                expirations=self._expirations,
+                purges=self._purges,
+                purge_time=self._purge_time)
+        finally:
+            if self.be_thread_safe: self._lock.release()
+
+    def reset_stats(self):
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            self._reset_stats()
+        finally:
+            if self.be_thread_safe: self._lock.release()
+
+    def _refresh_entry(self, key, double ttl):
+        """Reloads `key` with the loader.  Run on the thread pool by
+        refresh-ahead."""
+        try:
+            self._set(key, self._loader(key), ttl)
+        finally:
+            if self.be_thread_safe: self._lock.acquire()
+            try:
+                PyDict_DelItem(self._refreshing, key)
+            finally:
+                if self.be_thread_safe: self._lock.release()
+
+    property ttl:
+        def __get__(self):
+            return self._ttl
+
+    property weight:
+        "The total weight of all entries in the cache"
+        def __get__(self):
+            return self._total_weight
+
+    property max_weight:
+        def __get__(self):
+            return self._max_weight
+
+    cdef bint _contains(self, object key):
+        cdef void *nodepointer
+        nodepointer = PyDict_GetItem(self._node_map, key)
+        if nodepointer is NULL:
+            return False
+        return not (<CacheNode>nodepointer)._is_expired(time_of_day())
+
+    cdef object _set(self, object key, object val, double ttl):
+        cdef long long weight = 1
+
+        if self._weigher is not None:
+            # called outside the lock as it may be expensive
+            weight = self._weigh(key, val)
+
+        if self.be_thread_safe:
+            self._lock.acquire()
+        try:
+            self._set_node(key, val, ttl, weight)
+            if self._is_over_budget():
+                self._purge()
+        finally:
+            if self.be_thread_safe:
+                self._lock.release()
+            if self._has_deferred: self._run_deferred()
+
+    cdef long long _weigh(self, object key, object val) except? -1:
+        cdef long long weight = self._weigher(key, val)
+        if weight < 0:
+            raise ValueError('negative weight %r for key %r'%(weight, key))
+        return weight
+
+    cdef CacheNode _lookup(self, object key):
+        """ Internal use only, must be invoked within a thread lock.
+
+        Returns the node for `key`, recording the access, or _NULLNODE
+        if it's missing or expired."""
+        cdef void *nodepointer
+        cdef CacheNode node
+        cdef double now
+        nodepointer = PyDict_GetItem(self._node_map, key)
+        if nodepointer is NULL:
+            self._record_miss(key)
+            return _NULLNODE
+        node = <CacheNode>nodepointer
+        if node._expiry_time:
+            now = time_of_day()
+            if node._is_expired(now):
+                self._remove_node(node, _EXPIRED)
+                if self._collect_stats: self._expirations += 1
+                self._record_miss(key)
+                return _NULLNODE
+            if self._refresh_ahead and self._is_due_for_refresh(node, now):
+                self._schedule_refresh(node)
+        if self._collect_stats: self._hits += 1
+        node._record_access()
+        self._record_access(node)
+        return node
+
+    cdef object _set_node(self, object key, object val, double ttl, long long weight):
+        " Internal use only, must be invoked within a thread lock."""
         cdef void *nodepointer
         cdef CacheNode node
+        nodepointer = PyDict_GetItem(self._node_map, key)
+        if self._max_weight and weight > self._max_weight:
+            # it can't fit, and purging from the oldest entry would
+            # remove all the others before reaching it
+            if nodepointer is not NULL:
+                node = <CacheNode>nodepointer
+                self._remove_node(node, _REPLACED)
+            if self._removal_listener is not None:
+                self._defer_removal(key, val, _EVICTED)
+            if self._collect_stats: self._evictions += 1
+            return
+        if nodepointer is not NULL:
+            node = <CacheNode>nodepointer
+            if self._removal_listener is not None and node._value is not val:
+                self._defer_removal(key, node._value, _REPLACED)
+            node.value = val
+            self._total_weight -= node._weight
+        else:
+            node = CacheNode(key, val)
+            PyDict_SetItem(self._node_map, key, node)
+            if self._collect_stats: self._inserts += 1
+        node._weight = weight
+        self._total_weight += weight
+
+        if ttl > 0:
+            node._expiry_time = node._last_update_time + ttl
+        else:
+            node._expiry_time = 0
+
+        self._record_access(node)
 
+    cdef bint _is_due_for_refresh(self, CacheNode node, double now):
+        " Internal use only, must be invoked within a thread lock."""
+        return (now >= node._expiry_time - (node._expiry_time - node._last_update_time)
+                * (1 - self._refresh_ahead)
+                and not PyDict_Contains(self._refreshing, node._key))
+
+    cdef object _schedule_refresh(self, CacheNode node):
+        " Internal use only, must be invoked within a thread lock."""
+        PyDict_SetItem(self._refreshing, node._key, 1)
+        self._pending_refreshes.append(
+            (node._key, node._expiry_time - node._last_update_time))
+        self._has_deferred = 1
+
+    cdef object _defer_removal(self, object key, object val, int cause):
+        " Internal use only, must be invoked within a thread lock."""
+        self._pending_removals.append((key, val, cause))
+        self._has_deferred = 1
+
+    cdef object _run_deferred(self):
+        """Calls the removal listener and starts the refreshes queued
+        up while the lock was held.  Must be invoked outside the lock."""
         if self.be_thread_safe: self._lock.acquire()
         try:
-            nodepointer = PyDict_GetItem(self._node_map, key)
-            if nodepointer is NULL: raise KeyError(key)
-            node = <CacheNode>nodepointer
+            removals = self._pending_removals
+            refreshes = self._pending_refreshes
+            self._pending_removals = []
+            self._pending_refreshes = []
+            self._has_deferred = 0
+        finally:
+            if self.be_thread_safe: self._lock.release()
+
+        for key, val, cause in removals:
+            try:
+                self._removal_listener(key, val, cause)
+            except:
+                print_exc()
+        for key, ttl in refreshes:
+            self._thread_pool.add_job(partial(self._refresh_entry, key, ttl))
+
+    cdef bint _is_over_budget(self):
+        return (PyDict_Size(self._node_map) > self._maxsize
+                or (self._max_weight and self._total_weight > self._max_weight))
+
+    cdef object _get_or_call(self, object key, object func, tuple args, dict kws,
+                             double ttl):
+        """The implementation of `get_or_compute`, calling
+        `func(*args, **kws)` on a miss."""
+        cdef void *nodepointer
+        cdef CacheNode node
+        cdef _PendingComputation pending
+        cdef int is_owner = 0
 
-            if node is self._oldest:
-                self._oldest = node.next
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            node = self._lookup(key)
+            if node is not _NULLNODE:
+                return node._value
+
+            nodepointer = PyDict_GetItem(self._pending, key)
+            if nodepointer is NULL:
+                pending = _PendingComputation()
+                PyDict_SetItem(self._pending, key, pending)
+                is_owner = 1
             else:
-                node.prev.next = node.next
+                pending = <_PendingComputation>nodepointer
+        finally:
+            if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
+
+        if not is_owner:
+            return pending._wait()
 
-            if node is self._youngest:
-                self._youngest = node.prev
+        try:
+            if kws:
+                val = func(*args, **kws)
             else:
-                node.next.prev = node.prev
+                val = func(*args)
+            self._set(key, val, ttl)
+        except:
+            self._finish_computation(key, pending, None, sys.exc_info())
+            raise
+        self._finish_computation(key, pending, val, None)
+        return val
 
-            PyDict_DelItem(self._node_map, key)
-            node.next = _NULLNODE
-            node.prev = _NULLNODE
-            node.value = None
+    cdef list _snapshot_entries(self):
+        """Returns [(key, value, expiry_time)] for all unexpired
+        entries, from least to most recently used."""
+        cdef CacheNode node
+        cdef double now
+        cdef list entries = []
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            now = time_of_day()
+            node = self._first_node()
+            while node:
+                if not node._is_expired(now):
+                    entries.append((node._key, node._value, node._expiry_time))
+                node = self._next_node(node)
         finally:
             if self.be_thread_safe: self._lock.release()
+        return entries
 
-    cdef object _clear(self):
-        cdef CacheNode node, nextNode
+    cdef object _load_entries(self, list entries):
+        """Adds [(key, value, ttl)] while holding the lock once."""
+        cdef list weights = None
+        cdef int i = 0
+        if self._weigher is not None:
+            weights = [self._weigh(entry[0], entry[1]) for entry in entries]
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            for key, val, ttl in entries:
+                self._set_node(key, val, ttl, (weights[i] if weights is not None else 1))
+                i += 1
+            if self._is_over_budget():
+                self._purge()
+        finally:
+            if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
+
+    cdef object _finish_computation(self, object key, _PendingComputation pending,
+                                    object result, object exc_info):
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            PyDict_DelItem(self._pending, key)
+        finally:
+            if self.be_thread_safe: self._lock.release()
+        pending._set_result(result, exc_info)
+
+    cdef object c__delitem__(self, object key):
+        cdef void *nodepointer
+        cdef CacheNode node
+
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            nodepointer = PyDict_GetItem(self._node_map, key)
+            if nodepointer is NULL: raise KeyError(key)
+            node = <CacheNode>nodepointer
+            self._remove_node(node, _DELETED)
+        finally:
+            if self.be_thread_safe: self._lock.release()
+            if self._has_deferred: self._run_deferred()
 
+    cdef object _clear(self):
+        cdef CacheNode node
         if self.be_thread_safe:
             self._lock.acquire()
         try:
-            node = self._oldest
-            self._youngest = _NULLNODE
-            self._oldest = _NULLNODE
+            if self._removal_listener is not None:
+                node = self._first_node()
+                while node:
+                    self._defer_removal(node._key, node._value, _CLEARED)
+                    node = self._next_node(node)
+            # the map is emptied first, as dropping the values can run
+            # __del__ methods and ClockLRUCache's lock-free readers
+            # mustn't find a node whose value has gone
             self._node_map.clear()
-            while node:
-                nextNode = node.next
-                node.next = _NULLNODE
-                node.prev = _NULLNODE
-                node.value = None
-                node = nextNode
+            self._clear_links()
+            self._sweep_cursor = _NULLNODE
+            self._total_weight = 0
         finally:
             if self.be_thread_safe:
                 self._lock.release()
+            if self._has_deferred: self._run_deferred()
+
+    cdef object _clear_links(self):
+        " Internal use only, must be invoked within a thread lock."""
+        cdef CacheNode node, nextNode
+        node = self._oldest
+        self._youngest = _NULLNODE
+        self._oldest = _NULLNODE
+        while node:
+            nextNode = node.next
+            node.next = _NULLNODE
+            node.prev = _NULLNODE
+            node.value = None
+            node = nextNode
+
+    cdef CacheNode _first_node(self):
+        """Returns the first node in eviction order. Subclasses that
+        keep more than one list override this and `_next_node`."""
+        return self._oldest
+
+    cdef CacheNode _next_node(self, CacheNode node):
+        return node.next
+
+    cdef CacheNode _eviction_victim(self):
+        """Returns the node `_purge` should remove next. Eviction
+        policies other than LRU override this."""
+        return self._oldest
+
+    cdef object _record_miss(self, object key):
+        """Called, within the thread lock, for every failed lookup.
+        This is also a hook for eviction policies that track frequency."""
+        if self._collect_stats: self._misses += 1
+
+    cdef object _reset_stats(self):
+        self._hits = self._misses = self._inserts = 0
+        self._evictions = self._expirations = self._purges = 0
+        self._purge_time = 0
+
+    cdef object _unlink(self, CacheNode node):
+        " Internal use only, must be invoked within a thread lock."""
+        if node is self._sweep_cursor:
+            self._sweep_cursor = self._next_node(node)
+
+        if node is self._oldest:
+            self._oldest = node.next
+        else:
+            node.prev.next = node.next
+
+        if node is self._youngest:
+            self._youngest = node.prev
+        else:
+            node.next.prev = node.prev
+
+        node.next = _NULLNODE
+        node.prev = _NULLNODE
+
+    cdef object _remove_node(self, CacheNode node, int cause):
+        """ Internal use only, must be invoked within a thread lock.
+
+        The caller must hold a reference to `node` as the map's
+        reference is dropped here.  `cause` is passed on to the
+        removal listener."""
+        self._unlink(node)
+        self._total_weight -= node._weight
+        if self._removal_listener is not None:
+            self._defer_removal(node._key, node._value, cause)
+        # unmapped before the value is dropped, see _clear
+        PyDict_DelItem(self._node_map, node._key)
+        node._value = None
 
     cdef object _record_access(self, CacheNode node):
         " Internal use only, must be invoked within a thread lock."""
         if node is self._youngest:
             return self._youngest
 
-        if not self._oldest:
-            self._oldest = node
-        elif node is self._oldest and node.next:
-            self._oldest = node.next
-
-        if node.prev:
-            node.prev.next = node.next
         if node.next:
-            node.next.prev = node.prev
+            # already linked, so move it rather than adding it
+            self._unlink(node)
 
         node.prev = self._youngest
         node.next = _NULLNODE
         if self._youngest:
             self._youngest.next = node
+        else:
+            self._oldest = node
         self._youngest = node
 
     cdef int _purge(self) except -1:
         " Internal use only, must be invoked within a thread lock."""
-        cdef int how_many_to_purge, purged_cache_size
-        cdef CacheNode orig_oldest_node
+        cdef int purged_cache_size
+        cdef long long purged_weight
+        cdef CacheNode victim
+        cdef double start_time = 0
+        cdef int evictions = 0
 
-        if self._use_bulk_purge:
-            purged_cache_size = int(self._maxsize * self._proportion_remaining_after_purge)
-            how_many_to_purge = PyDict_Size(self._node_map)-purged_cache_size
+        if self._collect_stats:
+            start_time = time_of_day()
+
+        purged_cache_size = PyDict_Size(self._node_map)
+        if purged_cache_size > self._maxsize:
+            if self._use_bulk_purge:
+                purged_cache_size = int(self._maxsize * self._proportion_remaining_after_purge)
+            else:
+                purged_cache_size = self._maxsize
+
+        purged_weight = self._total_weight
+        if self._max_weight and purged_weight > self._max_weight:
+            if self._use_bulk_purge:
+                purged_weight = <long long>(
+                    self._max_weight * self._proportion_remaining_after_purge)
+            else:
+                purged_weight = self._max_weight
+
+        while (PyDict_Size(self._node_map) > purged_cache_size
+               or self._total_weight > purged_weight):
+            victim = self._eviction_victim()
+            if not victim:
+                break
+            self._remove_node(victim, _EVICTED)
+            evictions += 1
+
+        if self._collect_stats:
+            self._purges += 1
+            self._evictions += evictions
+            self._purge_time += time_of_day() - start_time
+
+cdef int _PROBATION=0, _PROTECTED=1
+
+cdef class SegmentedLRUCache(LRUCache):
+    """
+    A scan-resistant variant of LRUCache using a segmented LRU policy.
+
+    New entries start in a probationary segment and are only promoted
+    to the protected segment when they are accessed again.  Entries
+    are evicted from the probationary segment first, so a scan through
+    many one-off keys only flushes other probationary entries and
+    leaves the frequently used ones alone.  When the protected segment
+    grows beyond `protected_proportion` of `maxsize`, its least
+    recently used entries are demoted back to probation.
+
+    The interface is the same as LRUCache's.
+    """
+
+    def __init__(self, int maxsize=1024, float protected_proportion=.8, **kws):
+        LRUCache.__init__(self, maxsize, **kws)
+        self._protected_maxsize = int(maxsize * protected_proportion)
+        self._protected_size = 0
+        self._protected_youngest = _NULLNODE
+        self._protected_oldest = _NULLNODE
+
+    property protected_size:
+        def __get__(self):
+            return self._protected_size
+
+    cdef object _link_protected(self, CacheNode node):
+        " Internal use only, must be invoked within a thread lock."""
+        node._segment = _PROTECTED
+        node.prev = self._protected_youngest
+        node.next = _NULLNODE
+        if self._protected_youngest:
+            self._protected_youngest.next = node
+        else:
+            self._protected_oldest = node
+        self._protected_youngest = node
+        self._protected_size += 1
+
+    cdef object _unlink(self, CacheNode node):
+        " Internal use only, must be invoked within a thread lock."""
+        if node._segment != _PROTECTED:
+            LRUCache._unlink(self, node)
+            return
+
+        if node is self._sweep_cursor:
+            self._sweep_cursor = self._next_node(node)
+
+        if node is self._protected_oldest:
+            self._protected_oldest = node.next
+        else:
+            node.prev.next = node.next
+
+        if node is self._protected_youngest:
+            self._protected_youngest = node.prev
+        else:
+            node.next.prev = node.prev
+
+        node.next = _NULLNODE
+        node.prev = _NULLNODE
+        node._segment = _PROBATION
+        self._protected_size -= 1
+
+    cdef object _record_access(self, CacheNode node):
+        " Internal use only, must be invoked within a thread lock."""
+        cdef CacheNode demoted
+
+        if node._segment == _PROTECTED:
+            if node is not self._protected_youngest:
+                self._unlink(node)
+                self._link_protected(node)
+            return
+
+        if not (node.next or node.prev or node is self._youngest):
+            # a new entry, on probation until it is accessed again
+            LRUCache._record_access(self, node)
+            return
+
+        LRUCache._unlink(self, node)
+        self._link_protected(node)
+        if self._protected_size > self._protected_maxsize:
+            demoted = self._protected_oldest
+            self._unlink(demoted)
+            LRUCache._record_access(self, demoted)
+
+    cdef object _clear_links(self):
+        " Internal use only, must be invoked within a thread lock."""
+        cdef CacheNode node, nextNode
+        node = self._protected_oldest
+        self._protected_youngest = _NULLNODE
+        self._protected_oldest = _NULLNODE
+        self._protected_size = 0
+        while node:
+            nextNode = node.next
+            node.next = _NULLNODE
+            node.prev = _NULLNODE
+            node._segment = _PROBATION
+            node.value = None
+            node = nextNode
+        LRUCache._clear_links(self)
+
+    cdef CacheNode _first_node(self):
+        if self._oldest:
+            return self._oldest
+        return self._protected_oldest
+
+    cdef CacheNode _next_node(self, CacheNode node):
+        if node.next:
+            return node.next
+        elif node._segment == _PROBATION:
+            return self._protected_oldest
+        else:
+            return _NULLNODE
+
+    cdef CacheNode _eviction_victim(self):
+        if self._oldest:
+            return self._oldest
+        return self._protected_oldest
+
+cdef unsigned long long _SKETCH_SEEDS[4]
+_SKETCH_SEEDS[0] = 0x97cb3127ULL
+_SKETCH_SEEDS[1] = 0xc3a5c85c97cb3127ULL
+_SKETCH_SEEDS[2] = 0xb492b66fbe98f273ULL
+_SKETCH_SEEDS[3] = 0x9ae16a3b2f90404fULL
+
+cdef inline unsigned long long _mix_hash(unsigned long long x):
+    # the splitmix64 finalizer: python's hashes of small ints and
+    # similar strings are far too regular to index the sketch directly
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL
+    return x ^ (x >> 31)
+
+cdef class _FrequencySketch:
+    """A count-min sketch of 4-bit counters that estimates how often
+    each key has been seen recently.
+
+    Each of the 4 rows has about four counters per cache entry to keep
+    collisions rare.  The counters are halved once the number of
+    increments reaches ten times the cache's capacity, so old
+    popularity fades over time.
+    """
+
+    def __cinit__(self, long capacity):
+        cdef long width = 64
+        while width < 4 * capacity:
+            width = width << 1
+        self._table = <unsigned char *>PyMem_Malloc(4 * width)
+        if self._table is NULL:
+            raise MemoryError()
+        memset(self._table, 0, 4 * width)
+        self._width = width
+        self._width_mask = width - 1
+        self._additions = 0
+        self._sample_size = 10 * max(capacity, 16)
+
+    def __dealloc__(self):
+        PyMem_Free(self._table)
+
+    cdef int increment(self, object key) except -1:
+        cdef unsigned long long h = <unsigned long long>hash(key)
+        cdef unsigned long long x
+        cdef unsigned char *counter
+        cdef int row
+        for row from 0 <= row < 4:
+            x = _mix_hash(h + _SKETCH_SEEDS[row])
+            counter = &self._table[row * self._width + (x & self._width_mask)]
+            if counter[0] < 15:
+                counter[0] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._reset()
+        return 0
+
+    cdef int estimate(self, object key) except -1:
+        cdef unsigned long long h = <unsigned long long>hash(key)
+        cdef unsigned long long x
+        cdef int row, count, min_count = 15
+        for row from 0 <= row < 4:
+            x = _mix_hash(h + _SKETCH_SEEDS[row])
+            count = self._table[row * self._width + (x & self._width_mask)]
+            if count < min_count:
+                min_count = count
+        return min_count
+
+    cdef object _reset(self):
+        cdef long i
+        for i from 0 <= i < 4 * self._width:
+            self._table[i] = self._table[i] >> 1
+        self._additions = self._additions / 2
+
+cdef class TinyLFUCache(SegmentedLRUCache):
+    """
+    A SegmentedLRUCache with a TinyLFU admission filter.
+
+    A frequency sketch counts every lookup, hit or miss.  When a new
+    entry would push an older one out, the new entry is only admitted
+    if its key has been asked for more often than the victim's key.
+    Otherwise the new entry is dropped.  One-off keys, such as those
+    from a batch scan, are rarely admitted, so they can't displace
+    popular entries.
+
+    The interface is the same as LRUCache's.  Note that a `__setitem__`
+    of a new key can be silently rejected.
+    """
+
+    def __init__(self, int maxsize=1024, **kws):
+        SegmentedLRUCache.__init__(self, maxsize, **kws)
+        self._sketch = _FrequencySketch(maxsize)
+        self._candidate = _NULLNODE
+
+    def frequency(self, key):
+        "Returns the estimated recent access frequency of `key`, from 0-15"
+        return self._sketch.estimate(key)
+
+    cdef object _record_miss(self, object key):
+        LRUCache._record_miss(self, key)
+        self._sketch.increment(key)
+
+    cdef object _record_access(self, CacheNode node):
+        " Internal use only, must be invoked within a thread lock."""
+        if node.next or node.prev or node is self._youngest or node._segment == _PROTECTED:
+            self._sketch.increment(node._key)
+            self._candidate = _NULLNODE
+        else:
+            self._candidate = node
+        SegmentedLRUCache._record_access(self, node)
+
+    cdef object _unlink(self, CacheNode node):
+        if node is self._candidate:
+            self._candidate = _NULLNODE
+        SegmentedLRUCache._unlink(self, node)
+
+    cdef CacheNode _eviction_victim(self):
+        cdef CacheNode victim = SegmentedLRUCache._eviction_victim(self)
+        cdef CacheNode candidate = self._candidate
+        self._candidate = _NULLNODE
+        if (candidate and candidate is not victim
+            and self._sketch.estimate(candidate._key) <= self._sketch.estimate(victim._key)):
+            return candidate
+        return victim
+
+cdef class ClockLRUCache(LRUCache):
+    """
+    A variant of LRUCache that approximates LRU with the CLOCK, or
+    second-chance, algorithm so that reads don't need the lock.
+
+    A hit only sets a reference bit on the entry; it doesn't move the
+    entry in the linked list.  Writers do the rest: when the cache is
+    over budget, entries are examined from the oldest onwards and any
+    that have been referenced since they were last examined get a
+    second chance, i.e. their bit is cleared and they're moved to the
+    young end of the list.  The first unreferenced entry is evicted.
+
+    `__getitem__` and `get` skip the lock entirely.  That relies on the
+    GIL: the dictionary lookup and the reads of the node's fields
+    happen without any Python code running in between.  Writers remove
+    an entry from the key map before they drop its value, whose
+    `__del__` could let a reader run, so a reader finds either the
+    entry with its value or no entry.  Lookups of
+    expired entries and of entries due for refresh-ahead fall back to
+    the locked path.  The interface is the same as LRUCache's.
+    """
+
+    def __getitem__(self, key):
+        cdef void *nodepointer
+        cdef CacheNode node
+        nodepointer = PyDict_GetItem(self._node_map, key)
+        if nodepointer is not NULL:
+            node = <CacheNode>nodepointer
+            if not node._expiry_time or (
+                not self._refresh_ahead
+                and not node._is_expired(time_of_day())):
+                node._referenced = 1
+                if self._collect_stats: self._hits += 1
+                return node._value
+        return LRUCache.__getitem__(self, key)
+
+    cdef object _record_access(self, CacheNode node):
+        " Internal use only, must be invoked within a thread lock."""
+        if node.next or node.prev or node is self._youngest:
+            node._referenced = 1
         else:
-            how_many_to_purge = 1
-
-        for i from 0 <= i < how_many_to_purge:
-            orig_oldest_node = self._oldest
-            self._oldest = orig_oldest_node.next
-            orig_oldest_node.prev = _NULLNODE
-            orig_oldest_node.next.prev = _NULLNODE
-            orig_oldest_node.next = _NULLNODE
-            PyDict_DelItem(self._node_map, orig_oldest_node.key)
+            LRUCache._record_access(self, node)
+
+    cdef CacheNode _eviction_victim(self):
+        cdef CacheNode node = self._oldest
+        while node and node._referenced:
+            node._referenced = 0
+            LRUCache._record_access(self, node)
+            node = self._oldest
+        return node
+
+cdef class CompactLRUCache:
+    """
+    A memory-compact LRUCache for very large caches.
+
+    Rather than a CacheNode object per entry, the links and timestamps
+    of the LRU list are kept in C arrays, preallocated for `maxsize`
+    entries and indexed by slot number.  Keys and values live in two
+    preallocated lists and the key map holds slot numbers.  Unused
+    slots are chained on a free list.  Moving an entry to the young
+    end of the list only rewrites array elements.
+
+    It has the same dictionary-like interface as LRUCache and supports
+    `ttl`, but not weights, eviction hooks or per-node introspection.
+    """
+
+    def __cinit__(self, int maxsize=1024, *args, **kws):
+        # everything sized by maxsize is set up here, where the arrays
+        # are allocated, so a subclass's or a repeated __init__ can't
+        # size any of it differently
+        if maxsize <= 0:
+            raise ValueError('maxsize must be > 0')
+        self._maxsize = maxsize
+        self._prev = <int *>PyMem_Malloc(maxsize * sizeof(int))
+        self._next = <int *>PyMem_Malloc(maxsize * sizeof(int))
+        self._last_access_time = <double *>PyMem_Malloc(maxsize * sizeof(double))
+        self._expiry_time = <double *>PyMem_Malloc(maxsize * sizeof(double))
+        if (self._prev is NULL or self._next is NULL
+            or self._last_access_time is NULL or self._expiry_time is NULL):
+            raise MemoryError()
+        self._slot_map = PyDict_New()
+        self._keys = [None] * maxsize
+        self._values = [None] * maxsize
+        # one shared int object per slot, so the map doesn't allocate
+        self._slot_numbers = list(range(maxsize))
+        self._reset_slots()
+
+    def __dealloc__(self):
+        PyMem_Free(self._prev)
+        PyMem_Free(self._next)
+        PyMem_Free(self._last_access_time)
+        PyMem_Free(self._expiry_time)
+
+    def __init__(self, int maxsize=1024,
+                 int use_bulk_purge=1,
+                 float proportion_remaining_after_purge=.9,
+                 int be_thread_safe=1,
+                 double ttl=0
+                 ):
+        if maxsize != self._maxsize:
+            raise ValueError('maxsize %i differs from the %i the cache was created with'%(
+                maxsize, self._maxsize))
+        self._use_bulk_purge = use_bulk_purge
+        self._proportion_remaining_after_purge = proportion_remaining_after_purge
+        self._ttl = ttl
+        self.be_thread_safe = be_thread_safe
+        self._lock = <Lock>Lock(type(self).__name__+'._lock')
+
+    def __contains__(self, key):
+        return self._contains(key)
+
+    def has_key(self, key):
+        return self._contains(key)
+
+    def get(self, key, default=Unspecified):
+        try:
+            return self.__getitem__(key)
+        except KeyError:
+            if default is not Unspecified:
+                return default
+            else:
+                raise
+
+    def __getitem__(self, key):
+        cdef void *slotpointer
+        cdef int slot
+        cdef double now
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            slotpointer = PyDict_GetItem(self._slot_map, key)
+            if slotpointer is NULL:
+                raise KeyError(key)
+            slot = <object>slotpointer
+            now = time_of_day()
+            if self._expiry_time[slot] and self._expiry_time[slot] <= now:
+                self._remove_slot(slot)
+                raise KeyError(key)
+            self._last_access_time[slot] = now
+            self._move_to_youngest(slot)
+            return self._values[slot]
+        finally:
+            if self.be_thread_safe: self._lock.release()
+
+    def __setitem__(self, key, val):
+        self._set(key, val, self._ttl)
+
+    def set(self, key, val, ttl=Unspecified):
+        if ttl is Unspecified:
+            ttl = self._ttl
+        self._set(key, val, ttl)
+
+    def __delitem__(self, key):
+        cdef void *slotpointer
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            slotpointer = PyDict_GetItem(self._slot_map, key)
+            if slotpointer is NULL: raise KeyError(key)
+            self._remove_slot(<object>slotpointer)
+        finally:
+            if self.be_thread_safe: self._lock.release()
+
+    def __len__(self):
+        return PyDict_Size(self._slot_map)
+
+    def keys(self):
+        return self._slot_map.keys()
+
+    def clear(self):
+        """ Clears the cache """
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            self._slot_map.clear()
+            self._keys = [None] * self._maxsize
+            self._values = [None] * self._maxsize
+            self._reset_slots()
+        finally:
+            if self.be_thread_safe: self._lock.release()
+
+    property maxsize:
+        def __get__(self):
+            return self._maxsize
+
+    property ttl:
+        def __get__(self):
+            return self._ttl
+
+    cdef bint _contains(self, object key):
+        cdef void *slotpointer
+        cdef int slot
+        slotpointer = PyDict_GetItem(self._slot_map, key)
+        if slotpointer is NULL:
+            return False
+        slot = <object>slotpointer
+        return not (self._expiry_time[slot] and self._expiry_time[slot] <= time_of_day())
+
+    cdef object _set(self, object key, object val, double ttl):
+        cdef void *slotpointer
+        cdef int slot
+        cdef double now
+        if self.be_thread_safe: self._lock.acquire()
+        try:
+            now = time_of_day()
+            slotpointer = PyDict_GetItem(self._slot_map, key)
+            if slotpointer is not NULL:
+                slot = <object>slotpointer
+                self._values[slot] = val
+                self._move_to_youngest(slot)
+            else:
+                if self._free_head == -1:
+                    self._purge()
+                slot = self._free_head
+                self._free_head = self._next[slot]
+                self._keys[slot] = key
+                self._values[slot] = val
+                PyDict_SetItem(self._slot_map, key, self._slot_numbers[slot])
+                self._link_youngest(slot)
+            self._last_access_time[slot] = now
+            if ttl > 0:
+                self._expiry_time[slot] = now + ttl
+            else:
+                self._expiry_time[slot] = 0
+        finally:
+            if self.be_thread_safe: self._lock.release()
+
+    cdef object _reset_slots(self):
+        " Internal use only, must be invoked within a thread lock."""
+        cdef int i
+        for i from 0 <= i < self._maxsize:
+            self._prev[i] = -1
+            self._next[i] = i + 1
+            self._last_access_time[i] = 0
+            self._expiry_time[i] = 0
+        self._next[self._maxsize - 1] = -1
+        self._free_head = 0
+        self._oldest = -1
+        self._youngest = -1
+
+    cdef inline void _unlink(self, int slot):
+        " Internal use only, must be invoked within a thread lock."""
+        if slot == self._oldest:
+            self._oldest = self._next[slot]
+        else:
+            self._next[self._prev[slot]] = self._next[slot]
+        if slot == self._youngest:
+            self._youngest = self._prev[slot]
+        else:
+            self._prev[self._next[slot]] = self._prev[slot]
+
+    cdef inline void _link_youngest(self, int slot):
+        " Internal use only, must be invoked within a thread lock."""
+        self._prev[slot] = self._youngest
+        self._next[slot] = -1
+        if self._youngest == -1:
+            self._oldest = slot
+        else:
+            self._next[self._youngest] = slot
+        self._youngest = slot
+
+    cdef inline void _move_to_youngest(self, int slot):
+        if slot != self._youngest:
+            self._unlink(slot)
+            self._link_youngest(slot)
+
+    cdef object _remove_slot(self, int slot):
+        " Internal use only, must be invoked within a thread lock."""
+        self._unlink(slot)
+        PyDict_DelItem(self._slot_map, self._keys[slot])
+        self._keys[slot] = None
+        self._values[slot] = None
+        self._next[slot] = self._free_head
+        self._free_head = slot
+
+    cdef int _purge(self) except -1:
+        """ Internal use only, must be invoked within a thread lock.
+
+        Unlike LRUCache, this is called before inserting into a full
+        cache, so one more entry is purged to leave a free slot."""
+        cdef int purged_cache_size = self._maxsize - 1
+        if self._use_bulk_purge:
+            purged_cache_size = max(0, min(
+                purged_cache_size,
+                int(self._maxsize * self._proportion_remaining_after_purge) - 1))
+        while PyDict_Size(self._slot_map) > purged_cache_size:
+            self._remove_slot(self._oldest)
+
+cdef class ExpirySweepTask:
+    """A ThreadPool scheduled task that calls `cache.sweep_expired`
+    every `interval` seconds.
+
+    Only a weak reference to the cache is held and the task stops
+    rescheduling itself once the cache is gone or `cancel()` has been
+    called.
+    """
+    def __init__(self, cache, thread_pool, double interval=5, int max_nodes=1000):
+        self._cache_ref = weakref.ref(cache)
+        self._thread_pool = thread_pool
+        self.interval = interval
+        self.max_nodes = max_nodes
+        self.cancelled = 0
+
+    def schedule(self):
+        self._thread_pool.schedule_task(self, time_of_day() + self.interval)
+
+    def cancel(self):
+        self.cancelled = 1
+
+    def __call__(self):
+        if self.cancelled:
+            return
+        cache = self._cache_ref()
+        if cache is None:
+            return
+        try:
+            cache.sweep_expired(self.max_nodes)
+        finally:
+            # tasks are responsible for rescheduling themselves
+            self.schedule()
+
+cdef class ShardedLRUCache:
+    """
+    A lock-striped variant of LRUCache for caches that are shared by
+    many threads.
+
+    Keys are hashed into `num_shards` independent LRUCache segments,
+    each with its own lock and linked list, so threads working on
+    different keys rarely wait on each other.  The dictionary-like
+    interface is the same as LRUCache's.
+
+    `maxsize` and `max_weight` are global budgets that are split as
+    evenly as possible between the segments, so the totals never
+    exceed them.  `num_shards` is reduced to `maxsize`, or
+    `max_weight`, if it's larger, so each segment gets at least 1.
+    `ttl`, `weigher`, `removal_listener` and the
+    refresh-ahead settings are passed on to every segment.
+    Recency is tracked per segment: the entry evicted is the least
+    recently used one in its segment, which is only an approximation
+    of the globally least recently used entry.
+    """
+
+    def __init__(self, int maxsize=1024,
+                 int num_shards=16,
+                 int use_bulk_purge=1,
+                 float proportion_remaining_after_purge=.9,
+                 double ttl=0,
+                 object weigher=None,
+                 long long max_weight=0,
+                 int collect_stats=0,
+                 object removal_listener=None,
+                 object loader=None,
+                 float refresh_ahead=0,
+                 object thread_pool=None
+                 ):
+        cdef int i, shard_maxsize
+        cdef long long shard_max_weight = 0
+        assert maxsize > 0 and num_shards > 0
+        if num_shards > maxsize:
+            num_shards = maxsize
+        if max_weight and num_shards > max_weight:
+            # every shard needs a max_weight of at least 1, as 0 is unbounded
+            num_shards = max_weight
+        self.num_shards = num_shards
+        self._maxsize = maxsize
+        self._shards = []
+        for i from 0 <= i < num_shards:
+            shard_maxsize = maxsize / num_shards
+            if i < (maxsize % num_shards):
+                shard_maxsize += 1
+            if max_weight:
+                shard_max_weight = max_weight / num_shards
+                if i < (max_weight % num_shards):
+                    shard_max_weight += 1
+            self._shards.append(
+                LRUCache(shard_maxsize,
+                         use_bulk_purge=use_bulk_purge,
+                         proportion_remaining_after_purge=proportion_remaining_after_purge,
+                         ttl=ttl,
+                         weigher=weigher,
+                         max_weight=shard_max_weight,
+                         collect_stats=collect_stats,
+                         removal_listener=removal_listener,
+                         loader=loader,
+                         refresh_ahead=refresh_ahead,
+                         thread_pool=thread_pool))
+
+    cdef LRUCache _get_shard(self, object key):
+        return <LRUCache>self._shards[hash(key) % self.num_shards]
+
+    def __contains__(self, key):
+        return key in self._get_shard(key)
+
+    def has_key(self, key):
+        return key in self._get_shard(key)
+
+    def get(self, key, default=Unspecified):
+        return self._get_shard(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._get_shard(key)[key]
+
+    def __setitem__(self, key, val):
+        self._get_shard(key)[key] = val
+
+    def set(self, key, val, ttl=Unspecified):
+        self._get_shard(key).set(key, val, ttl)
+
+    def get_or_compute(self, key, factory, ttl=Unspecified):
+        return self._get_shard(key).get_or_compute(key, factory, ttl)
+
+    def get_many(self, keys):
+        """Groups `keys` by segment and does one `get_many` per
+        segment. Returns (hits_dict, misses_list)."""
+        hits = {}
+        misses = []
+        for shard, shard_keys in self._group_by_shard(keys):
+            shard_hits, shard_misses = shard.get_many(shard_keys)
+            hits.update(shard_hits)
+            misses.extend(shard_misses)
+        return hits, misses
+
+    def set_many(self, items, ttl=Unspecified):
+        if isinstance(items, dict):
+            items = items.items()
+        for shard, shard_items in self._group_by_shard(items, 1):
+            shard.set_many(shard_items, ttl)
+
+    def delete_many(self, keys):
+        cdef int deleted = 0
+        for shard, shard_keys in self._group_by_shard(keys):
+            deleted += shard.delete_many(shard_keys)
+        return deleted
+
+    cdef object _group_by_shard(self, object seq, int is_items=0):
+        """Returns [(shard, [seq elements])] for the shards used by
+        `seq`, which holds keys or (key, val) items."""
+        cdef dict groups = {}
+        for elem in seq:
+            shard = self._get_shard(elem[0] if is_items else elem)
+            if shard in groups:
+                groups[shard].append(elem)
+            else:
+                groups[shard] = [elem]
+        return groups.items()
+
+    def __delitem__(self, key):
+        self._get_shard(key).c__delitem__(key)
+
+    def __len__(self):
+        cdef int size = 0
+        for shard in self._shards:
+            size += len(shard)
+        return size
+
+    def keys(self):
+        keys = []
+        for shard in self._shards:
+            keys.extend(shard.keys())
+        return keys
+
+    def clear(self):
+        """ Clears all segments of the cache """
+        for shard in self._shards:
+            (<LRUCache>shard)._clear()
+
+    def sweep_expired(self, int max_nodes=1000):
+        """Sweeps every segment, sharing `max_nodes` between them, and
+        returns the number of expired entries removed."""
+        cdef int removed = 0
+        cdef int max_nodes_per_shard = max_nodes / self.num_shards + 1
+        for shard in self._shards:
+            removed += shard.sweep_expired(max_nodes_per_shard)
+        return removed
+
+    def schedule_expiry_sweeps(self, thread_pool, double interval=5, int max_nodes=1000):
+        task = ExpirySweepTask(self, thread_pool, interval, max_nodes)
+        task.schedule()
+        return task
+
+    def dump(self, path):
+        """Writes every segment's entries to `path`.  The recency
+        order within each segment is preserved."""
+        entries = []
+        for shard in self._shards:
+            entries.extend((<LRUCache>shard)._snapshot_entries())
+        return _write_snapshot(path, entries)
+
+    def load(self, path, int batch_size=1000):
+        cdef int count = 0
+        for batch in _read_snapshot(path, batch_size):
+            for shard, shard_entries in self._group_by_shard(batch, 1):
+                (<LRUCache>shard)._load_entries(shard_entries)
+            count += len(batch)
+        return count
+
+    def stats(self):
+        """Returns the sum of the segments' statistics as a dict."""
+        totals = {}
+        for shard in self._shards:
+            for k, v in shard.stats().iteritems():
+                totals[k] = totals.get(k, 0) + v
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_ratio'] = (float(totals['hits']) / lookups) if lookups else 0.0
+        return totals
+
+    def reset_stats(self):
+        for shard in self._shards:
+            shard.reset_stats()
+
+    property maxsize:
+        def __get__(self):
+            return self._maxsize
+
+    property weight:
+        def __get__(self):
+            cdef long long weight = 0
+            for shard in self._shards:
+                weight += (<LRUCache>shard)._total_weight
+            return weight
+
+    property shards:
+        def __get__(self):
+            return list(self._shards)
+
+_SNAPSHOT_HEADER = ('dss.sys.LRUCache snapshot', 1)
+
+cdef int _write_snapshot(object path, list entries) except -1:
+    """Pickles `entries`, [(key, value, expiry_time)], one at a time
+    to `path` so no single large pickle is built in memory.  On failure
+    the temporary file is removed and `path` is left untouched."""
+    cdef int count = 0
+    tmp_path = '%s.tmp'%path
+    f = open(tmp_path, 'wb')
+    try:
+        try:
+            pickler = cPickle.Pickler(f, 2)
+            pickler.dump(_SNAPSHOT_HEADER)
+            for key, val, expiry_time in entries:
+                pickler.dump((key, val, expiry_time))
+                pickler.clear_memo()
+                count += 1
+        finally:
+            f.close()
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.rename(tmp_path, path)
+    return count
+
+def _read_snapshot(path, int batch_size=1000):
+    """Yields lists of up to `batch_size` (key, value, ttl) entries
+    from a snapshot file, skipping expired entries."""
+    cdef double now = time_of_day()
+    cdef double expiry_time
+    cdef list batch = []
+    f = open(path, 'rb')
+    try:
+        unpickler = cPickle.Unpickler(f)
+        if unpickler.load() != _SNAPSHOT_HEADER:
+            raise ValueError('%s is not an LRUCache snapshot'%path)
+        while True:
+            try:
+                key, val, expiry_time = unpickler.load()
+            except EOFError:
+                break
+            if not expiry_time:
+                batch.append((key, val, 0))
+            elif expiry_time > now:
+                batch.append((key, val, expiry_time - now))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        f.close()
+
+cdef object _KWD_MARK = object()
+
+cdef object _make_memo_key(tuple args, dict kws, bint typed):
+    """Builds a cache key for a call.  Positional-only calls use the
+    args tuple itself. Keyword args are sorted so their order doesn't
+    matter."""
+    cdef tuple key = args
+    cdef list sorted_items = None
+    if kws:
+        sorted_items = sorted(kws.items())
+        key = args + (_KWD_MARK,) + tuple(sorted_items)
+    if typed:
+        key = key + tuple([type(arg) for arg in args])
+        if sorted_items:
+            key = key + tuple([type(item[1]) for item in sorted_items])
+    return key
+
+def memoize(int maxsize=128, double ttl=0, typed=False, **cache_kws):
+    """A decorator that caches a function's results in an LRUCache.
+
+    Use:
+      @memoize(maxsize=1000, ttl=60)
+      def expensive(a, b=2):
+          ...
+
+    The arguments must be hashable.  With `typed`=True, arguments of
+    different types are cached separately, e.g. f(1) and f(1.0).
+    Concurrent calls with the same arguments only call the function
+    once (see `LRUCache.get_or_compute`), so a recursive call with the
+    same arguments as one in progress raises RuntimeError.  Extra
+    keyword args are passed on to LRUCache.
+
+    The decorated function has `cache_info()`, which returns the
+    cache's stats, `cache_clear()`, and `cache`, the LRUCache.  Stats
+    are collected unless `collect_stats`=False is passed.
+    """
+    cdef bint typed_keys = typed
+    collect_stats = cache_kws.pop('collect_stats', 1)
+
+    def decorator(func):
+        cdef LRUCache cache = LRUCache(maxsize, ttl=ttl, collect_stats=collect_stats,
+                                       **cache_kws)
+
+        def wrapper(*args, **kws):
+            return cache._get_or_call(
+                _make_memo_key(args, kws, typed_keys), func, args, kws, cache._ttl)
+
+        def cache_clear():
+            cache.clear()
+            cache.reset_stats()
+
+        update_wrapper(wrapper, func)
+        wrapper.cache = cache
+        wrapper.cache_info = cache.stats
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
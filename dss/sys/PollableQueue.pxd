@@ -0,0 +1,15 @@
+from libc.stdint cimport uint64_t
+
+from dss.sys.Queue cimport BlockingQueue
+
+cdef extern from "sys/eventfd.h":
+    int eventfd(unsigned int initval, int flags)
+    int EFD_NONBLOCK
+    int EFD_CLOEXEC
+
+cdef class PollableQueue(BlockingQueue):
+    cdef int _eventfd
+    cdef int _signalled
+
+    cpdef object drain(self, int maxitems=?)
+    cdef int _signal(self) except -1
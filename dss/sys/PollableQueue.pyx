@@ -0,0 +1,81 @@
+from cpython.exc cimport PyErr_SetFromErrno
+from libc.stdint cimport uint64_t
+from posix.unistd cimport read, write, close
+
+from dss.sys.Queue cimport BlockingQueue
+from dss.sys.Queue import Empty
+
+cdef class PollableQueue(BlockingQueue):
+    """A BlockingQueue whose readiness can be polled via an eventfd,
+    so that an IOEventReactor can be handed work by other threads
+    without a dedicated consumer thread.
+
+    `fileno()` becomes readable when items are put on the empty
+    queue.  The reactor side should call `drain`, rather than `get`,
+    which resets the eventfd and then takes the items without
+    blocking.  See `IOEventReactor.register_queue`.
+
+    To keep the syscalls off the producers' common path, the eventfd
+    is only written to when it isn't already signalled.  Linux only.
+    """
+    def __cinit__(self, *args, **kws):
+        # __dealloc__ mustn't close fd 0 if __init__ fails before eventfd()
+        self._eventfd = -1
+
+    def __init__(self, maxsize=0, sizer=None, max_bytes=0, collect_stats=0,
+                 int lock_spin=0):
+        BlockingQueue.__init__(self, maxsize, sizer, max_bytes, collect_stats,
+                               lock_spin)
+        self._eventfd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC)
+        if self._eventfd < 0:
+            PyErr_SetFromErrno(OSError)
+        self._signalled = 0
+
+    def __dealloc__(self):
+        if self._eventfd >= 0:
+            close(self._eventfd)
+
+    def fileno(self):
+        return self._eventfd
+
+    cdef int _signal(self) except -1:
+        cdef uint64_t one = 1
+        if not self._signalled:
+            self._signalled = 1
+            if write(self._eventfd, &one, sizeof(one)) < 0:
+                PyErr_SetFromErrno(OSError)
+        return 0
+
+    cpdef object put(self, object item, double timeout=-1):
+        result = BlockingQueue.put(self, item, timeout)
+        self._signal()
+        return result
+
+    cpdef object putmany(self, object items, double timeout=-1):
+        result = BlockingQueue.putmany(self, items, timeout)
+        if self._size:
+            self._signal()
+        return result
+
+    cpdef object putleft(self, object item, int respectmaxsize=1):
+        result = BlockingQueue.putleft(self, item, respectmaxsize)
+        self._signal()
+        return result
+
+    cpdef object drain(self, int maxitems=0):
+        """Resets the eventfd and returns up to `maxitems`, or all, of
+        the queued items without blocking.  If items are left behind
+        the eventfd is signalled again so the reactor comes back for
+        them."""
+        cdef uint64_t count
+        self._signalled = 0
+        # the flag must be cleared before reading so a concurrent put
+        # either lands in this batch or signals again
+        read(self._eventfd, &count, sizeof(count))
+        try:
+            items = self.getmany(maxitems, 0, 0, 0) # timeout=0
+        except Empty:
+            return []
+        if self._size:
+            self._signal()
+        return items
@@ -1,11 +1,33 @@
+from cpython.ref cimport PyObject
+
 from dss.sys.lock cimport Lock
 
+cdef extern from "_atomic.h":
+    unsigned long dss_atomic_load_acquire(unsigned long *p) nogil
+    unsigned long dss_atomic_load_seq_cst(unsigned long *p) nogil
+    void dss_atomic_store_seq_cst(unsigned long *p, unsigned long v) nogil
+    unsigned long dss_atomic_exchange(unsigned long *p, unsigned long v) nogil
+
+cdef enum:
+    _HISTOGRAM_BUCKETS = 32
+
+cdef class WaitTimeHistogram:
+    cdef unsigned long long _counts[_HISTOGRAM_BUCKETS]
+    cdef readonly unsigned long long count
+    cdef readonly double total
+    cdef readonly double max
+
+    cpdef int record(self, double seconds) except -1
+
 cdef class AbstractQueue:
-    cpdef object put(self, object item)
-    cpdef object putmany(self, object items)
+    cpdef object put(self, object item, double timeout=?)
+    cpdef object put_nowait(self, object item)
+    cpdef object putmany(self, object items, double timeout=?)
     cpdef object putleft(self, object item, int respectmaxsize=?)
-    cpdef object get(self)
-    cpdef object getmany(self, int maxitems=?)
+    cpdef object get(self, double timeout=?)
+    cpdef object get_nowait(self)
+    cpdef object getmany(self, int maxitems=?, int min_items=?, double linger=?,
+                         double timeout=?)
 
 cdef class BlockingQueue(AbstractQueue):
     cdef int _maxsize, _size
@@ -13,10 +35,60 @@ cdef class BlockingQueue(AbstractQueue):
     cdef public Lock _mutex
     cdef public Lock _esema
     cdef public Lock _fsema
+    cdef Lock _batch_ready
+    cdef int _linger_target
+    cdef object _sizer
+    cdef long long _max_bytes, _bytes
+    cdef bint _bounded
+    cdef public int _collect_stats
+    cdef unsigned long long _puts, _gets
+    cdef int _high_water
+    cdef readonly WaitTimeHistogram _producer_waits
+    cdef readonly WaitTimeHistogram _consumer_waits
     cdef object _put
     cdef object _extend
     cdef object _putleft
     cdef object _popleft
 
+    cdef inline bint _is_full(self)
+    cdef long long _size_of(self, object item) except? -1
+    cdef object _sized(self, object item, long long nbytes)
+    cdef int _acquire_sema(self, Lock sema, double timeout,
+                           WaitTimeHistogram waits) except -1
+    cdef inline void _record_put(self, int count)
+    cdef object _reset_stats(self)
+    cdef int _wake_lingering_consumer(self) except -1
+    cdef int _linger(self, int min_items, double linger) except -1
+
+cdef class _PrioritizedItem:
+    cdef object item
+    cdef object priority
+
+cdef class _PriorityHeap:
+    cdef list _heap
+    cdef unsigned long long _seq
+    cdef long long _left_seq
+    cdef public object default_priority
+
+cdef class PriorityBlockingQueue(BlockingQueue):
+    cpdef object put_prioritized(self, object item, object priority, double timeout=?)
+    cdef long long _size_of(self, object item) except? -1
+    cdef object _sized(self, object item, long long nbytes)
+
+cdef class SPSCQueue(AbstractQueue):
+    cdef PyObject **_slots
+    cdef unsigned long _capacity
+    cdef unsigned long _mask
+    cdef unsigned long _head # only written by the consumer
+    cdef unsigned long _tail # only written by the producer
+    cdef unsigned long _consumer_waiting
+    cdef unsigned long _producer_waiting
+    cdef Lock _not_empty
+    cdef Lock _not_full
+
+    cdef int _wait_for_items(self, unsigned long count, double timeout) except -1
+    cdef int _wait_until_not_full(self, double timeout) except -1
+    cdef object _pop(self)
+
 #cdef class SingleConsumer(BlockingQueue):
 #     pass
@@ -1,7 +1,83 @@
 # -*- python -*-
+from cpython.ref cimport PyObject, Py_INCREF, Py_XDECREF
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from libc.math cimport frexp, ldexp
+from libc.string cimport memset
+
 from dss.sys.lock cimport Lock
+from dss.sys.time_of_day cimport time_of_day
 
 import collections
+from heapq import heappush, heappop
+
+class Empty(Exception):
+    "Raised by a `get` that times out, or doesn't wait, on an empty queue."
+
+class Full(Exception):
+    "Raised by a `put` that times out, or doesn't wait, on a full queue."
+
+cdef class WaitTimeHistogram:
+    """Counts wait times in power of two buckets, from under a
+    microsecond up to ~36 minutes, so recording one is a few arithmetic
+    ops.  Longer waits go in the last bucket.
+
+    `buckets()` returns [(upper bound in seconds, count), ...] for the
+    non-empty buckets and `percentile(p)` the upper bound of the bucket
+    the p-th percentile falls in.
+    """
+    def __init__(self):
+        self.reset()
+
+    cpdef int record(self, double seconds) except -1:
+        cdef int exponent = 0
+        if seconds > 0:
+            frexp(seconds * 1e6, &exponent)
+            if exponent < 0:
+                exponent = 0
+            elif exponent >= _HISTOGRAM_BUCKETS:
+                exponent = _HISTOGRAM_BUCKETS - 1
+        else:
+            seconds = 0
+        self._counts[exponent] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        return 0
+
+    def reset(self):
+        memset(self._counts, 0, sizeof(self._counts))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def buckets(self):
+        cdef int i
+        result = []
+        for i from 0 <= i < _HISTOGRAM_BUCKETS:
+            if self._counts[i]:
+                result.append((ldexp(1, i) / 1e6, self._counts[i]))
+        return result
+
+    def percentile(self, double p):
+        cdef int i
+        cdef unsigned long long seen = 0
+        if not self.count:
+            return 0.0
+        for i from 0 <= i < _HISTOGRAM_BUCKETS:
+            seen += self._counts[i]
+            if seen >= self.count * p / 100.0:
+                return ldexp(1, i) / 1e6
+        return self.max
+
+    def as_dict(self):
+        return dict(count=self.count,
+                    total=self.total,
+                    max=self.max,
+                    mean=(self.total / self.count if self.count else 0.0),
+                    p50=self.percentile(50),
+                    p99=self.percentile(99),
+                    buckets=self.buckets())
 
 cdef class AbstractQueue:
     def __init__(self, maxsize=0):
@@ -10,19 +86,28 @@ cdef class AbstractQueue:
     def __len__(self):
         raise NotImplementedError
 
-    cpdef object put(self, object item):
+    cpdef object put(self, object item, double timeout=-1):
         raise NotImplementedError
 
-    cpdef object putmany(self, object items):
+    cpdef object put_nowait(self, object item):
+        "Equivalent to `put(item, timeout=0)`"
+        return self.put(item, 0)
+
+    cpdef object putmany(self, object items, double timeout=-1):
         raise NotImplementedError
 
     cpdef object putleft(self, object item, int respectmaxsize=1):
         raise NotImplementedError
 
-    cpdef object get(self):
+    cpdef object get(self, double timeout=-1):
         raise NotImplementedError
 
-    cpdef object getmany(self, int maxitems=0):
+    cpdef object get_nowait(self):
+        "Equivalent to `get(timeout=0)`"
+        return self.get(0)
+
+    cpdef object getmany(self, int maxitems=0, int min_items=0, double linger=0,
+                         double timeout=-1):
         raise NotImplementedError
 
     property maxsize:
@@ -45,11 +130,37 @@ cdef class BlockingQueue(AbstractQueue):
     `IndexError` when empty this blocks.  Where `collections.deque`
     would drop elements when full, this blocks.
 
+    `get`, `getmany`, `put` and `putmany` take an optional `timeout`
+    in seconds.  If they can't proceed within it they raise `Empty` or
+    `Full`.  A `timeout` of 0 doesn't wait at all and a negative one,
+    the default, waits forever.
+
+    `getmany` can also linger, waiting up to `linger` seconds after
+    the first item arrives for at least `min_items` to be present, so
+    that consumers handle fuller batches under moderate load.
+
+    Given a `sizer` function the queue also tracks the total size of
+    its items, in bytes or whatever unit `sizer` returns, and with
+    `max_bytes` it is full once that total reaches the limit.  This
+    bounds the memory a queue of variably sized items can hold.
+
+    With `collect_stats`=1 the queue counts puts and gets, tracks its
+    high-water mark and records how long producers were blocked on a
+    full queue and consumers on an empty one in WaitTimeHistograms.
+    `stats()` returns a snapshot.  Calls that don't block don't read
+    the clock.
+
+    `lock_spin` is passed to the queue's Locks as `spin`, so that a
+    producer or consumer spins briefly before sleeping when it finds
+    the queue locked, empty or full.  It cuts handoff latency between
+    threads that are actively exchanging items at the cost of CPU time.
+
     This is implemented in Cython to avoid the overhead of python
     function calls when used in the critical paths of other Cython
     code.
     """
-    def __init__(self, maxsize=0):
+    def __init__(self, maxsize=0, sizer=None, max_bytes=0, collect_stats=0,
+                 int lock_spin=0):
         """Initialize a queue object with a given maximum size.
 
         If maxsize is == 0, the queue size is infinite (to the limits
@@ -57,16 +168,41 @@ cdef class BlockingQueue(AbstractQueue):
 
         If maxsize is specified, put/putmany will block when the queue
         is full.
+
+        `sizer(item)` must return the same size for an item each time
+        it's called while the item is queued.  If `max_bytes` is
+        specified, put/putmany will block once the sizes of the queued
+        items add up to it.  An item is admitted whenever the total is
+        below `max_bytes`, so a large one can take it over the limit.
+        Each item is stored with the size it had when it was put, so
+        `sizer` is only called by producers, outside the queue's lock.
         """
 
         assert maxsize>=0
+        assert max_bytes>=0
+        if max_bytes and sizer is None:
+            raise ValueError('max_bytes requires a sizer')
         self._maxsize = maxsize
         self._size = 0
+        self._sizer = sizer
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._bounded = bool(maxsize or max_bytes)
+        self._collect_stats = collect_stats
+        self._producer_waits = WaitTimeHistogram()
+        self._consumer_waits = WaitTimeHistogram()
+        self._reset_stats()
         self._queue = collections.deque()
-        self._mutex = Lock()
-        self._esema = Lock()
-        self._fsema = Lock()
+        # only the mutex is named, for lock profiling.  Waits on the
+        # semaphores are an empty or full queue, not contention, and
+        # are covered by stats()
+        self._mutex = Lock(type(self).__name__+'._mutex', lock_spin)
+        self._esema = Lock(None, lock_spin)
+        self._fsema = Lock(None, lock_spin)
         self._esema.acquire() # it's empty now!
+        self._batch_ready = Lock()
+        self._batch_ready.acquire() # released for a lingering getmany
+        self._linger_target = 0
 
         # shortcut the name lookups:
         self._put = self._queue.append
@@ -78,48 +214,145 @@ cdef class BlockingQueue(AbstractQueue):
         #return len(self._queue)
         return self._size
 
-    cpdef object put(self, object item):
+    cdef inline bint _is_full(self):
+        return ((self._maxsize and self._size >= self._maxsize)
+                or (self._max_bytes and self._bytes >= self._max_bytes))
+
+    cdef long long _size_of(self, object item) except? -1:
+        cdef long long nbytes = self._sizer(item)
+        if nbytes < 0:
+            raise ValueError('negative size %r for item %r'%(nbytes, item))
+        return nbytes
+
+    cdef object _sized(self, object item, long long nbytes):
+        """Returns the entry stored for `item` when there's a sizer: an
+        (item, nbytes) pair that get/getmany unpack."""
+        return (item, nbytes)
+
+    cdef int _acquire_sema(self, Lock sema, double timeout,
+                           WaitTimeHistogram waits) except -1:
+        """Acquires `_fsema` or `_esema` like `_acquire_timed`, timing
+        the wait when it would block and stats are on."""
+        cdef double start_time
+        cdef int acquired
+        if not self._collect_stats:
+            return sema._acquire_timed(timeout)
+        if sema._acquire_timed(0):
+            return 1
+        if timeout == 0:
+            waits.record(0)
+            return 0
+        start_time = time_of_day()
+        acquired = sema._acquire_timed(timeout)
+        waits.record(time_of_day() - start_time)
+        return acquired
+
+    cdef inline void _record_put(self, int count):
+        " Internal use only, must be invoked within the mutex."""
+        self._puts += count
+        if self._size > self._high_water:
+            self._high_water = self._size
+
+    cdef object _reset_stats(self):
+        self._puts = self._gets = 0
+        self._high_water = self._size
+        self._producer_waits.reset()
+        self._consumer_waits.reset()
+
+    def stats(self):
+        """Returns a snapshot of the queue's statistics as a dict.
+        The counters are only updated when `collect_stats` is on."""
+        self._mutex.acquire()
+        try:
+            return dict(
+                size=self._size,
+                maxsize=self._maxsize,
+                queued_bytes=self._bytes,
+                high_water=self._high_water,
+                puts=self._puts,
+                gets=self._gets,
+                producer_waits=self._producer_waits.as_dict(),
+                consumer_waits=self._consumer_waits.as_dict())
+        finally:
+            self._mutex.release()
+
+    def reset_stats(self):
+        self._mutex.acquire()
+        try:
+            self._reset_stats()
+        finally:
+            self._mutex.release()
+
+    cpdef object put(self, object item, double timeout=-1):
         """Adds `item` to the right side of the deque. Equivalent to `deque.append(item)`
 
-        Will block only if the queue has a `maxsize` and is
-        currently full.
+        Will block only if the queue has a `maxsize` or `max_bytes`
+        and is currently full, raising `Full` if it's still full after
+        `timeout` seconds.
         """
         cdef int was_empty
+        cdef long long nbytes = 0
         cdef object result
 
-        if self._maxsize:
-            self._fsema.acquire()
+        if self._sizer is not None:
+            nbytes = self._size_of(item)
+            item = self._sized(item, nbytes)
+        if self._bounded:
+            if not self._acquire_sema(self._fsema, timeout, self._producer_waits):
+                raise Full
         self._mutex.acquire()
         was_empty = not self._size
         result = self._put(item)
         self._size += 1
+        self._bytes += nbytes
+        if self._collect_stats:
+            self._record_put(1)
         if was_empty:
             self._esema.release()
-        if self._maxsize and self._size < self._maxsize:
+        if self._linger_target:
+            self._wake_lingering_consumer()
+        if self._bounded and not self._is_full():
             self._fsema.release()
         self._mutex.release()
 
         return result
 
-    cpdef object putmany(self, object items):
+    cpdef object putmany(self, object items, double timeout=-1):
         """Adds `items` to the right side of the deque. Equivalent to
         `deque.extend(items)`
 
-        Will block only if the queue has a `maxsize` and is
-        currently full.
+        Will block only if the queue has a `maxsize` or `max_bytes`
+        and is currently full, raising `Full` if it's still full after
+        `timeout` seconds.
         """
-        cdef int was_empty
+        cdef int was_empty, count
+        cdef long long nbytes = 0, item_bytes
         cdef object result
-
-        if self._maxsize:
-            self._fsema.acquire()
+        cdef list entries
+
+        if self._sizer is not None:
+            entries = []
+            for item in items:
+                item_bytes = self._size_of(item)
+                nbytes += item_bytes
+                entries.append(self._sized(item, item_bytes))
+            items = entries
+        if self._bounded:
+            if not self._acquire_sema(self._fsema, timeout, self._producer_waits):
+                raise Full
         self._mutex.acquire()
         was_empty = not self._size
+        count = self._size
         result = self._extend(items)
         self._size += len(items)
+        self._bytes += nbytes
+        if self._collect_stats:
+            self._record_put(self._size - count)
         if was_empty and self._size:
             self._esema.release()
-        if self._maxsize and self._size < self._maxsize:
+        if self._linger_target:
+            self._wake_lingering_consumer()
+        if self._bounded and not self._is_full():
             if self._fsema.locked(): # may not be locked
                 self._fsema.release()
         self._mutex.release()
@@ -130,54 +363,101 @@ cdef class BlockingQueue(AbstractQueue):
         """Adds `item` to the left side of the deque.
         Equivalent to `deque.appendleft(item)`.
 
-        If the queue has a `maxsize` and is full this will block,
-        unless `respectmaxsize`=0.
+        If the queue has a `maxsize` or `max_bytes` and is full this
+        will block, unless `respectmaxsize`=0.
 
         Note, `respectmaxsize` is provided so job queues (thread
         pools, etc.) using BlockingQueue can put important high
         priority jobs on the queue even when full.
         """
         cdef int was_empty
+        cdef long long nbytes = 0
         cdef object result
 
-        if respectmaxsize and self._maxsize:
-            self._fsema.acquire()
+        if self._sizer is not None:
+            nbytes = self._size_of(item)
+            item = self._sized(item, nbytes)
+        if respectmaxsize and self._bounded:
+            self._acquire_sema(self._fsema, -1, self._producer_waits)
         self._mutex.acquire()
         was_empty = not self._size
         result = self._putleft(item)
         self._size += 1
+        self._bytes += nbytes
+        if self._collect_stats:
+            self._record_put(1)
         if was_empty:
             self._esema.release()
-        if self._maxsize and self._size < self._maxsize:
+        if self._linger_target:
+            self._wake_lingering_consumer()
+        if self._bounded and not self._is_full():
             if self._fsema.locked(): # may not be locked, due to respectmaxsize
                 self._fsema.release()
         self._mutex.release()
 
         return result
 
-    cpdef object get(self):
+    cpdef object get(self, double timeout=-1):
         """Gets one item from the left side of the deque.
         Equivalent to `deque.popleft`.
 
-        Will block if the queue is empty.
+        Will block if the queue is empty, raising `Empty` if it's
+        still empty after `timeout` seconds.
         """
         cdef int was_full
         cdef object item
+        cdef long long nbytes
 
-        self._esema.acquire()
+        if not self._acquire_sema(self._esema, timeout, self._consumer_waits):
+            raise Empty
         self._mutex.acquire()
-        was_full = (self._maxsize and self._size >= self._maxsize)
+        was_full = self._is_full()
         item = self._popleft()
         self._size -= 1
+        if self._sizer is not None:
+            item, nbytes = item
+            self._bytes -= nbytes
+        if self._collect_stats:
+            self._gets += 1
         if was_full:
-            if self._size < self._maxsize and self._fsema.locked():
+            if not self._is_full() and self._fsema.locked():
                 self._fsema.release()
         if self._size:
             self._esema.release()
         self._mutex.release()
         return item
 
-    cpdef object getmany(self, int maxitems=0):
+    cdef int _wake_lingering_consumer(self) except -1:
+        " Internal use only, must be invoked within the mutex."""
+        if self._size >= self._linger_target:
+            self._linger_target = 0
+            self._batch_ready.release()
+        return 0
+
+    cdef int _linger(self, int min_items, double linger) except -1:
+        """Waits up to `linger` seconds for `min_items` to be present.
+        Must be invoked by a consumer holding `_esema`, and returns with
+        the mutex acquired."""
+        if self._maxsize and min_items > self._maxsize:
+            min_items = self._maxsize
+        self._mutex.acquire()
+        if self._size >= min_items:
+            return 0
+        self._linger_target = min_items
+        self._mutex.release()
+        if self._batch_ready._acquire_timed(linger):
+            self._mutex.acquire()
+        else:
+            self._mutex.acquire()
+            if self._linger_target:
+                self._linger_target = 0
+            else:
+                # a put released it as the wait timed out
+                self._batch_ready.acquire()
+        return 0
+
+    cpdef object getmany(self, int maxitems=0, int min_items=0, double linger=0,
+                         double timeout=-1):
         """Gets many items from the left side of the deque.
         Equivalent to `deque.popleft` call repeatedly.
 
@@ -185,16 +465,28 @@ cdef class BlockingQueue(AbstractQueue):
         Otherwise, it will attempt to retrieve up to `maxitems`, but
         will *not* block if fewer items are present.
 
-        It will block if the queue is empty.
+        It will block if the queue is empty, raising `Empty` if it's
+        still empty after `timeout` seconds.
+
+        With `linger`, once there is an item it waits up to `linger`
+        more seconds for at least `min_items` (capped at `maxitems`) to
+        be present.  Other consumers wait while it lingers.
         """
         cdef int was_full, howmany, i
         cdef object item
+        cdef long long nbytes
 
         result = []
 
-        self._esema.acquire()
-        self._mutex.acquire()
-        was_full = (self._maxsize and self._size >= self._maxsize)
+        if not self._acquire_sema(self._esema, timeout, self._consumer_waits):
+            raise Empty
+        if linger > 0 and min_items > 1:
+            if maxitems and min_items > maxitems:
+                min_items = maxitems
+            self._linger(min_items, linger)
+        else:
+            self._mutex.acquire()
+        was_full = self._is_full()
 
         if maxitems:
             howmany = min(maxitems, self._size)
@@ -203,12 +495,18 @@ cdef class BlockingQueue(AbstractQueue):
 
         i = 0
         while i < howmany and self._size:
-            result.append(self._popleft())
+            item = self._popleft()
             self._size -= 1
+            if self._sizer is not None:
+                item, nbytes = item
+                self._bytes -= nbytes
+            result.append(item)
             i += 1
+        if self._collect_stats:
+            self._gets += i
 
         if was_full:
-            if self._size < self._maxsize and self._fsema.locked():
+            if not self._is_full() and self._fsema.locked():
                 self._fsema.release()
         if self._size:
             self._esema.release()
@@ -219,14 +517,289 @@ cdef class BlockingQueue(AbstractQueue):
         def __get__(self):
             return self._maxsize
 
+    property max_bytes:
+        def __get__(self):
+            return self._max_bytes
+
+    property queued_bytes:
+        def __get__(self):
+            return self._bytes
+
     property is_full:
         def __get__(self):
-            return (self._maxsize and self._size >= self._maxsize)
+            return self._is_full()
 
     property is_empty:
         def __get__(self):
             return not self._size
 
+cdef class _PrioritizedItem:
+    def __init__(self, item, priority):
+        self.item = item
+        self.priority = priority
+
+cdef class _PriorityHeap:
+    """A heap with the subset of the deque interface BlockingQueue
+    uses.  Entries are (priority, sequence number, item) so items with
+    the same priority come out in the order they went in and are never
+    compared themselves."""
+
+    def __init__(self, default_priority=0):
+        self._heap = []
+        self._seq = 0
+        self._left_seq = -1
+        self.default_priority = default_priority
+
+    def __len__(self):
+        return len(self._heap)
+
+    def append(self, item):
+        cdef _PrioritizedItem prioritized
+        if isinstance(item, _PrioritizedItem):
+            prioritized = item
+            heappush(self._heap, (prioritized.priority, self._seq, prioritized.item))
+        else:
+            heappush(self._heap, (self.default_priority, self._seq, item))
+        self._seq += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def appendleft(self, item):
+        """Adds `item` ahead of everything else: with the priority of
+        the current head and a sequence number lower than any other."""
+        if self._heap:
+            priority = self._heap[0][0]
+        else:
+            priority = self.default_priority
+        heappush(self._heap, (priority, self._left_seq, item))
+        self._left_seq -= 1
+
+    def popleft(self):
+        return heappop(self._heap)[2]
+
+cdef class PriorityBlockingQueue(BlockingQueue):
+    """A BlockingQueue that hands out items in priority order.
+
+    Lower numbers come out first and items with the same priority come
+    out in FIFO order.  `put`, `putmany` and friends use
+    `default_priority`; `put_prioritized` takes an explicit one.
+    `putleft` puts an item ahead of everything already queued.  The
+    blocking behaviour, `maxsize`, `max_bytes` and timeouts are the
+    same as BlockingQueue's.
+    """
+    def __init__(self, maxsize=0, default_priority=0, sizer=None, max_bytes=0,
+                 collect_stats=0, int lock_spin=0):
+        BlockingQueue.__init__(self, maxsize, sizer, max_bytes, collect_stats,
+                               lock_spin)
+        self._queue = _PriorityHeap(default_priority)
+        self._put = self._queue.append
+        self._extend = self._queue.extend
+        self._putleft = self._queue.appendleft
+        self._popleft = self._queue.popleft
+
+    cpdef object put_prioritized(self, object item, object priority, double timeout=-1):
+        """Adds `item` with the given `priority`.  Blocks like `put`."""
+        return BlockingQueue.put(self, _PrioritizedItem(item, priority), timeout)
+
+    cdef long long _size_of(self, object item) except? -1:
+        if isinstance(item, _PrioritizedItem):
+            item = (<_PrioritizedItem>item).item
+        return BlockingQueue._size_of(self, item)
+
+    cdef object _sized(self, object item, long long nbytes):
+        cdef _PrioritizedItem prioritized
+        if isinstance(item, _PrioritizedItem):
+            prioritized = item
+            return _PrioritizedItem((prioritized.item, nbytes), prioritized.priority)
+        return (item, nbytes)
+
+    property default_priority:
+        def __get__(self):
+            return self._queue.default_priority
+
+cdef class SPSCQueue(AbstractQueue):
+    """A bounded queue for exactly one producer thread and one consumer
+    thread.
+
+    Items are stored in a preallocated ring of slots.  The producer
+    only ever advances the tail index and the consumer only ever
+    advances the head index, so neither `put` nor `get` takes a lock.
+    A consumer that finds the queue empty (or a producer that finds it
+    full) flags that it's waiting and blocks on a Lock, which the other
+    side releases only when that flag is set.  The uncontended paths
+    therefore cost a few atomic loads and stores rather than the three
+    Lock operations of BlockingQueue.
+
+    `maxsize` is rounded up to a power of two.  Using this with more
+    than one producer or more than one consumer corrupts it.  `putleft`
+    isn't supported.
+    """
+    def __cinit__(self, maxsize=1024):
+        # the ring is set up here, as it's freed in __dealloc__, so
+        # that __init__ being skipped or called again can't leak it or
+        # leave it NULL
+        assert maxsize > 0
+        self._capacity = 1
+        while self._capacity < maxsize:
+            self._capacity *= 2
+        self._mask = self._capacity - 1
+        self._slots = <PyObject **>PyMem_Malloc(sizeof(PyObject *) * self._capacity)
+        if self._slots is NULL:
+            raise MemoryError
+        self._head = self._tail = 0
+        self._consumer_waiting = self._producer_waiting = 0
+        self._not_empty = Lock()
+        self._not_empty.acquire()
+        self._not_full = Lock()
+        self._not_full.acquire()
+
+    def __dealloc__(self):
+        cdef unsigned long i
+        if self._slots is not NULL:
+            i = self._head
+            while i != self._tail:
+                Py_XDECREF(self._slots[i & self._mask])
+                i += 1
+            PyMem_Free(self._slots)
+
+    def __len__(self):
+        return dss_atomic_load_acquire(&self._tail) - dss_atomic_load_acquire(&self._head)
+
+    cdef int _wait_for_items(self, unsigned long count, double timeout) except -1:
+        """Consumer only.  Returns 1 once there are `count` items to
+        get or 0 if `timeout` expires first."""
+        cdef double deadline = 0
+        if timeout > 0:
+            deadline = time_of_day() + timeout
+        while dss_atomic_load_acquire(&self._tail) - self._head < count:
+            if deadline:
+                timeout = deadline - time_of_day()
+                if timeout <= 0:
+                    return 0
+            elif timeout == 0:
+                return 0
+            dss_atomic_store_seq_cst(&self._consumer_waiting, 1)
+            if dss_atomic_load_seq_cst(&self._tail) - self._head >= count:
+                # an item arrived after all
+                if not dss_atomic_exchange(&self._consumer_waiting, 0):
+                    # but the producer saw the flag, so absorb its release
+                    self._not_empty.acquire()
+                return 1
+            if not self._not_empty._acquire_timed(timeout):
+                if dss_atomic_exchange(&self._consumer_waiting, 0):
+                    return 0
+                # a put raced with the timeout
+                self._not_empty.acquire()
+        return 1
+
+    cdef int _wait_until_not_full(self, double timeout) except -1:
+        """Producer only.  Returns 1 once there's a free slot or 0 if
+        `timeout` expires first."""
+        cdef double deadline = 0
+        if timeout > 0:
+            deadline = time_of_day() + timeout
+        while self._tail - dss_atomic_load_acquire(&self._head) >= self._capacity:
+            if deadline:
+                timeout = deadline - time_of_day()
+                if timeout <= 0:
+                    return 0
+            elif timeout == 0:
+                return 0
+            dss_atomic_store_seq_cst(&self._producer_waiting, 1)
+            if self._tail - dss_atomic_load_seq_cst(&self._head) < self._capacity:
+                if not dss_atomic_exchange(&self._producer_waiting, 0):
+                    self._not_full.acquire()
+                return 1
+            if not self._not_full._acquire_timed(timeout):
+                if dss_atomic_exchange(&self._producer_waiting, 0):
+                    return 0
+                self._not_full.acquire()
+        return 1
+
+    cpdef object put(self, object item, double timeout=-1):
+        """Adds `item` to the queue.  Producer thread only.
+
+        Blocks if the queue is full, raising `Full` if it's still full
+        after `timeout` seconds."""
+        if not self._wait_until_not_full(timeout):
+            raise Full
+        Py_INCREF(item)
+        self._slots[self._tail & self._mask] = <PyObject *>item
+        dss_atomic_store_seq_cst(&self._tail, self._tail + 1)
+        if (dss_atomic_load_seq_cst(&self._consumer_waiting)
+            and dss_atomic_exchange(&self._consumer_waiting, 0)):
+            self._not_empty.release()
+
+    cpdef object putmany(self, object items, double timeout=-1):
+        """Adds each of `items` in turn.  Producer thread only.
+
+        `timeout` applies to each item separately."""
+        for item in items:
+            self.put(item, timeout)
+
+    cdef object _pop(self):
+        " Consumer only.  The queue must not be empty."""
+        cdef unsigned long i = self._head & self._mask
+        cdef object item = <object>self._slots[i]
+        Py_XDECREF(self._slots[i])
+        self._slots[i] = NULL
+        dss_atomic_store_seq_cst(&self._head, self._head + 1)
+        return item
+
+    cpdef object get(self, double timeout=-1):
+        """Gets the oldest item.  Consumer thread only.
+
+        Blocks if the queue is empty, raising `Empty` if it's still
+        empty after `timeout` seconds."""
+        if not self._wait_for_items(1, timeout):
+            raise Empty
+        item = self._pop()
+        if (dss_atomic_load_seq_cst(&self._producer_waiting)
+            and dss_atomic_exchange(&self._producer_waiting, 0)):
+            self._not_full.release()
+        return item
+
+    cpdef object getmany(self, int maxitems=0, int min_items=0, double linger=0,
+                         double timeout=-1):
+        """Gets up to `maxitems`, or all, of the items present.
+        Consumer thread only.
+
+        Blocks if the queue is empty, raising `Empty` if it's still
+        empty after `timeout` seconds.  With `linger`, it then waits up
+        to `linger` more seconds for `min_items` to be present, as
+        BlockingQueue.getmany does."""
+        cdef unsigned long howmany, i
+        if not self._wait_for_items(1, timeout):
+            raise Empty
+        if linger > 0 and min_items > 1:
+            if maxitems and min_items > maxitems:
+                min_items = maxitems
+            self._wait_for_items(min(<unsigned long>min_items, self._capacity), linger)
+        howmany = dss_atomic_load_acquire(&self._tail) - self._head
+        if maxitems and howmany > maxitems:
+            howmany = maxitems
+        result = []
+        for i from 0 <= i < howmany:
+            result.append(self._pop())
+        if (dss_atomic_load_seq_cst(&self._producer_waiting)
+            and dss_atomic_exchange(&self._producer_waiting, 0)):
+            self._not_full.release()
+        return result
+
+    property maxsize:
+        def __get__(self):
+            return self._capacity
+
+    property is_full:
+        def __get__(self):
+            return len(self) >= self._capacity
+
+    property is_empty:
+        def __get__(self):
+            return not len(self)
+
 #cdef class SingleConsumer(BlockingQueue):
 #    """@@TR: Needs re-testing!!!  Do not use until this docstring has
 #    been updated.
@@ -0,0 +1,72 @@
+from posix.types cimport off_t
+
+cdef extern from "pthread.h" nogil:
+    ctypedef struct pthread_mutex_t:
+        pass
+    ctypedef struct pthread_mutexattr_t:
+        pass
+    int PTHREAD_PROCESS_SHARED
+    int PTHREAD_MUTEX_ROBUST
+    int pthread_mutexattr_init(pthread_mutexattr_t *attr)
+    int pthread_mutexattr_destroy(pthread_mutexattr_t *attr)
+    int pthread_mutexattr_setpshared(pthread_mutexattr_t *attr, int pshared)
+    int pthread_mutexattr_setrobust(pthread_mutexattr_t *attr, int robustness)
+    int pthread_mutex_init(pthread_mutex_t *mutex, pthread_mutexattr_t *attr)
+    int pthread_mutex_lock(pthread_mutex_t *mutex)
+    int pthread_mutex_unlock(pthread_mutex_t *mutex)
+    int pthread_mutex_consistent(pthread_mutex_t *mutex)
+
+cdef extern from "errno.h":
+    int EOWNERDEAD
+
+cdef extern from "sys/mman.h" nogil:
+    void *mmap(void *addr, size_t length, int prot, int flags, int fd, off_t offset)
+    int munmap(void *addr, size_t length)
+    int PROT_READ
+    int PROT_WRITE
+    int MAP_SHARED
+    void *MAP_FAILED
+
+from dss.sys.time_of_day cimport time_of_day
+
+cdef struct _SegmentHeader:
+    unsigned long long magic
+    unsigned int version
+    unsigned int num_buckets
+    unsigned int ways
+    unsigned int slot_size
+
+cdef struct _SlotHeader:
+    unsigned long long key_hash
+    double expiry_time
+    double last_access_time
+    unsigned int key_len
+    unsigned int value_len
+    int in_use
+
+cdef class SharedMemoryCache:
+    cdef readonly object path
+    cdef readonly unsigned int num_buckets
+    cdef readonly unsigned int ways
+    cdef readonly unsigned int slot_size
+    cdef public double _ttl
+    cdef size_t _stride
+    cdef size_t _mapped_size
+    cdef char *_base
+    cdef pthread_mutex_t *_locks
+    cdef char *_slots
+
+    cdef object _open(self, int mode)
+    cdef object _map(self, int fd, size_t size)
+    cdef object _initialize(self)
+    cdef object _check_open(self)
+    cdef inline _SlotHeader *_slot(self, unsigned int bucket, unsigned int way)
+    cdef int _lock_bucket(self, unsigned int bucket) except -1
+    cdef inline void _unlock_bucket(self, unsigned int bucket)
+    cdef void _clear_bucket(self, unsigned int bucket)
+    cdef int _find(self, unsigned int bucket, unsigned long long key_hash,
+                   char *key, unsigned int key_len)
+    cdef int _victim(self, unsigned int bucket, double now)
+    cdef object _get(self, object key)
+    cdef object _set(self, object key, object val, double ttl)
+    cdef bint _delete(self, object key) except -1
@@ -0,0 +1,371 @@
+import os
+import fcntl
+from cPickle import dumps, loads, Pickler
+from cStringIO import StringIO
+
+from libc.string cimport memcpy, memcmp, memset
+
+from dss.sys.time_of_day cimport time_of_day
+from dss.sys.Unspecified import Unspecified
+
+cdef unsigned long long _MAGIC = 0x6473734c52554d31ULL # 'dssLRUM1'
+cdef unsigned int _VERSION = 2
+cdef size_t _ALIGNMENT = 64
+
+cdef object _MISSING = object()
+
+cdef inline size_t _align(size_t size, size_t alignment):
+    return (size + alignment - 1) / alignment * alignment
+
+cdef bytes _dump_key(object key):
+    # Pickles the key without the memo, which works by object identity,
+    # so that equal keys pickle to the same bytes even if one shares
+    # objects that the other only has copies of.
+    f = StringIO()
+    pickler = Pickler(f, 2)
+    pickler.fast = 1
+    pickler.dump(key)
+    return f.getvalue()
+
+cdef inline unsigned long long _hash_bytes(char *data, unsigned int length):
+    # FNV-1a. The builtin hash() can't be used as it isn't guaranteed to
+    # be the same in every process.
+    cdef unsigned long long h = 0xcbf29ce484222325ULL
+    cdef unsigned int i
+    for i from 0 <= i < length:
+        h = (h ^ <unsigned char>data[i]) * 0x100000001b3ULL
+    return h
+
+cdef class SharedMemoryCache:
+    """
+    A cache shared by all processes on a host, stored in a memory-mapped
+    file.
+
+    The file, which should usually be on a tmpfs such as /dev/shm, is
+    created by whichever process opens it first and is simply mapped by
+    the others.  A cache that is opened before forking is also shared
+    with the children.
+
+    Keys and values are pickled and stored together in fixed-size slots
+    of `slot_size` bytes; storing a larger entry raises ValueError.  Keys
+    are compared by their pickles, which are produced without the pickle
+    memo so that equal strings, numbers and tuples of them pickle the
+    same in every process.  Equal keys of different types, such as 1 and
+    1.0, are different keys.
+
+    The slots are grouped into buckets of `ways` slots, each protected
+    by its own process-shared mutex, and a key can only be stored in
+    the bucket its hash selects.  When a bucket is full, the least
+    recently used entry in it is replaced, so the eviction order is an
+    approximation of LRU.  The mutexes are robust: if a process dies
+    while holding one, the next process to take it clears that bucket,
+    whose contents can't be trusted.
+
+    The interface is a subset of LRUCache's:
+      val = cache.get(key, default)
+      cache[key] = val
+      cache.set(key, val, ttl)
+      key in cache
+      del cache[key]
+    """
+
+    def __init__(self, path, int maxsize=1024, int slot_size=1024, int ways=8,
+                 double ttl=0, int mode=0600):
+        assert maxsize > 0 and slot_size > 0 and ways > 0
+        self.path = path
+        self.ways = ways
+        self.num_buckets = (maxsize + ways - 1) / ways
+        self.slot_size = slot_size
+        self._ttl = ttl
+        self._stride = _align(sizeof(_SlotHeader) + slot_size, 8)
+        self._open(mode)
+
+    def __dealloc__(self):
+        if self._base is not NULL:
+            munmap(self._base, self._mapped_size)
+
+    def close(self):
+        """Unmaps the cache.  The file is left in place for other
+        processes."""
+        if self._base is not NULL:
+            munmap(self._base, self._mapped_size)
+            self._base = NULL
+
+    def __contains__(self, key):
+        return self._get(key) is not _MISSING
+
+    def has_key(self, key):
+        return self._get(key) is not _MISSING
+
+    def get(self, key, default=Unspecified):
+        val = self._get(key)
+        if val is _MISSING:
+            if default is Unspecified:
+                raise KeyError(key)
+            return default
+        return val
+
+    def __getitem__(self, key):
+        val = self._get(key)
+        if val is _MISSING:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        self._set(key, val, self._ttl)
+
+    def set(self, key, val, ttl=Unspecified):
+        """Equivalent to `cache[key] = val`, but allows the cache's
+        default `ttl` to be overridden for this entry."""
+        if ttl is Unspecified:
+            ttl = self._ttl
+        self._set(key, val, ttl)
+
+    def __delitem__(self, key):
+        if not self._delete(key):
+            raise KeyError(key)
+
+    def __len__(self):
+        cdef unsigned int bucket, way
+        cdef double now = time_of_day()
+        cdef _SlotHeader *slot
+        cdef int count = 0
+        self._check_open()
+        for bucket from 0 <= bucket < self.num_buckets:
+            self._lock_bucket(bucket)
+            for way from 0 <= way < self.ways:
+                slot = self._slot(bucket, way)
+                if slot.in_use and not (slot.expiry_time and slot.expiry_time <= now):
+                    count += 1
+            self._unlock_bucket(bucket)
+        return count
+
+    def clear(self):
+        """ Clears the cache, for all processes """
+        cdef unsigned int bucket
+        self._check_open()
+        for bucket from 0 <= bucket < self.num_buckets:
+            self._lock_bucket(bucket)
+            self._clear_bucket(bucket)
+            self._unlock_bucket(bucket)
+
+    property maxsize:
+        def __get__(self):
+            return self.num_buckets * self.ways
+
+    property ttl:
+        def __get__(self):
+            return self._ttl
+
+    cdef object _open(self, int mode):
+        cdef size_t header_size = _align(sizeof(_SegmentHeader), _ALIGNMENT)
+        cdef size_t locks_size = _align(sizeof(pthread_mutex_t) * self.num_buckets, _ALIGNMENT)
+        cdef size_t size = header_size + locks_size + self._stride * self.num_buckets * self.ways
+        cdef _SegmentHeader *header
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, mode)
+        try:
+            # serializes the initialization of a new file
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                existing_size = os.fstat(fd).st_size
+                if existing_size == 0:
+                    os.ftruncate(fd, size)
+                elif existing_size != size:
+                    raise ValueError(
+                        '%s is %i bytes, expected %i: it was created with different '
+                        'settings'%(self.path, existing_size, size))
+                self._map(fd, size)
+                self._locks = <pthread_mutex_t *>(self._base + header_size)
+                self._slots = self._base + header_size + locks_size
+                header = <_SegmentHeader *>self._base
+                if existing_size == 0:
+                    self._initialize()
+                elif (header.magic != _MAGIC or header.version != _VERSION
+                      or header.num_buckets != self.num_buckets
+                      or header.ways != self.ways
+                      or header.slot_size != self.slot_size):
+                    self.close()
+                    raise ValueError(
+                        '%s is not a compatible SharedMemoryCache'%self.path)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            # the mapping stays valid once the file is closed
+            os.close(fd)
+
+    cdef object _map(self, int fd, size_t size):
+        cdef void *base = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0)
+        if base == MAP_FAILED:
+            raise OSError('mmap of %s failed'%self.path)
+        self._base = <char *>base
+        self._mapped_size = size
+
+    cdef object _initialize(self):
+        """Sets up the header and mutexes of a new, zero-filled file."""
+        cdef _SegmentHeader *header = <_SegmentHeader *>self._base
+        cdef pthread_mutexattr_t attr
+        cdef unsigned int bucket
+        pthread_mutexattr_init(&attr)
+        pthread_mutexattr_setpshared(&attr, PTHREAD_PROCESS_SHARED)
+        pthread_mutexattr_setrobust(&attr, PTHREAD_MUTEX_ROBUST)
+        for bucket from 0 <= bucket < self.num_buckets:
+            pthread_mutex_init(&self._locks[bucket], &attr)
+        pthread_mutexattr_destroy(&attr)
+        header.num_buckets = self.num_buckets
+        header.ways = self.ways
+        header.slot_size = self.slot_size
+        header.version = _VERSION
+        header.magic = _MAGIC
+
+    cdef object _check_open(self):
+        if self._base is NULL:
+            raise ValueError('the cache has been closed')
+
+    cdef inline _SlotHeader *_slot(self, unsigned int bucket, unsigned int way):
+        return <_SlotHeader *>(self._slots + (<size_t>bucket * self.ways + way) * self._stride)
+
+    cdef int _lock_bucket(self, unsigned int bucket) except -1:
+        cdef pthread_mutex_t *mutex = &self._locks[bucket]
+        cdef int rc
+        with nogil:
+            rc = pthread_mutex_lock(mutex)
+        if rc == EOWNERDEAD:
+            # the process holding the lock died, perhaps half way through
+            # writing an entry
+            pthread_mutex_consistent(mutex)
+            self._clear_bucket(bucket)
+        elif rc != 0:
+            raise OSError(rc, os.strerror(rc))
+        return 0
+
+    cdef inline void _unlock_bucket(self, unsigned int bucket):
+        pthread_mutex_unlock(&self._locks[bucket])
+
+    cdef void _clear_bucket(self, unsigned int bucket):
+        " Internal use only, must be invoked within the bucket's lock."""
+        cdef unsigned int way
+        for way from 0 <= way < self.ways:
+            memset(self._slot(bucket, way), 0, sizeof(_SlotHeader))
+
+    cdef int _find(self, unsigned int bucket, unsigned long long key_hash,
+                   char *key, unsigned int key_len):
+        """ Internal use only, must be invoked within the bucket's lock.
+
+        Returns the way holding `key` or -1."""
+        cdef unsigned int way
+        cdef _SlotHeader *slot
+        for way from 0 <= way < self.ways:
+            slot = self._slot(bucket, way)
+            if (slot.in_use and slot.key_hash == key_hash and slot.key_len == key_len
+                and memcmp(<char *>slot + sizeof(_SlotHeader), key, key_len) == 0):
+                return way
+        return -1
+
+    cdef int _victim(self, unsigned int bucket, double now):
+        """ Internal use only, must be invoked within the bucket's lock.
+
+        Returns the way to store a new entry in: an empty or expired
+        slot if there is one, otherwise the least recently used one."""
+        cdef unsigned int way
+        cdef int victim = 0
+        cdef _SlotHeader *slot
+        for way from 0 <= way < self.ways:
+            slot = self._slot(bucket, way)
+            if not slot.in_use or (slot.expiry_time and slot.expiry_time <= now):
+                return way
+            if slot.last_access_time < self._slot(bucket, victim).last_access_time:
+                victim = way
+        return victim
+
+    cdef object _get(self, object key):
+        cdef bytes key_bytes = _dump_key(key)
+        cdef char *key_data = key_bytes
+        cdef unsigned int key_len = len(key_bytes)
+        cdef unsigned long long key_hash = _hash_bytes(key_data, key_len)
+        cdef unsigned int bucket = key_hash % self.num_buckets
+        cdef _SlotHeader *slot
+        cdef char *data
+        cdef double now
+        cdef int way
+        cdef bytes val_bytes = None
+
+        self._check_open()
+        self._lock_bucket(bucket)
+        try:
+            way = self._find(bucket, key_hash, key_data, key_len)
+            if way >= 0:
+                slot = self._slot(bucket, way)
+                now = time_of_day()
+                if slot.expiry_time and slot.expiry_time <= now:
+                    slot.in_use = 0
+                else:
+                    slot.last_access_time = now
+                    data = <char *>slot + sizeof(_SlotHeader) + key_len
+                    val_bytes = data[:slot.value_len]
+        finally:
+            self._unlock_bucket(bucket)
+
+        if val_bytes is None:
+            return _MISSING
+        return loads(val_bytes)
+
+    cdef object _set(self, object key, object val, double ttl):
+        cdef bytes key_bytes = _dump_key(key)
+        cdef bytes val_bytes = dumps(val, 2)
+        cdef char *key_data = key_bytes
+        cdef unsigned int key_len = len(key_bytes)
+        cdef unsigned int val_len = len(val_bytes)
+        cdef unsigned long long key_hash
+        cdef unsigned int bucket
+        cdef _SlotHeader *slot
+        cdef char *data
+        cdef double now
+        cdef int way
+
+        if key_len + val_len > self.slot_size:
+            raise ValueError('the entry for %r is %i bytes, the slot size is %i'%(
+                key, key_len + val_len, self.slot_size))
+        key_hash = _hash_bytes(key_data, key_len)
+        bucket = key_hash % self.num_buckets
+
+        self._check_open()
+        self._lock_bucket(bucket)
+        try:
+            now = time_of_day()
+            way = self._find(bucket, key_hash, key_data, key_len)
+            if way < 0:
+                way = self._victim(bucket, now)
+            slot = self._slot(bucket, way)
+            data = <char *>slot + sizeof(_SlotHeader)
+            memcpy(data, key_data, key_len)
+            memcpy(data + key_len, <char *>val_bytes, val_len)
+            slot.key_hash = key_hash
+            slot.key_len = key_len
+            slot.value_len = val_len
+            slot.last_access_time = now
+            if ttl > 0:
+                slot.expiry_time = now + ttl
+            else:
+                slot.expiry_time = 0
+            slot.in_use = 1
+        finally:
+            self._unlock_bucket(bucket)
+
+    cdef bint _delete(self, object key) except -1:
+        cdef bytes key_bytes = _dump_key(key)
+        cdef char *key_data = key_bytes
+        cdef unsigned int key_len = len(key_bytes)
+        cdef unsigned long long key_hash = _hash_bytes(key_data, key_len)
+        cdef unsigned int bucket = key_hash % self.num_buckets
+        cdef int way
+
+        self._check_open()
+        self._lock_bucket(bucket)
+        try:
+            way = self._find(bucket, key_hash, key_data, key_len)
+            if way >= 0:
+                self._slot(bucket, way).in_use = 0
+        finally:
+            self._unlock_bucket(bucket)
+        return way >= 0
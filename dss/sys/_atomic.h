@@ -0,0 +1,38 @@
+#ifndef DSS_ATOMIC_H
+#define DSS_ATOMIC_H
+
+/* Memory-ordered loads, stores and exchanges of word-sized integers,
+   used by the lock-free SPSCQueue in Queue.pyx.  GCC >= 4.7 and clang
+   provide the __atomic builtins; older GCCs fall back on full
+   barriers via __sync_synchronize. */
+
+#if defined(__ATOMIC_ACQUIRE)
+
+#define dss_atomic_load_acquire(p) __atomic_load_n((p), __ATOMIC_ACQUIRE)
+#define dss_atomic_load_seq_cst(p) __atomic_load_n((p), __ATOMIC_SEQ_CST)
+#define dss_atomic_store_seq_cst(p, v) __atomic_store_n((p), (v), __ATOMIC_SEQ_CST)
+#define dss_atomic_exchange(p, v) __atomic_exchange_n((p), (v), __ATOMIC_SEQ_CST)
+
+#else
+
+#define dss_atomic_load_acquire(p) ({ __typeof__(*(p)) _v = *(volatile __typeof__(*(p)) *)(p); \
+                                      __sync_synchronize(); _v; })
+#define dss_atomic_load_seq_cst(p) ({ __sync_synchronize(); dss_atomic_load_acquire(p); })
+#define dss_atomic_store_seq_cst(p, v) do { __sync_synchronize(); \
+                                            *(volatile __typeof__(*(p)) *)(p) = (v); \
+                                            __sync_synchronize(); } while (0)
+#define dss_atomic_exchange(p, v) ({ __sync_synchronize(); __sync_lock_test_and_set((p), (v)); })
+
+#endif
+
+/* A hint to the CPU that the caller is busy-waiting, used by spinning
+   Locks in lock.pyx. */
+#if defined(__i386__) || defined(__x86_64__)
+#define dss_cpu_relax() __asm__ __volatile__("pause" ::: "memory")
+#elif defined(__aarch64__)
+#define dss_cpu_relax() __asm__ __volatile__("yield" ::: "memory")
+#else
+#define dss_cpu_relax() __asm__ __volatile__("" ::: "memory")
+#endif
+
+#endif /* DSS_ATOMIC_H */
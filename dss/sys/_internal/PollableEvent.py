@@ -1,7 +1,7 @@
 import os
 import select
 import errno
-from threading import Lock, Condition
+from dss.sys.lock import Lock, Condition
 
 class PollableEvent:
     """Provides an abstract object that can be used to resume select loops with
@@ -26,7 +26,7 @@ class PollableEvent:
             if not self.isSet():
                 os.write(self._write_fd, '1')
             self._flag = True
-            self._cond.notifyAll()
+            self._cond.notify_all()
         finally:
             self._cond.release()
 
@@ -43,7 +43,7 @@ class PollableEvent:
         self._cond.acquire()
         try:
             if not self._flag:
-                self._cond.wait(timeout)
+                self._cond.wait(-1 if timeout is None else timeout)
         finally:
             self._cond.release()
 
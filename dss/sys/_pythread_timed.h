@@ -0,0 +1,32 @@
+#ifndef DSS_PYTHREAD_TIMED_H
+#define DSS_PYTHREAD_TIMED_H
+
+/* A timed acquire for PyThread locks, used by Lock in lock.pyx.
+   PyThread_acquire_lock_timed appeared in Python 3.2; on older
+   Pythons DSS_HAVE_TIMED_ACQUIRE is 0 and Lock polls instead. */
+
+#include "Python.h"
+#include "pythread.h"
+
+#if PY_VERSION_HEX >= 0x03020000
+
+#define DSS_HAVE_TIMED_ACQUIRE 1
+
+static int dss_acquire_lock_timed(PyThread_type_lock lock, double timeout)
+{
+    PY_TIMEOUT_T microseconds;
+    if (timeout * 1e6 >= (double)PY_TIMEOUT_MAX)
+        microseconds = PY_TIMEOUT_MAX;
+    else
+        microseconds = (PY_TIMEOUT_T)(timeout * 1e6);
+    return PyThread_acquire_lock_timed(lock, microseconds, 0) == PY_LOCK_ACQUIRED;
+}
+
+#else
+
+#define DSS_HAVE_TIMED_ACQUIRE 0
+#define dss_acquire_lock_timed(lock, timeout) 0
+
+#endif
+
+#endif /* DSS_PYTHREAD_TIMED_H */
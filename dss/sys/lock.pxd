@@ -5,10 +5,78 @@ cdef extern from "pythread.h":
     void  PyThread_free_lock(PyThread_type_lock lock)
     int PyThread_acquire_lock(PyThread_type_lock lock, int mode) nogil
     void PyThread_release_lock(PyThread_type_lock lock)
+    long PyThread_get_thread_ident()
+
+cdef extern from "unistd.h":
+    int usleep(unsigned int usec) nogil
+    long sysconf(int name)
+    int _SC_NPROCESSORS_ONLN
+
+cdef extern from "_pythread_timed.h":
+    bint DSS_HAVE_TIMED_ACQUIRE
+    int dss_acquire_lock_timed(PyThread_type_lock lock, double timeout) nogil
+
+cdef extern from "_atomic.h":
+    void dss_cpu_relax() nogil
+
+cdef class LockStats:
+    cdef readonly object name
+    cdef readonly unsigned long long acquires
+    cdef readonly unsigned long long contended
+    cdef readonly double total_wait
+    cdef readonly double max_wait
 
 cdef class Lock:
     cdef PyThread_type_lock _lock
     cdef bint _locked
+    cdef LockStats _stats
+    cdef int _max_spin
+    cdef int _spin_estimate
     cpdef bint locked(self)
-    cpdef int acquire(Lock, int blocking=?) except -1
+    cpdef int acquire(Lock, int blocking=?, double timeout=?) except -1
     cpdef int release(Lock) except -1
+    cdef int _acquire_timed(Lock, double timeout) except -1
+    cdef int _acquire_waiting(Lock, double timeout) except -1
+    cdef int _acquire_profiled(Lock, double timeout) except -1
+
+cdef class RLock:
+    cdef Lock _block
+    cdef long _owner
+    cdef int _count
+    cpdef bint locked(self)
+    cpdef int acquire(RLock, int blocking=?, double timeout=?) except -1
+    cpdef int release(RLock) except -1
+    cdef int _acquire_timed(RLock, double timeout) except -1
+    cdef bint _is_owned(RLock)
+    cdef int _release_save(RLock) except -1
+    cdef int _acquire_restore(RLock, int count) except -1
+
+cdef class Condition:
+    cdef Lock _lock
+    cdef RLock _rlock
+    cdef list _waiters
+    cpdef int acquire(Condition, int blocking=?, double timeout=?) except -1
+    cpdef int release(Condition) except -1
+    cpdef int wait(Condition, double timeout=?) except -1
+    cpdef int notify(Condition, int n=?) except -1
+    cpdef int notify_all(Condition) except -1
+    cdef bint _is_owned(Condition)
+
+cdef class Semaphore:
+    cdef int _value
+    cdef Condition _cond
+    cpdef int acquire(Semaphore, int blocking=?, double timeout=?) except -1
+    cpdef int release(Semaphore) except -1
+    cdef int _acquire_timed(Semaphore, double timeout) except -1
+
+cdef class RWLock:
+    cdef Lock _mutex
+    cdef Condition _readers_ok
+    cdef Condition _writers_ok
+    cdef int _readers
+    cdef int _waiting_writers
+    cdef bint _writer
+    cpdef int acquire_read(RWLock) except -1
+    cpdef int release_read(RWLock) except -1
+    cpdef int acquire_write(RWLock) except -1
+    cpdef int release_write(RWLock) except -1
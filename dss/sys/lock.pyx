@@ -1,17 +1,105 @@
-"""This module natively implements Lock from the threading module.
+"""This module natively implements Lock, RLock, Condition and
+Semaphore from the threading module, plus a reader-writer lock.
+
+Locks and RLocks can be given a name, under which their contention is
+recorded while lock profiling is on (see `enable_lock_profiling`).
+Locks with the same name share a LockStats, so e.g. the locks of all
+LRUCaches are reported together.  With profiling off the only cost is
+a check of a C global on each acquire.
 
 Derived from: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/310792
 Original Copyright. Nicolas Lehuen
 """
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+
+cdef inline double _monotonic_time() nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+# spinning is pointless when the lock holder can't run meanwhile:
+cdef bint _can_spin = sysconf(_SC_NPROCESSORS_ONLN) > 1
+
+cdef bint _lock_profiling = False
+cdef dict _lock_stats_registry = {}
+
+cdef class LockStats:
+    """Contention stats for the Locks sharing a name.  An acquire is
+    contended if the lock was held when it was attempted; only those
+    are timed."""
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.acquires = 0
+        self.contended = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def as_dict(self):
+        return dict(name=self.name,
+                    acquires=self.acquires,
+                    contended=self.contended,
+                    total_wait=self.total_wait,
+                    max_wait=self.max_wait)
+
+cdef LockStats _get_lock_stats_for(object name):
+    cdef LockStats stats
+    stats = _lock_stats_registry.get(name)
+    if stats is None:
+        stats = _lock_stats_registry[name] = LockStats(name)
+    return stats
+
+def enable_lock_profiling():
+    """Starts recording contention for all named Locks and RLocks,
+    including those already created."""
+    global _lock_profiling
+    _lock_profiling = True
+
+def disable_lock_profiling():
+    global _lock_profiling
+    _lock_profiling = False
+
+def is_lock_profiling_enabled():
+    return _lock_profiling
+
+def get_lock_stats(sort_by='total_wait', int limit=0):
+    """Returns the stats of the named locks as a list of dicts, hottest
+    first by `sort_by` (any LockStats field), and at most `limit` of
+    them if it's > 0."""
+    result = [stats.as_dict() for stats in _lock_stats_registry.values()]
+    result.sort(key=lambda d: d[sort_by], reverse=True)
+    if limit > 0:
+        del result[limit:]
+    return result
+
+def reset_lock_stats():
+    cdef LockStats stats
+    for stats in _lock_stats_registry.values():
+        stats.reset()
 
 cdef class Lock:
     """A basic, non-reentrant Lock, implemented in Cython so it can be
     called from critical paths in other Cython code without the
-    overhead of a python function call."""
+    overhead of a python function call.
 
-    def __cinit__(self):
+    With `spin` > 0 a contended acquire first retries up to `spin`
+    times, with the GIL released, before the thread is put to sleep.
+    This suits locks held for a few microseconds at a time.  The spin
+    adapts: it's limited to about twice what recent successful spins
+    took and shrinks after unsuccessful ones, so a lock that's held for
+    long stops wasting cycles.  There's no spinning on uniprocessors."""
+
+    def __cinit__(self, name=None, int spin=0):
         self._lock = PyThread_allocate_lock()
         self._locked = False
+        if name is not None:
+            self._stats = _get_lock_stats_for(name)
+        assert spin >= 0
+        self._max_spin = spin
+        self._spin_estimate = spin
 
     def __dealloc__(self):
         PyThread_free_lock(self._lock)
@@ -19,7 +107,7 @@ cdef class Lock:
     cpdef bint locked(self):
         return self._locked
 
-    cpdef int acquire(self, int blocking=1) except -1:
+    cpdef int acquire(self, int blocking=1, double timeout=-1) except -1:
         """Lock the lock.
 
         With `blocking`=1, this blocks if the lock is already locked
@@ -27,16 +115,15 @@ cdef class Lock:
         release the lock, and return 1 once the lock is acquired.
         With an argument, this will only block if the argument is
         true, and the return value reflects whether the lock is
-        acquired.  The blocking operation is not interruptible."""
-        cdef int result
-        with nogil:
-            result = PyThread_acquire_lock(self._lock, blocking)
+        acquired.  The blocking operation is not interruptible.
 
-        if result==1:
-            self._locked = True
-            return 1
-        else:
-            return 0
+        A `timeout` >= 0 limits the wait to that many seconds, as with
+        threading.Lock."""
+        if not blocking:
+            if timeout >= 0:
+                raise ValueError("can't specify a timeout for a non-blocking call")
+            timeout = 0
+        return self._acquire_timed(timeout)
 
     cpdef int release(self) except -1:
         """Release the lock.
@@ -47,3 +134,356 @@ cdef class Lock:
             raise Exception('Error in lock.release(). This lock %r is not locked'%self)
         PyThread_release_lock(self._lock)
         self._locked = False
+
+    cdef int _acquire_timed(self, double timeout) except -1:
+        """Lock the lock, waiting at most `timeout` seconds.  Returns 1
+        if the lock was acquired and 0 otherwise.
+
+        A negative `timeout` waits forever and 0 doesn't wait at all."""
+        if _lock_profiling and self._stats is not None:
+            return self._acquire_profiled(timeout)
+        return self._acquire_waiting(timeout)
+
+    cdef int _acquire_waiting(self, double timeout) except -1:
+        """Spins first if `spin` was given, retrying the lock up to twice
+        the number of times recent successful spins took.  Like glibc's
+        adaptive mutexes a success moves that estimate 1/8th of the way
+        to its count, while a failure halves it.  The estimate isn't
+        synchronized, it needn't be exact.
+
+        PyThread locks have no timed acquire before Python 3.2, so
+        there a timed wait polls with exponentially increasing sleeps
+        of up to 50ms, the same way threading.Condition.wait does."""
+        cdef int i, limit
+        cdef double deadline, remaining, delay = .0005
+        cdef int result = PyThread_acquire_lock(self._lock, 0)
+
+        if not result and timeout != 0:
+            with nogil:
+                if self._max_spin and _can_spin:
+                    limit = self._spin_estimate * 2 + 16
+                    if limit > self._max_spin:
+                        limit = self._max_spin
+                    for i from 0 <= i < limit:
+                        dss_cpu_relax()
+                        result = PyThread_acquire_lock(self._lock, 0)
+                        if result:
+                            break
+                    if result:
+                        self._spin_estimate = self._spin_estimate + (i - self._spin_estimate) / 8
+                    else:
+                        self._spin_estimate = self._spin_estimate / 2
+
+                if not result and timeout < 0:
+                    result = PyThread_acquire_lock(self._lock, 1)
+                elif not result and DSS_HAVE_TIMED_ACQUIRE:
+                    result = dss_acquire_lock_timed(self._lock, timeout)
+                elif not result:
+                    deadline = _monotonic_time() + timeout
+                    while 1:
+                        result = PyThread_acquire_lock(self._lock, 0)
+                        if result:
+                            break
+                        remaining = deadline - _monotonic_time()
+                        if remaining <= 0:
+                            break
+                        delay = min(delay * 2, remaining, .05)
+                        usleep(<unsigned int>(delay * 1e6))
+        if result:
+            self._locked = True
+            return 1
+        return 0
+
+    cdef int _acquire_profiled(self, double timeout) except -1:
+        """`_acquire_timed`, recording the acquire in the lock's
+        LockStats."""
+        cdef LockStats stats = self._stats
+        cdef double wait
+        cdef int result = PyThread_acquire_lock(self._lock, 0)
+
+        if result:
+            self._locked = True
+        else:
+            stats.contended += 1
+            if timeout == 0:
+                return 0
+            wait = _monotonic_time()
+            result = self._acquire_waiting(timeout)
+            wait = _monotonic_time() - wait
+            stats.total_wait += wait
+            if wait > stats.max_wait:
+                stats.max_wait = wait
+        if result:
+            stats.acquires += 1
+        return result
+
+    property name:
+        def __get__(self):
+            if self._stats is not None:
+                return self._stats.name
+
+cdef class RLock:
+    """A reentrant Lock.  The thread holding it can acquire it again,
+    and must release it as many times as it acquired it.  Like
+    threading.RLock but callable from Cython without python function
+    call overhead."""
+
+    def __cinit__(self, name=None, int spin=0):
+        self._block = Lock(name, spin)
+        self._owner = 0
+        self._count = 0
+
+    cpdef bint locked(self):
+        return self._count > 0
+
+    cpdef int acquire(self, int blocking=1, double timeout=-1) except -1:
+        """Lock the lock, blocking as `Lock.acquire` does unless this
+        thread already holds it."""
+        if self._is_owned():
+            self._count += 1
+            return 1
+        if not self._block.acquire(blocking, timeout):
+            return 0
+        self._owner = PyThread_get_thread_ident()
+        self._count = 1
+        return 1
+
+    cdef int _acquire_timed(self, double timeout) except -1:
+        if self._is_owned():
+            self._count += 1
+            return 1
+        if not self._block._acquire_timed(timeout):
+            return 0
+        self._owner = PyThread_get_thread_ident()
+        self._count = 1
+        return 1
+
+    cpdef int release(self) except -1:
+        """Release the lock.  It must be held by the calling thread."""
+        if not self._is_owned():
+            raise RuntimeError('cannot release un-acquired lock')
+        self._count -= 1
+        if not self._count:
+            self._block.release()
+
+    cdef bint _is_owned(self):
+        return self._count and self._owner == PyThread_get_thread_ident()
+
+    cdef int _release_save(self) except -1:
+        """Fully releases the lock for `Condition.wait`, returning the
+        recursion count to restore."""
+        cdef int count = self._count
+        self._count = 0
+        self._block.release()
+        return count
+
+    cdef int _acquire_restore(self, int count) except -1:
+        self._block.acquire(1)
+        self._owner = PyThread_get_thread_ident()
+        self._count = count
+
+cdef class Condition:
+    """A condition variable, as threading.Condition, over a Lock or
+    RLock (a new RLock by default).
+
+    `wait` takes a `timeout` in seconds, where a negative one waits
+    forever, and returns whether it was notified.  The lock must be
+    held to call `wait`, `notify` or `notify_all`."""
+
+    def __init__(self, lock=None):
+        if lock is None:
+            lock = RLock()
+        if isinstance(lock, RLock):
+            self._rlock = lock
+        elif isinstance(lock, Lock):
+            self._lock = lock
+        else:
+            raise TypeError('Condition requires a dss.sys.lock Lock or RLock')
+        self._waiters = []
+
+    cpdef int acquire(self, int blocking=1, double timeout=-1) except -1:
+        if self._rlock is not None:
+            return self._rlock.acquire(blocking, timeout)
+        return self._lock.acquire(blocking, timeout)
+
+    cpdef int release(self) except -1:
+        if self._rlock is not None:
+            return self._rlock.release()
+        return self._lock.release()
+
+    cdef bint _is_owned(self):
+        if self._rlock is not None:
+            return self._rlock._is_owned()
+        return self._lock.locked()
+
+    cpdef int wait(self, double timeout=-1) except -1:
+        """Releases the lock, waits until notified or for `timeout`
+        seconds and then reacquires the lock."""
+        cdef Lock waiter
+        cdef int count = 0
+        cdef int notified = 0
+
+        if not self._is_owned():
+            raise RuntimeError('cannot wait on un-acquired lock')
+        waiter = Lock()
+        waiter.acquire(1)
+        self._waiters.append(waiter)
+        if self._rlock is not None:
+            count = self._rlock._release_save()
+        else:
+            self._lock.release()
+        try:
+            notified = waiter._acquire_timed(timeout)
+        finally:
+            if self._rlock is not None:
+                self._rlock._acquire_restore(count)
+            else:
+                self._lock.acquire(1)
+            if not notified:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+        return notified
+
+    cpdef int notify(self, int n=1) except -1:
+        """Wakes up to `n` of the threads waiting on the condition."""
+        cdef Lock waiter
+        if not self._is_owned():
+            raise RuntimeError('cannot notify on un-acquired lock')
+        while n > 0 and self._waiters:
+            waiter = self._waiters.pop(0)
+            waiter.release()
+            n -= 1
+
+    cpdef int notify_all(self) except -1:
+        return self.notify(len(self._waiters))
+
+cdef class Semaphore:
+    """A counting semaphore, as threading.Semaphore.
+
+    `acquire` takes the count without touching the underlying
+    Condition when it's positive."""
+
+    def __init__(self, int value=1):
+        if value < 0:
+            raise ValueError('semaphore initial value must be >= 0')
+        self._value = value
+        self._cond = Condition(Lock())
+
+    cpdef int acquire(self, int blocking=1, double timeout=-1) except -1:
+        if not blocking:
+            if timeout >= 0:
+                raise ValueError("can't specify a timeout for a non-blocking call")
+            timeout = 0
+        return self._acquire_timed(timeout)
+
+    cdef int _acquire_timed(self, double timeout) except -1:
+        """Decrements the count, waiting at most `timeout` seconds for
+        it to be positive.  Returns 1 if it was decremented."""
+        cdef double deadline = 0, remaining = -1
+
+        if self._value > 0: # atomic under the GIL
+            self._value -= 1
+            return 1
+        if timeout == 0:
+            return 0
+        if timeout > 0:
+            deadline = _monotonic_time() + timeout
+        self._cond.acquire(1)
+        try:
+            while self._value <= 0:
+                if timeout > 0:
+                    remaining = deadline - _monotonic_time()
+                    if remaining <= 0:
+                        return 0
+                self._cond.wait(remaining)
+            self._value -= 1
+            return 1
+        finally:
+            self._cond.release()
+
+    cpdef int release(self) except -1:
+        self._cond.acquire(1)
+        try:
+            self._value += 1
+            self._cond.notify(1)
+        finally:
+            self._cond.release()
+
+    property value:
+        def __get__(self):
+            return self._value
+
+cdef class RWLock:
+    """A writer-preferring reader-writer lock for read-mostly data.
+
+    Any number of threads can hold the read lock at once, but the
+    write lock is exclusive.  Once a writer is waiting no new readers
+    are admitted, so a steady stream of readers can't starve writers.
+    Neither lock is reentrant: a thread that holds the read lock and
+    asks for it again can deadlock behind a waiting writer."""
+
+    def __init__(self):
+        self._mutex = Lock()
+        self._readers_ok = Condition(self._mutex)
+        self._writers_ok = Condition(self._mutex)
+        self._readers = 0
+        self._waiting_writers = 0
+        self._writer = False
+
+    cpdef int acquire_read(self) except -1:
+        self._mutex.acquire(1)
+        try:
+            while self._writer or self._waiting_writers:
+                self._readers_ok.wait(-1)
+            self._readers += 1
+        finally:
+            self._mutex.release()
+        return 1
+
+    cpdef int release_read(self) except -1:
+        self._mutex.acquire(1)
+        try:
+            if self._readers <= 0:
+                raise RuntimeError('release_read() without acquire_read()')
+            self._readers -= 1
+            if not self._readers and self._waiting_writers:
+                self._writers_ok.notify(1)
+        finally:
+            self._mutex.release()
+
+    cpdef int acquire_write(self) except -1:
+        self._mutex.acquire(1)
+        try:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._writers_ok.wait(-1)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        finally:
+            self._mutex.release()
+        return 1
+
+    cpdef int release_write(self) except -1:
+        self._mutex.acquire(1)
+        try:
+            if not self._writer:
+                raise RuntimeError('release_write() without acquire_write()')
+            self._writer = False
+            if self._waiting_writers:
+                self._writers_ok.notify(1)
+            else:
+                self._readers_ok.notify_all()
+        finally:
+            self._mutex.release()
+
+    property readers:
+        def __get__(self):
+            return self._readers
+
+    property writer_active:
+        def __get__(self):
+            return self._writer
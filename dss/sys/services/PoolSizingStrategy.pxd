@@ -0,0 +1,28 @@
+from cpython.list cimport PyList_Size
+
+cpdef object summarize_job_timing_stats(list stats, double since)
+
+cdef class PoolSizingStrategy:
+    cdef public double wake_monitor_threshold
+
+    cpdef int calculate_adjustment(self, object pool, double now) except? -1
+
+cdef class UtilizationPoolSizingStrategy(PoolSizingStrategy):
+    cdef public double window
+    cdef public double spike_threshold
+    cdef public double grow_threshold
+    cdef public double shrink_threshold
+    cdef public int max_decrease
+
+cdef class QueueWaitPoolSizingStrategy(PoolSizingStrategy):
+    cdef public double target_wait
+    cdef public double window
+
+cdef class PIDPoolSizingStrategy(PoolSizingStrategy):
+    cdef public double target_wait
+    cdef public double window
+    cdef public double kp, ki, kd
+    cdef public double max_integral
+    cdef double _integral
+    cdef double _last_error
+    cdef double _last_time
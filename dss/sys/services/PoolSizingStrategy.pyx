@@ -0,0 +1,241 @@
+"""Strategies that decide when a ThreadPool adds or removes threads.
+
+ThreadPool's monitor thread calls its strategy's `calculate_adjustment`
+every `monitor_interval` seconds, or sooner when most threads are busy,
+and applies the relative adjustment it returns, clamped to the pool's
+min and max threads.  Set the `pool_sizing_strategy` setting to use a
+strategy other than UtilizationPoolSizingStrategy.
+
+`pool` is the ThreadPool, or a SimulatedPool from
+dss.sys.services.pool_sizing_simulator, which replays recorded job
+timing stats against a strategy.  Strategies may use its
+`current_pool_size`, `min_threads`, `max_threads`,
+`active_thread_count`, `job_queue_size`, `_last_pool_size_change`,
+`_last_pool_size_change_time`, `_delay_between_pool_decreases` and
+`_get_summary_stats_since(time)`.
+"""
+
+cpdef object summarize_job_timing_stats(list stats, double since):
+    """Summarizes the job timing stats, [(request_time, wait_time,
+    active_threads, duration), ...] as recorded by ThreadPool, of the
+    jobs requested since `since`.  Returns a tuple
+      (job_count, ave_wait_time, max_wait_time,
+       ave_active_threads, max_active_threads)
+    """
+    cdef double request_time
+    cdef double wait, sum_wait_time, max_wait_time
+    cdef int i, stats_list_len
+    cdef int active_threads, sum_active_threads, max_active_threads
+
+    stats_list_len = PyList_Size(stats)
+    if stats_list_len == 0 or stats[-1][0]< since:
+        return (0, 0,0, 0,0)
+
+    sum_wait_time = 0
+    max_wait_time = 0
+    sum_active_threads = 0
+    max_active_threads = 0
+    i = 1
+    while i <= stats_list_len:
+        (request_time, wait, active_threads, duration) = stats[-i]
+        if i==stats_list_len or request_time < since:
+            return (i, # num of jobs
+                    (sum_wait_time/i), # ave wait time
+                    max_wait_time,
+                    (sum_active_threads/i), # ave active threads
+                    max_active_threads
+                    )
+        else:
+            sum_wait_time = sum_wait_time + wait
+            sum_active_threads = sum_active_threads + active_threads
+            if wait > max_wait_time:
+                max_wait_time = wait
+            if active_threads > max_active_threads:
+               max_active_threads = active_threads
+        i = i + 1
+
+cdef class PoolSizingStrategy:
+    """Base class for pool sizing strategies.
+
+    Worker threads wake the monitor thread early, rather than leaving
+    it to its next interval, when more than `wake_monitor_threshold` of
+    the pool's threads are busy.
+    """
+    def __init__(self, double wake_monitor_threshold=.66):
+        self.wake_monitor_threshold = wake_monitor_threshold
+
+    cpdef int calculate_adjustment(self, object pool, double now) except? -1:
+        """Returns a relative pool size adjustment, positive or negative."""
+        raise NotImplementedError
+
+cdef class UtilizationPoolSizingStrategy(PoolSizingStrategy):
+    """Sizes the pool by how many of its threads are busy.
+
+    This is designed to scale threads up quickly when load spikes and
+    lower them slowly, and smoothly, as the usage average comes back
+    down.  If more than `spike_threshold` of the threads are busy the
+    pool is doubled immediately.  Otherwise it grows when the average
+    number of busy threads over the last `window` seconds is above
+    `grow_threshold` of the pool, and shrinks, by at most
+    `max_decrease` threads at a time, when it's below
+    `shrink_threshold`.
+    """
+    def __init__(self, double window=30, double spike_threshold=.8,
+                 double grow_threshold=.6, double shrink_threshold=.35,
+                 int max_decrease=20, double wake_monitor_threshold=.66):
+        PoolSizingStrategy.__init__(self, wake_monitor_threshold)
+        self.window = window
+        self.spike_threshold = spike_threshold
+        self.grow_threshold = grow_threshold
+        self.shrink_threshold = shrink_threshold
+        self.max_decrease = max_decrease
+
+    cpdef int calculate_adjustment(self, object pool, double now) except? -1:
+        cdef double window_start = now - self.window
+        cdef double stats_start_time
+        cdef double delay_between_decreases
+        cdef int current_pool_size = pool.current_pool_size
+        cdef int min_threads = pool.min_threads
+        cdef int max_threads = pool.max_threads
+        cdef int ave_active_threads
+        cdef int max_active_threads
+
+        if pool.active_thread_count > (current_pool_size * self.spike_threshold):
+            # no need for fancy stats, just double the threads pool immediately
+            return min(current_pool_size, (max_threads-current_pool_size))
+
+        if (pool._last_pool_size_change < 0
+            and pool._last_pool_size_change_time > window_start):
+            # last change was a decrease, use last change time to avoid
+            # oscillations from a moving average
+            stats_start_time = pool._last_pool_size_change_time
+        else:
+            stats_start_time = window_start
+
+        (job_count,
+         ave_wait_time,
+         max_wait_time,
+         ave_active_threads,
+         max_active_threads) = pool._get_summary_stats_since(stats_start_time)
+
+        if ((ave_active_threads >= (current_pool_size * self.grow_threshold))
+            or (max_active_threads > current_pool_size * self.spike_threshold)):
+
+            if current_pool_size >= max_threads:
+                adj = 0
+            elif max_active_threads > (current_pool_size * self.spike_threshold):
+                adj = max_active_threads*2
+            elif ave_active_threads < (max_threads/10):
+                adj = int(ave_active_threads*.05)
+            else:
+                adj = ave_active_threads
+
+            return min(adj, (max_threads-current_pool_size))
+
+        elif ave_active_threads < (current_pool_size * self.shrink_threshold):
+            delay_between_decreases = pool._delay_between_pool_decreases
+            if pool._last_pool_size_change > 0:
+                delay_between_decreases = delay_between_decreases * 3
+
+            if current_pool_size == min_threads:
+                return 0
+            elif ((now - pool._last_pool_size_change_time)
+                  < delay_between_decreases):
+                return 0
+            elif current_pool_size > min_threads:
+                if (min_threads - current_pool_size) == -1:
+                    return -1
+                else:
+                    return -min(((current_pool_size-min_threads)/2), self.max_decrease)
+            else:
+                return 0
+        else:
+            return 0
+
+cdef class QueueWaitPoolSizingStrategy(PoolSizingStrategy):
+    """Sizes the pool to keep the average time jobs wait in the queue,
+    over the last `window` seconds, below `target_wait` seconds.
+
+    The pool grows in proportion to how far the average wait is over
+    the target, at most doubling at once.  It shrinks a thread at a
+    time while the average wait is under half the target and fewer
+    than half the threads are busy, at most once every
+    `delay_between_pool_decreases` seconds.
+    """
+    def __init__(self, double target_wait=.05, double window=10,
+                 double wake_monitor_threshold=.66):
+        PoolSizingStrategy.__init__(self, wake_monitor_threshold)
+        self.target_wait = target_wait
+        self.window = window
+
+    cpdef int calculate_adjustment(self, object pool, double now) except? -1:
+        cdef int current_pool_size = pool.current_pool_size
+        cdef double overshoot
+        cdef int ave_active_threads
+
+        (job_count,
+         ave_wait_time,
+         max_wait_time,
+         ave_active_threads,
+         max_active_threads) = pool._get_summary_stats_since(now - self.window)
+
+        if ave_wait_time > self.target_wait:
+            overshoot = min(ave_wait_time / self.target_wait - 1, 1)
+            return max(1, int(current_pool_size * overshoot + .5))
+        elif (ave_wait_time < self.target_wait / 2
+              and ave_active_threads < current_pool_size / 2.
+              and current_pool_size > pool.min_threads
+              and (now - pool._last_pool_size_change_time
+                   >= pool._delay_between_pool_decreases)):
+            return -1
+        return 0
+
+cdef class PIDPoolSizingStrategy(PoolSizingStrategy):
+    """A PID controller on the average time jobs waited in the queue
+    over the last `window` seconds, with `target_wait` as its setpoint.
+
+    The error is in seconds and the gains in threads per second of
+    error, so with the default `kp` of 20 an average wait 50ms over the
+    target adds a thread each cycle.  The integral term is clamped to
+    +/-`max_integral` to limit windup while the pool is at its min or
+    max.  Gains depend on the workload, and the simulator is a good
+    way to tune them.
+    """
+    def __init__(self, double target_wait=.05, double window=5,
+                 double kp=20, double ki=5, double kd=0,
+                 double max_integral=1, double wake_monitor_threshold=.66):
+        PoolSizingStrategy.__init__(self, wake_monitor_threshold)
+        self.target_wait = target_wait
+        self.window = window
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.max_integral = max_integral
+        self._integral = 0
+        self._last_error = 0
+        self._last_time = 0
+
+    cpdef int calculate_adjustment(self, object pool, double now) except? -1:
+        cdef double error, derivative = 0, dt, output
+
+        (job_count,
+         ave_wait_time,
+         max_wait_time,
+         ave_active_threads,
+         max_active_threads) = pool._get_summary_stats_since(now - self.window)
+
+        error = ave_wait_time - self.target_wait
+        if self._last_time:
+            dt = now - self._last_time
+            if dt > 0:
+                self._integral = max(-self.max_integral,
+                                     min(self._integral + error * dt,
+                                         self.max_integral))
+                derivative = (error - self._last_error) / dt
+        self._last_error = error
+        self._last_time = now
+
+        output = self.kp * error + self.ki * self._integral + self.kd * derivative
+        if output >= 0:
+            return int(output + .5)
+        return -int(-output + .5)
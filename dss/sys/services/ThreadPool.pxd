@@ -4,6 +4,7 @@ from dss.sys.time_of_day cimport time_of_day
 from dss.sys.services.Service cimport Service
 from dss.sys.Queue cimport AbstractQueue
 from dss.sys.lock cimport Lock
+from dss.sys.services.PoolSizingStrategy cimport PoolSizingStrategy
 
 cdef class ThreadState:
     cdef public int state
@@ -19,6 +20,23 @@ cdef class AbstractThreadPoolJob:
 cdef class PyCallbackThreadJob(AbstractThreadPoolJob):
     cdef public object callback
 
+cdef class Future:
+    cdef int _state
+    cdef object _result
+    cdef object _exception
+    cdef list _waiters
+    cdef list _callbacks
+
+    cpdef bint cancel(self)
+    cpdef bint cancelled(self)
+    cpdef bint running(self)
+    cpdef bint done(self)
+    cdef int _wait(self, object timeout) except -1
+    cdef bint _set_running(self)
+    cdef int _set_result(self, object result) except -1
+    cdef int _set_exception(self, object exception) except -1
+    cdef int _finish(self) except -1
+
 cdef class ThreadPool(Service):
 
     ## pub:
@@ -27,7 +45,8 @@ cdef class ThreadPool(Service):
 
     cpdef object add_job_object(self, AbstractThreadPoolJob job)
     cpdef object add_job_objects(self, jobs)
-    #cpdef object add_high_priority_job(self, callback)
+    cpdef object add_prioritized_job(self, callback, priority)
+    cpdef object add_high_priority_job(self, callback)
 
     cdef readonly int current_pool_size
     cdef readonly int initial_threads
@@ -36,6 +55,7 @@ cdef class ThreadPool(Service):
     cdef readonly int active_thread_count
     cdef readonly long total_threads_ever_used
     cdef readonly unsigned long long job_count
+    cdef readonly PoolSizingStrategy pool_sizing_strategy
 
     ## private:
     cdef AbstractQueue _job_queue
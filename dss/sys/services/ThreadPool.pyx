@@ -6,8 +6,11 @@ from thread import get_ident
 
 # cython imports
 from dss.sys.services.Service cimport Service
-from dss.sys.Queue cimport BlockingQueue
+from dss.sys.Queue cimport BlockingQueue, PriorityBlockingQueue
 from dss.sys.lock cimport Lock
+from dss.sys.services.PoolSizingStrategy cimport (
+    PoolSizingStrategy, summarize_job_timing_stats)
+from dss.sys.services.PoolSizingStrategy import UtilizationPoolSizingStrategy
 # dss imports
 from dss.sys._internal.get_thread_description import get_thread_description
 
@@ -73,14 +76,231 @@ cdef class PyCallbackThreadJob(AbstractThreadPoolJob):
 
 cdef AbstractThreadPoolJob _EXIT_NOW = AbstractThreadPoolJob()
 
+class CancelledError(Exception):
+    "Raised by `Future.result` or `Future.exception` on a cancelled job."
+
+class TimeoutError(Exception):
+    "Raised by `Future.result` or `Future.exception` when they time out."
+
+cdef int _PENDING=0, _RUNNING=1, _FINISHED=2, _CANCELLED=3
+
+cdef class Future:
+    """The pending result of a job added with `ThreadPool.submit`, as
+    concurrent.futures.Future.
+
+    `result` and `exception` take an optional `timeout` in seconds and
+    raise `TimeoutError` if the job hasn't finished within it.  A job
+    can be cancelled until a worker thread starts it.  Callbacks added
+    with `add_done_callback` are called with the future, by the thread
+    that finishes or cancels the job, or immediately if it's already
+    done.
+    """
+    def __init__(self):
+        self._state = _PENDING
+        # these are never replaced, as a thread switch while creating a
+        # replacement could lose a waiter or callback
+        self._waiters = []
+        self._callbacks = []
+
+    cpdef bint cancel(self):
+        """Cancels the job, if it hasn't started, and returns whether
+        it's cancelled."""
+        if self._state == _PENDING:
+            self._state = _CANCELLED
+            self._finish()
+        return self._state == _CANCELLED
+
+    cpdef bint cancelled(self):
+        return self._state == _CANCELLED
+
+    cpdef bint running(self):
+        return self._state == _RUNNING
+
+    cpdef bint done(self):
+        return self._state >= _FINISHED
+
+    def result(self, timeout=None):
+        """Returns the job's return value, or raises its exception."""
+        self._wait(timeout)
+        if self._state == _CANCELLED:
+            raise CancelledError
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the job, or None."""
+        self._wait(timeout)
+        if self._state == _CANCELLED:
+            raise CancelledError
+        return self._exception
+
+    def add_done_callback(self, fn):
+        self._callbacks.append(fn)
+        if self._state >= _FINISHED:
+            # _finish may have already been and gone.  Whichever of it
+            # and this removes fn from the list calls it.
+            try:
+                self._callbacks.remove(fn)
+            except ValueError:
+                return
+            fn(self)
+
+    cdef int _wait(self, object timeout) except -1:
+        cdef Lock waiter
+        if self._state >= _FINISHED:
+            return 0
+        waiter = Lock()
+        waiter.acquire(1)
+        self._waiters.append(waiter)
+        # _finish sets the state before releasing the waiters, so if it
+        # missed this one the state shows it
+        if self._state >= _FINISHED:
+            return 0
+        if not waiter._acquire_timed(-1 if timeout is None else timeout):
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            if self._state < _FINISHED:
+                raise TimeoutError
+        return 0
+
+    cdef bint _set_running(self):
+        if self._state != _PENDING:
+            return 0
+        self._state = _RUNNING
+        return 1
+
+    cdef int _set_result(self, object result) except -1:
+        self._result = result
+        self._state = _FINISHED
+        return self._finish()
+
+    cdef int _set_exception(self, object exception) except -1:
+        self._exception = exception
+        self._state = _FINISHED
+        return self._finish()
+
+    cdef int _finish(self) except -1:
+        """Wakes the waiting threads and calls the callbacks, re-raising
+        the first exception from them once they've all been called."""
+        cdef Lock waiter
+        while 1:
+            try: # a timed out waiter may remove itself at any point
+                waiter = self._waiters.pop()
+            except IndexError:
+                break
+            waiter.release()
+        error = None
+        while 1:
+            try:
+                fn = self._callbacks.pop(0)
+            except IndexError:
+                break
+            try:
+                fn(self)
+            except Exception, e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return 0
+
+cdef class _FutureJob(AbstractThreadPoolJob):
+    """Runs `fn(*args)` and sets the result on `future`, unless it was
+    cancelled first."""
+    cdef Future future
+    cdef object fn
+    cdef tuple args
+
+    def __init__(self, Future future, fn, tuple args):
+        self.future = future
+        self.fn = fn
+        self.args = args
+
+    cpdef object run(self):
+        if not self.future._set_running():
+            return
+        try:
+            result = self.fn(*self.args)
+        except BaseException, e:
+            self.future._set_exception(e)
+            if not isinstance(e, Exception):
+                raise # SystemExit, etc. are the worker loop's business
+        else:
+            self.future._set_result(result)
+
+def _call_for_each(fn, chunk):
+    """Returns the results of `fn` for the items of `chunk` up to the
+    first one it raises an exception for, and that exception or None."""
+    results = []
+    try:
+        for item in chunk:
+            results.append(fn(item))
+    except Exception, e:
+        return results, e
+    return results, None
+
+cdef class _MapIterator:
+    """Iterates over the results of the chunks queued by
+    `ThreadPool.map`, waiting for each chunk's future in turn."""
+    cdef list _futures
+    cdef int _next_future
+    cdef list _chunk
+    cdef int _next_item
+    cdef object _error
+
+    def __init__(self, list futures):
+        self._futures = futures
+        self._next_future = 0
+        self._chunk = []
+        self._next_item = 0
+        self._error = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef Future future
+        while self._next_item >= len(self._chunk):
+            if self._error is not None:
+                error = self._error
+                self._error = None
+                raise error
+            if self._next_future >= len(self._futures):
+                raise StopIteration
+            future = self._futures[self._next_future]
+            self._futures[self._next_future] = None
+            self._next_future += 1
+            self._chunk, self._error = future.result()
+            self._next_item = 0
+        item = self._chunk[self._next_item]
+        self._next_item += 1
+        return item
+
+cdef class _JobSizer:
+    """Applies the `job_queue_sizer` setting to the job in each
+    (job, request_time) entry on the job queue."""
+    cdef object sizer
+
+    def __init__(self, sizer):
+        self.sizer = sizer
+
+    def __call__(self, entry):
+        job = entry[0]
+        if job is _EXIT_NOW:
+            return 0
+        return self.sizer(job)
+
 
 # The underscored attrs below are used for fast cython-C access by ThreadPool and
 # the properties are not used internally.  The properties are provided to allow
 # access from Python code, should it be needed.
 
 cdef class ThreadPool(Service):
-    # @@TR: split the stats collection and pool adjustment strategy
-    # out into a helper as this class does too much.
+    # @@TR: split the stats collection out into a helper as this class
+    # does too much.
 
     def __init__(self, **kws):
         Service.__init__(self, **kws)
@@ -96,7 +316,19 @@ cdef class ThreadPool(Service):
         self._worker_thread_exit_event = Event()
 
         # job queue:
-        self._job_queue = BlockingQueue(self._settings['job_queue_maxsize'])
+        job_queue_sizer = self._settings['job_queue_sizer']
+        if job_queue_sizer is not None:
+            job_queue_sizer = _JobSizer(job_queue_sizer)
+        if self._settings['prioritized_job_queue']:
+            self._job_queue = PriorityBlockingQueue(
+                self._settings['job_queue_maxsize'], 0,
+                job_queue_sizer, self._settings['job_queue_max_bytes'],
+                self._settings['collect_job_queue_stats'])
+        else:
+            self._job_queue = BlockingQueue(
+                self._settings['job_queue_maxsize'],
+                job_queue_sizer, self._settings['job_queue_max_bytes'],
+                self._settings['collect_job_queue_stats'])
         self.job_count = 0 # note, access is not synchronized!
 
         # monitoring:
@@ -105,7 +337,9 @@ cdef class ThreadPool(Service):
         self._monitor_event = Event()
 
         # pool size management
-        self._pool_management_lock = Lock()
+        self.pool_sizing_strategy = (self._settings['pool_sizing_strategy']
+                                     or UtilizationPoolSizingStrategy())
+        self._pool_management_lock = Lock('ThreadPool._pool_management_lock')
         self._delay_between_pool_decreases = self._settings['delay_between_pool_decreases']
         self._last_pool_size_change = 0
         self._last_pool_size_change_time = 0
@@ -117,11 +351,11 @@ cdef class ThreadPool(Service):
 
         # task scheduling
         self._scheduled_task_list = [] # [(nextRuntime, task)]
-        self._scheduled_task_list_lock = Lock()
+        self._scheduled_task_list_lock = Lock('ThreadPool._scheduled_task_list_lock')
         self._next_scheduled_task_time = 0
 
         # job timing stats
-        self._job_timing_stats_list_lock = Lock()
+        self._job_timing_stats_list_lock = Lock('ThreadPool._job_timing_stats_list_lock')
         self._job_timing_stats_list = []
         self._job_timing_stats_list_max_size = self._settings[
             'job_timing_stats_list_max_size']
@@ -134,6 +368,10 @@ cdef class ThreadPool(Service):
             log_channel='dss.threadpool',
             register_as_main_thread_pool=True,
             job_queue_maxsize=1024,
+            prioritized_job_queue=False, # enables add_prioritized_job
+            job_queue_sizer=None, # sizer(job) -> approx. bytes held by the job
+            job_queue_max_bytes=0, # requires job_queue_sizer
+            collect_job_queue_stats=False, # see get_job_queue_stats
 
             min_threads=3,
             initial_threads=5,
@@ -142,6 +380,8 @@ cdef class ThreadPool(Service):
 
             seconds_before_considered_stuck=10,
 
+            pool_sizing_strategy=None, # a PoolSizingStrategy, see that module
+
             delay_between_pool_decreases=3, #seconds
             recent_pool_size_changes_list_max_size=500,
             recent_pool_size_changes_list_cull_size=200,
@@ -205,9 +445,58 @@ cdef class ThreadPool(Service):
         cdef double t = time_of_day()
         self._job_queue.putmany([(job, t) for job in jobs])
 
-    #cpdef object add_high_priority_job(self, callback):
-    #    self._job_queue.putleft(
-    #          (PyCallbackThreadJob(callback), time_of_day()), 0)   # respectmaxsize=0
+    cpdef object add_prioritized_job(self, callback, priority):
+        """Adds a job that runs before any queued job with a higher
+        `priority` number.  Jobs with the default priority, 0, are
+        added by `add_job`.  Requires the `prioritized_job_queue`
+        setting."""
+        if not isinstance(self._job_queue, PriorityBlockingQueue):
+            raise TypeError('add_prioritized_job requires the prioritized_job_queue setting')
+        (<PriorityBlockingQueue>self._job_queue).put_prioritized(
+            (PyCallbackThreadJob(callback), time_of_day()), priority)
+
+    cpdef object add_high_priority_job(self, callback):
+        """Adds a job ahead of all queued jobs, even if the queue is
+        full."""
+        self._job_queue.putleft(
+              (PyCallbackThreadJob(callback), time_of_day()), 0)   # respectmaxsize=0
+
+    def submit(self, fn, *args):
+        """Adds a job that calls `fn(*args)`, returning a Future for its
+        result."""
+        cdef Future future = Future()
+        self._job_queue.put((_FutureJob(future, fn, args), time_of_day()))
+        return future
+
+    def map(self, fn, iterable, int chunksize=1):
+        """Calls `fn` on each item of `iterable` in the pool, returning
+        an iterator over the results in order.  The iterator raises the
+        first exception from `fn` when it reaches that item.
+
+        The items are run in jobs of `chunksize` items each, which are
+        all queued in one operation.  Larger chunks cut the queueing
+        overhead for cheap `fn`s, at the expense of parallelism.  A job
+        stops at the first item `fn` raises an exception for, so the
+        rest of that chunk isn't run, but the results before it are
+        still returned.
+        """
+        cdef int i, num_items
+        cdef double t = time_of_day()
+        cdef Future future
+        if chunksize < 1:
+            raise ValueError('chunksize must be >= 1')
+        items = list(iterable)
+        num_items = len(items)
+        futures = []
+        jobs = []
+        for i from 0 <= i < num_items by chunksize:
+            future = Future()
+            futures.append(future)
+            jobs.append((_FutureJob(future, _call_for_each,
+                                    (fn, items[i:i+chunksize])), t))
+        if jobs:
+            self._job_queue.putmany(jobs)
+        return _MapIterator(futures)
 
     def schedule_task(self, task, when):
         self._scheduled_task_list_lock.acquire()
@@ -272,8 +561,9 @@ cdef class ThreadPool(Service):
 
                 if (not self._monitor_thread_active
                     and self.current_pool_size < self.max_threads
-                    and self.active_thread_count > self.current_pool_size*0.66):
-                    # @@TR: the .66 threshold above should be soft-coded
+                    and self.active_thread_count > (
+                        self.current_pool_size
+                        * self.pool_sizing_strategy.wake_monitor_threshold)):
                     self._monitor_event.set()
 
                 start_time = time_of_day()
@@ -340,7 +630,8 @@ cdef class ThreadPool(Service):
                     # for when minthreads and sudden surge:
                     or (self.current_pool_size < self.max_threads
                         and self.active_thread_count >
-                        (self.current_pool_size*0.66))
+                        (self.current_pool_size
+                         * self.pool_sizing_strategy.wake_monitor_threshold))
                     ):
 
                     self._adjust_pool_size()
@@ -445,131 +736,34 @@ cdef class ThreadPool(Service):
             self._pool_management_lock.release()
 
     cdef signed int _calculate_pool_size_adjustment(self) except? -1:
-        """Returns a relative pool size adjustment, positive or negative.
-
-        This is designed to scale threads up quickly when load spikes and lower
-        them slowly, and smoothly, as the usage average comes back
-        down.
+        """Returns a relative pool size adjustment, positive or negative,
+        as calculated by the `pool_sizing_strategy` and clamped to the
+        pool's min and max threads."""
+        cdef signed int adjustment
 
-        # @@TR: I will eventually factor this out into a separate
-        # `strategy` object that allows different strategies to be
-        # experimented with, etc.
-        """
-        cdef double _30secs_ago = (time_of_day() - 30)
-        cdef double stats_start_time
-        cdef double ave_wait_time
-        cdef double max_wait_time
-        cdef int ave_active_threads
-        cdef int max_active_threads
-        cdef int delay_between_decreases
-        # @@TR: there are some hardcoded factors below that should be soft-coded
-
-        if self.active_thread_count > (self.current_pool_size * 0.8):
-            # no need for fancy stats, just double the threads pool immediately
-            return min(self.current_pool_size,
-                       (self.max_threads-self.current_pool_size))
-
-        elif self.current_pool_size < self.min_threads:
+        if self.current_pool_size < self.min_threads:
             # should be able to get here!
             self._log_channel.warn(
                 'Thread pool dropped below min allowed pool size. Increasing')
             return self.min_threads-self.current_pool_size
 
-        if (self._last_pool_size_change < 0
-            and self._last_pool_size_change_time > _30secs_ago):
-            # last change was a decrease, use last change time to avoid
-            # oscillations from a moving average
-            stats_start_time = self._last_pool_size_change_time
-        else:
-            stats_start_time = _30secs_ago
-
-        (job_count,
-         ave_wait_time,
-         max_wait_time,
-         ave_active_threads,
-         max_active_threads) = self._get_summary_stats_since(stats_start_time)
-
+        adjustment = self.pool_sizing_strategy.calculate_adjustment(self, time_of_day())
+        adjustment = min(adjustment, self.max_threads-self.current_pool_size)
+        adjustment = max(adjustment, self.min_threads-self.current_pool_size)
         if self._verbose:
             self._log_channel.debug(
-              ('stats last 30 seconds: '
-               'jobs=%i, ave_active_threads=%i, '
-               'max_active_threads=%i, current queue size=%i')%(
-              job_count, ave_active_threads, max_active_threads, len(self._job_queue)))
-
-        if ((ave_active_threads >= (self.current_pool_size * 0.6))
-            or (max_active_threads > self.current_pool_size * 0.8)):
-
-            if self.current_pool_size >= self.max_threads:
-                adj = 0
-            elif max_active_threads > (self.current_pool_size * 0.8):
-                adj = max_active_threads*2
-            elif ave_active_threads < (self.max_threads/10):
-                adj = int(ave_active_threads*.05)
-            else:
-                adj = ave_active_threads
-
-            return min(adj, (self.max_threads-self.current_pool_size))
-
-        elif ave_active_threads < (self.current_pool_size * 0.35):
-            delay_between_decreases = self._delay_between_pool_decreases
-            if self._last_pool_size_change > 0:
-                delay_between_decreases = delay_between_decreases * 3
-
-            if self.current_pool_size == self.min_threads:
-                return 0
-            elif ((time_of_day() - self._last_pool_size_change_time)
-                  < delay_between_decreases):
-                return 0
-            elif self.current_pool_size > self.min_threads:
-                if (self.min_threads - self.current_pool_size) == -1:
-                    return -1
-                else:
-                    adj = -min(((self.current_pool_size-self.min_threads)/2), 20)
-                    return adj
-            else:
-                return 0
-        else:
-            return 0
+                '%r: adjustment=%i, current queue size=%i'%(
+                self.pool_sizing_strategy, adjustment, len(self._job_queue)))
+        return adjustment
 
     cpdef object _get_summary_stats_since(self, double time):
         """Returns a tuple
            (job_count, ave_wait_time, max_wait_time,
             ave_active_threads, max_active_threads)
         """
-        cdef double request_time
-        cdef double wait, sum_wait_time, max_wait_time
-        cdef int i, stats_list_len
-        cdef int active_threads, sum_active_threads, max_active_threads
-
         self._job_timing_stats_list_lock.acquire()
         try:
-            stats = self._job_timing_stats_list
-            stats_list_len = PyList_Size(stats)
-            if stats_list_len == 0 or stats[-1][0]< time:
-                return (0, 0,0, 0,0)
-
-            sum_wait_time = 0
-            max_wait_time = 0
-            sum_active_threads = 0
-            max_active_threads = 0
-            i = 1
-            while i <= stats_list_len:
-                (request_time, wait, active_threads, duration) = stats[-i]
-                if i==stats_list_len or request_time < time:
-                    return (i, # num of jobs
-                            (sum_wait_time/i), # ave wait time
-                            max_wait_time,
-                            (sum_active_threads/i), # ave active threads
-                            max_active_threads
-                            )
-                else:
-                    sum_wait_time = sum_wait_time + wait
-                    sum_active_threads = sum_active_threads + active_threads
-                    if wait > max_wait_time:
-                        max_wait_time = wait
-                    if active_threads > max_active_threads:
-                       max_active_threads = active_threads
-                i = i + 1
+            return summarize_job_timing_stats(self._job_timing_stats_list, time)
         finally:
             self._job_timing_stats_list_lock.release()
 
@@ -601,6 +795,14 @@ cdef class ThreadPool(Service):
         """
         return self._get_job_timing_stats_since((time_of_day() - seconds))
 
+    def get_job_queue_stats(self):
+        """Returns the job queue's stats (see `BlockingQueue.stats`),
+        which are only collected with the `collect_job_queue_stats`
+        setting on.  Long `producer_waits` mean jobs are being added
+        faster than the pool can run them and long `consumer_waits`
+        mean the workers are idle, waiting for jobs."""
+        return (<BlockingQueue>self._job_queue).stats()
+
     cdef int _add_threads(self, signed int num) except -1:
         cdef ThreadState state
         if not self._running:
@@ -709,6 +911,16 @@ cdef class ThreadPool(Service):
                 matches.append(t)
         return matches
 
+    property job_queue_size:
+        def __get__(self):
+            return len(self._job_queue)
+
+    property job_queue_bytes:
+        """The total size of the queued jobs, as measured by the
+        `job_queue_sizer` setting (0 without one)."""
+        def __get__(self):
+            return (<BlockingQueue>self._job_queue).queued_bytes
+
     property used_threads:
         def __get__(self):
             return self._get_used_threads()
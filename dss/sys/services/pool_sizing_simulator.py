@@ -0,0 +1,152 @@
+"""Replays recorded ThreadPool job timing stats against pool sizing
+strategies, to compare them, or tune one, without a live load.
+
+Record stats from a running pool with
+`cPickle.dump(pool.get_job_timing_stats(seconds), f)` and then run
+
+    python -m dss.sys.services.pool_sizing_simulator stats.pickle
+
+The jobs are replayed with their original request times and durations
+through a simulated pool that the strategy resizes every
+`monitor_interval` seconds, as ThreadPool's monitor thread would.  The
+waits the jobs would have seen with that strategy are reported with
+the pool sizes it chose.  A simulated decrease takes effect as busy
+threads finish their jobs.
+"""
+import sys
+import cPickle
+from collections import deque
+from heapq import heappush, heappop
+
+from dss.sys.services.PoolSizingStrategy import (
+    summarize_job_timing_stats,
+    UtilizationPoolSizingStrategy,
+    QueueWaitPoolSizingStrategy,
+    PIDPoolSizingStrategy)
+
+class SimulatedPool(object):
+    """Provides the subset of ThreadPool's interface that
+    PoolSizingStrategies use, for the simulation."""
+
+    def __init__(self, strategy, min_threads=3, initial_threads=5, max_threads=80,
+                 delay_between_pool_decreases=3, monitor_interval=1):
+        self.strategy = strategy
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.current_pool_size = initial_threads
+        self._delay_between_pool_decreases = delay_between_pool_decreases
+        self.monitor_interval = monitor_interval
+        self._last_pool_size_change = 0
+        self._last_pool_size_change_time = 0
+        self._job_timing_stats_list = []
+        self._queue = deque()
+        self._busy = [] # heap of (end_time, request_time, wait, active_threads, duration)
+        self.pool_size_changes = []
+
+    @property
+    def active_thread_count(self):
+        return len(self._busy)
+
+    @property
+    def job_queue_size(self):
+        return len(self._queue)
+
+    def _get_summary_stats_since(self, time):
+        return summarize_job_timing_stats(self._job_timing_stats_list, time)
+
+    def _adjust_pool_size(self, now):
+        adjustment = self.strategy.calculate_adjustment(self, now)
+        adjustment = min(adjustment, self.max_threads-self.current_pool_size)
+        adjustment = max(adjustment, self.min_threads-self.current_pool_size)
+        if adjustment:
+            self.current_pool_size += adjustment
+            self._last_pool_size_change = adjustment
+            self._last_pool_size_change_time = now
+            self.pool_size_changes.append((now, adjustment))
+
+    def _start_jobs(self, now):
+        while self._queue and len(self._busy) < self.current_pool_size:
+            request_time, duration = self._queue.popleft()
+            heappush(self._busy, (now + duration, request_time, now - request_time,
+                                  len(self._busy)+1, duration))
+
+    def run(self, job_timing_stats):
+        """Replays `job_timing_stats`, in the format returned by
+        `ThreadPool.get_job_timing_stats`, and returns a summary dict."""
+        jobs = sorted((request_time, duration)
+                      for request_time, wait, active, duration in job_timing_stats)
+        if not jobs:
+            raise ValueError('no jobs to replay')
+        infinity = float('inf')
+        now = start_time = jobs[0][0]
+        next_tick = start_time + self.monitor_interval
+        thread_seconds = 0
+        max_pool_size = self.current_pool_size
+        waits = []
+        i = 0
+        while i < len(jobs) or self._queue or self._busy:
+            next_arrival = jobs[i][0] if i < len(jobs) else infinity
+            next_completion = self._busy[0][0] if self._busy else infinity
+            next_event = min(next_arrival, next_completion, next_tick)
+            thread_seconds += (next_event - now) * self.current_pool_size
+            now = next_event
+
+            if now == next_completion:
+                end_time, request_time, wait, active_threads, duration = heappop(self._busy)
+                self._job_timing_stats_list.append(
+                    (request_time, wait, active_threads, duration))
+                waits.append(wait)
+            elif now == next_arrival:
+                self._queue.append(jobs[i])
+                i += 1
+            else:
+                self._adjust_pool_size(now)
+                max_pool_size = max(max_pool_size, self.current_pool_size)
+                next_tick += self.monitor_interval
+            self._start_jobs(now)
+
+        waits.sort()
+        elapsed = (now - start_time) or 1
+        return dict(strategy=self.strategy,
+                    jobs=len(waits),
+                    ave_wait=sum(waits)/len(waits),
+                    p99_wait=waits[min(int(len(waits)*.99), len(waits)-1)],
+                    max_wait=waits[-1],
+                    ave_pool_size=thread_seconds/elapsed,
+                    max_pool_size=max_pool_size,
+                    pool_size_changes=len(self.pool_size_changes))
+
+def compare_strategies(job_timing_stats, strategies=None, **pool_settings):
+    """Runs a SimulatedPool per strategy, returning their summaries."""
+    if strategies is None:
+        strategies = [UtilizationPoolSizingStrategy(),
+                      QueueWaitPoolSizingStrategy(),
+                      PIDPoolSizingStrategy()]
+    return [SimulatedPool(strategy, **pool_settings).run(job_timing_stats)
+            for strategy in strategies]
+
+def format_summary(summary):
+    return ('%-32s: ave_wait=%0.4fs p99_wait=%0.4fs max_wait=%0.4fs '
+            'ave_pool_size=%0.1f max_pool_size=%i changes=%i')%(
+        summary['strategy'].__class__.__name__,
+        summary['ave_wait'], summary['p99_wait'], summary['max_wait'],
+        summary['ave_pool_size'], summary['max_pool_size'],
+        summary['pool_size_changes'])
+
+def main(argv=None):
+    argv = argv or sys.argv
+    if len(argv) != 2:
+        print >> sys.stderr, 'usage: %s job_timing_stats.pickle'%argv[0]
+        return 1
+    f = open(argv[1], 'rb')
+    try:
+        job_timing_stats = cPickle.load(f)
+    finally:
+        f.close()
+    print '%i jobs'%len(job_timing_stats)
+    for summary in compare_strategies(job_timing_stats):
+        print format_summary(summary)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,8 @@ from __future__ import with_statement
 # pylint: disable-msg=W0613,W0212
 #import socket
 #import select
-from threading import Event
+from time import sleep
+from threading import Event, Thread, currentThread
 from nose.tools import raises
 
 from dss.pubsub.MessageBus import MessageBus
@@ -27,6 +28,7 @@ from dss.net.event_flags import (
 
 from dss.net.IOEventHandler import AbstractIOEventHandler
 from dss.sys._internal.PollableEvent import PollableEvent
+from dss.sys.PollableQueue import PollableQueue
 
 from dss.log.Subscribers import Formatter
 from dss.log.LogChannel import LogChannel
@@ -178,6 +180,35 @@ def test_with_abstract_handler():
         handler._register_fd_with_reactor(fd=fd, reactor=reactor)
     reactor._cull_any_bad_descriptors()
 
+def test_register_queue():
+    reactor = IOEventReactor(log_channel=None)
+    queue = PollableQueue()
+    received = []
+    drain_threads = set()
+    def callback(items):
+        assert len(items) <= 10
+        drain_threads.add(currentThread())
+        received.extend(items)
+    reactor.register_queue(queue, callback, maxitems=10)
+    reactor.start()
+    try:
+        def produce():
+            for i in xrange(100):
+                queue.put(i)
+            queue.putmany(range(100, 150))
+        producer = Thread(target=produce)
+        producer.start()
+        producer.join(5)
+        for _i in xrange(500):
+            if len(received) == 150:
+                break
+            sleep(.01)
+        assert received == range(150), received
+        assert drain_threads == set([reactor._event_loop_thread]), drain_threads
+        assert queue.is_empty
+    finally:
+        reactor.stop()
+
 ################################################################################
 
 #class SyncEvHandler(AbstractIOEventHandler):
@@ -0,0 +1,186 @@
+import random
+import sys
+from threading import Thread
+from time import time
+
+from dss.sys.Queue import BlockingQueue, SPSCQueue
+from dss.sys.LRUCache import (
+    LRUCache, ShardedLRUCache, SegmentedLRUCache, TinyLFUCache, ClockLRUCache)
+
+def format_result(title, t, ops, comparison_time=None):
+    return ' '.join(
+        ('%-20s:'%title,
+         '%0.3f usec/op'%((t/ops)*1e6),
+         ('%0.2fx faster'%(comparison_time/t) if comparison_time else '')
+         ))
+
+################################################################################
+def _run_cache_workers(cache, num_threads, iterations, num_keys):
+    def worker(seed):
+        get = cache.get
+        for i in xrange(iterations):
+            key = (i*7 + seed) % num_keys
+            if get(key, None) is None:
+                cache[key] = i
+    threads = [Thread(target=worker, args=(n,)) for n in range(num_threads)]
+    start = time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time()-start
+
+def bench_cache_contention(num_threads=80, iterations=20000, num_keys=5000, maxsize=4096):
+    print '-'*80
+    print 'cache contention: %i threads, %i ops each'%(num_threads, iterations)
+    ops = num_threads*iterations
+    single = _run_cache_workers(LRUCache(maxsize), num_threads, iterations, num_keys)
+    print format_result('LRUCache', single, ops)
+    for num_shards in (4, 16, 64):
+        sharded = _run_cache_workers(
+            ShardedLRUCache(maxsize, num_shards=num_shards),
+            num_threads, iterations, num_keys)
+        print format_result('Sharded (%i)'%num_shards, sharded, ops, single)
+
+def _run_read_heavy_workers(cache, num_threads, iterations, num_keys, reads_per_write):
+    for key in xrange(num_keys):
+        cache[key] = key
+    def worker(seed):
+        get = cache.get
+        for i in xrange(iterations):
+            key = (i*7 + seed) % num_keys
+            if i % reads_per_write:
+                get(key, None)
+            else:
+                cache[key] = i
+    threads = [Thread(target=worker, args=(n,)) for n in range(num_threads)]
+    start = time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time()-start
+
+def bench_read_heavy(num_threads=16, iterations=50000, num_keys=4000, maxsize=4096,
+                     reads_per_write=50):
+    print '-'*80
+    print 'read-heavy: %i threads, %i ops each, %i reads per write'%(
+        num_threads, iterations, reads_per_write)
+    ops = num_threads*iterations
+    lru = _run_read_heavy_workers(
+        LRUCache(maxsize), num_threads, iterations, num_keys, reads_per_write)
+    print format_result('LRUCache', lru, ops)
+    clock = _run_read_heavy_workers(
+        ClockLRUCache(maxsize), num_threads, iterations, num_keys, reads_per_write)
+    print format_result('ClockLRUCache', clock, ops, lru)
+
+################################################################################
+def make_scan_trace(length=200000, num_hot_keys=2000, scan_length=20000,
+                    scan_every=50000, seed=0):
+    """Returns a list of keys: mostly skewed accesses to a hot set,
+    interrupted periodically by a scan through one-off keys."""
+    rand = random.Random(seed)
+    trace = []
+    scan_id = 0
+    while len(trace) < length:
+        if trace and not (len(trace) % scan_every):
+            scan_id += 1
+            trace.extend([('scan', scan_id, i) for i in xrange(scan_length)])
+        # squaring a uniform variate skews accesses towards the low keys
+        trace.append(int(num_hot_keys * rand.random()**2))
+    return trace
+
+def load_trace(path):
+    "Loads a trace file with one key per line"
+    return [ln.strip() for ln in open(path) if ln.strip()]
+
+def replay_trace(cache, trace):
+    hits = 0
+    get = cache.get
+    start = time()
+    for key in trace:
+        if get(key, None) is None:
+            cache[key] = 1
+        else:
+            hits += 1
+    return hits, time()-start
+
+def bench_cache_policies(trace=None, maxsize=1000):
+    if trace is None:
+        trace = make_scan_trace()
+    print '-'*80
+    print 'cache policies: %i accesses, maxsize=%i'%(len(trace), maxsize)
+    for cls in (LRUCache, ClockLRUCache, SegmentedLRUCache, TinyLFUCache):
+        hits, duration = replay_trace(cls(maxsize), trace)
+        print '%-20s: hit ratio %5.1f%%  %0.3f usec/op'%(
+            cls.__name__, (100.0*hits/len(trace)), (duration/len(trace))*1e6)
+
+################################################################################
+def _run_queue_pipeline(queue, iterations, batch_size):
+    def consume():
+        remaining = iterations
+        if batch_size > 1:
+            getmany = queue.getmany
+            while remaining:
+                remaining -= len(getmany(batch_size))
+        else:
+            get = queue.get
+            while remaining:
+                get()
+                remaining -= 1
+    consumer = Thread(target=consume)
+    put = queue.put
+    start = time()
+    consumer.start()
+    for i in xrange(iterations):
+        put(i)
+    consumer.join()
+    return time()-start
+
+def bench_queue_throughput(iterations=500000, maxsize=1024):
+    print '-'*80
+    print 'queue throughput: 1 producer, 1 consumer, %i items, maxsize=%i'%(
+        iterations, maxsize)
+    for batch_size in (1, 64):
+        blocking = _run_queue_pipeline(BlockingQueue(maxsize), iterations, batch_size)
+        print format_result('BlockingQueue (%i)'%batch_size, blocking, iterations)
+        spsc = _run_queue_pipeline(SPSCQueue(maxsize), iterations, batch_size)
+        print format_result('SPSCQueue (%i)'%batch_size, spsc, iterations, blocking)
+
+def _run_queue_ping_pong(lock_spin, round_trips):
+    ping = BlockingQueue(lock_spin=lock_spin)
+    pong = BlockingQueue(lock_spin=lock_spin)
+    def echo():
+        get, put = ping.get, pong.put
+        for i in xrange(round_trips):
+            put(get())
+    echoer = Thread(target=echo)
+    echoer.start()
+    get, put = pong.get, ping.put
+    start = time()
+    for i in xrange(round_trips):
+        put(i)
+        get()
+    t = time()-start
+    echoer.join()
+    return t
+
+def bench_queue_ping_pong(round_trips=50000):
+    print '-'*80
+    print 'queue ping-pong latency: 2 threads, %i round trips'%round_trips
+    no_spin = _run_queue_ping_pong(0, round_trips)
+    print format_result('no spin', no_spin, round_trips)
+    for lock_spin in (100, 1000, 10000):
+        print format_result('lock_spin=%i'%lock_spin,
+                            _run_queue_ping_pong(lock_spin, round_trips),
+                            round_trips, no_spin)
+
+if __name__ == '__main__':
+    bench_cache_contention()
+    bench_read_heavy()
+    bench_queue_throughput()
+    bench_queue_ping_pong()
+    if len(sys.argv) > 1:
+        bench_cache_policies(load_trace(sys.argv[1]))
+    else:
+        bench_cache_policies()
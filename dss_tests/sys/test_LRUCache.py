@@ -1,4 +1,11 @@
-from dss.sys.LRUCache import LRUCache
+import os
+import tempfile
+from threading import Thread
+from time import sleep
+
+from dss.sys.LRUCache import (
+    LRUCache, ShardedLRUCache, SegmentedLRUCache, TinyLFUCache, ClockLRUCache,
+    CompactLRUCache, ExpirySweepTask, memoize, EVICTED, EXPIRED, DELETED, REPLACED, CLEARED)
 
 # @@TR: these tests need better names, some concurrency checks, etc.
 
@@ -91,3 +98,658 @@ def test3():
         else:
             ok(c[i], i)
             ok(len(c), i)
+
+def test_sharded_maxsize_is_global():
+    c = ShardedLRUCache(100, num_shards=8, use_bulk_purge=False)
+    ok(c.num_shards, 8)
+    ok(sum([s._maxsize for s in c.shards]), 100)
+    for i in xrange(1000):
+        c[i] = i
+        assert len(c) <= 100
+        ok(c[i], i)
+    assert 90 < len(c) <= 100
+    ok(len(c.keys()), len(c))
+
+    small = ShardedLRUCache(3, num_shards=8)
+    ok(small.num_shards, 3)
+
+def test_sharded_dict_interface():
+    c = ShardedLRUCache(64, num_shards=4)
+    c['a'] = 1
+    ok(c['a'], 1)
+    ok(c.get('a'), 1)
+    ok(c.get('b', None), None)
+    ok('a' in c, True)
+    ok(c.has_key('b'), False)
+    del c['a']
+    ok('a' in c, False)
+    try:
+        c['a']
+    except KeyError:
+        pass
+    else:
+        raise Exception("expected exception not found")
+    c['b'] = 2
+    c.clear()
+    ok(len(c), 0)
+
+def test_sharded_multiple_threads(num_threads=20, iterations=500):
+    c = ShardedLRUCache(256, num_shards=8)
+    errors = []
+    def run(offset):
+        try:
+            for i in xrange(iterations):
+                key = (offset, i % 50)
+                c[key] = i
+                val = c.get(key, None)
+                assert val is None or val <= i, val
+        except Exception, e:
+            errors.append(e)
+    threads = [Thread(target=run, args=(n,)) for n in range(num_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    ok(errors, [])
+    assert len(c) <= 256
+
+def test_ttl():
+    c = LRUCache(10, ttl=.05)
+    c['a'] = 1
+    c.set('b', 2, ttl=0)     # never expires
+    c.set('c', 3, ttl=10)
+    ok(c['a'], 1)
+    ok('a' in c, True)
+    sleep(.06)
+    ok('a' in c, False)
+    ok(c.get('a', None), None)
+    ok(len(c), 2)           # removed lazily on read
+    ok(c['b'], 2)
+    ok(c['c'], 3)
+
+    # updating an entry restarts its ttl
+    c['d'] = 4
+    sleep(.03)
+    c['d'] = 5
+    sleep(.03)
+    ok(c['d'], 5)
+
+def test_sweep_expired():
+    c = LRUCache(100, ttl=.02)
+    for i in xrange(50):
+        c[i] = i
+    c.set('keep', 1, ttl=0)
+    sleep(.03)
+    removed = 0
+    for i in xrange(6):
+        removed += c.sweep_expired(10)
+    ok(removed, 50)
+    ok(list(c.keys()), ['keep'])
+    ok(c.sweep_expired(10), 0)
+
+def test_sharded_ttl():
+    c = ShardedLRUCache(64, num_shards=4, ttl=.02)
+    for i in xrange(20):
+        c[i] = i
+    c.set('keep', 1, ttl=0)
+    sleep(.03)
+    ok(c.sweep_expired(100), 20)
+    ok(len(c), 1)
+
+class DummyThreadPool(object):
+    def __init__(self):
+        self.tasks = []
+        self.jobs = []
+    def schedule_task(self, task, when):
+        self.tasks.append((when, task))
+    def add_job(self, job):
+        self.jobs.append(job)
+
+def test_expiry_sweep_task():
+    pool = DummyThreadPool()
+    c = LRUCache(10, ttl=.01)
+    task = c.schedule_expiry_sweeps(pool, interval=1, max_nodes=5)
+    assert isinstance(task, ExpirySweepTask)
+    ok(len(pool.tasks), 1)
+    c['a'] = 1
+    sleep(.02)
+    pool.tasks.pop()[1]()
+    ok(len(c), 0)
+    ok(len(pool.tasks), 1) # rescheduled itself
+    task.cancel()
+    pool.tasks.pop()[1]()
+    ok(len(pool.tasks), 0)
+
+def test_weight():
+    c = LRUCache(100, use_bulk_purge=False,
+                 weigher=lambda k, v: len(v), max_weight=10)
+    ok(c.max_weight, 10)
+    c['a'] = 'aaaa'
+    c['b'] = 'bbbb'
+    ok(c.weight, 8)
+    c['c'] = 'cc'
+    ok(c.weight, 10)
+    ok(len(c), 3)
+    c['a'] # now b is the oldest
+    c['d'] = 'ddd'
+    ok('b' in c, False)
+    ok(c.weight, 9)
+
+    c['a'] = 'a' # replacing an entry replaces its weight
+    ok(c.weight, 6)
+    del c['a']
+    ok(c.weight, 5)
+
+    c['big'] = 'x'*11 # heavier than max_weight on its own
+    ok('big' in c, False)
+    assert c.weight <= 10
+    c.clear()
+    ok(c.weight, 0)
+
+def test_weight_bulk_purge():
+    c = LRUCache(100, proportion_remaining_after_purge=.5,
+                 weigher=lambda k, v: v, max_weight=100)
+    for i in xrange(10):
+        c[i] = 10
+    ok(c.weight, 100)
+    c[10] = 10
+    ok(c.weight, 50)
+    ok(sorted(c.keys()), list(range(6, 11)))
+
+def test_oversized_entry():
+    removed = []
+    c = LRUCache(100, weigher=lambda k, v: v, max_weight=100,
+                 removal_listener=lambda k, v, cause: removed.append((k, v, cause)))
+    for i in xrange(9):
+        c[i] = 10
+    c['old'] = 5
+    c['old'] = 150
+    ok(len(c), 9) # the other entries survive
+    ok(c.weight, 90)
+    ok('old' in c, False)
+    ok(removed, [('old', 5, REPLACED), ('old', 150, EVICTED)])
+
+def test_sharded_weight():
+    c = ShardedLRUCache(1000, num_shards=4,
+                        weigher=lambda k, v: v, max_weight=100)
+    for i in xrange(100):
+        c[i] = 5
+    assert c.weight <= 100
+    ok(c.weight, 5*len(c))
+
+    c = ShardedLRUCache(1000, num_shards=16, use_bulk_purge=False,
+                        weigher=lambda k, v: v, max_weight=10)
+    ok(c.num_shards, 10)
+    for i in xrange(100):
+        c[i] = 1
+    ok(c.weight, 10)
+
+def test_get_or_compute():
+    c = LRUCache(10)
+    calls = []
+    def factory(key):
+        calls.append(key)
+        return key*2
+    ok(c.get_or_compute(2, factory), 4)
+    ok(c.get_or_compute(2, factory), 4)
+    ok(calls, [2])
+    ok(c[2], 4)
+
+    def failing_factory(key):
+        raise ValueError(key)
+    try:
+        c.get_or_compute(3, failing_factory)
+    except ValueError:
+        pass
+    else:
+        raise Exception("expected exception not found")
+    ok(3 in c, False)
+    ok(c.get_or_compute(3, factory), 6)
+
+def _run_concurrent_get_or_compute(factory, num_threads=20):
+    c = LRUCache(10)
+    results = []
+    def run():
+        try:
+            results.append(c.get_or_compute('key', factory))
+        except Exception, e:
+            results.append(e)
+    threads = [Thread(target=run) for _i in range(num_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return c, results
+
+def test_get_or_compute_single_flight():
+    calls = []
+    def slow_factory(key):
+        calls.append(key)
+        sleep(.05)
+        return 'value'
+    c, results = _run_concurrent_get_or_compute(slow_factory)
+    ok(calls, ['key'])
+    ok(results, ['value']*20)
+
+    def failing_factory(key):
+        calls.append(key)
+        sleep(.05)
+        raise ValueError(key)
+    del calls[:]
+    c, results = _run_concurrent_get_or_compute(failing_factory)
+    ok(calls, ['key'])
+    ok(len(results), 20)
+    for e in results:
+        assert isinstance(e, ValueError), e
+    ok('key' in c, False)
+
+def _check_basic_dict_interface(c):
+    c['a'] = 1
+    c['b'] = 2
+    ok(c['a'], 1)
+    ok(c['a'], 1)
+    ok(c.get('b'), 2)
+    ok('a' in c, True)
+    del c['a']
+    ok('a' in c, False)
+    ok(len(c), 1)
+    c.clear()
+    ok(len(c), 0)
+    c['c'] = 3
+    ok(c['c'], 3)
+
+def test_policies_dict_interface():
+    for cls in (SegmentedLRUCache, TinyLFUCache, ClockLRUCache):
+        _check_basic_dict_interface(cls(10))
+
+def test_segmented_scan_resistance():
+    c = SegmentedLRUCache(10, use_bulk_purge=False, protected_proportion=.5)
+    for i in xrange(5):
+        c[i] = i
+        c[i] # promoted to the protected segment
+    ok(c.protected_size, 5)
+    for i in xrange(100, 200): # a scan of one-off keys
+        c[i] = i
+    for i in xrange(5):
+        ok(c[i], i)
+    ok(len(c), 10)
+
+    # the protected segment is bounded, its oldest entries get demoted
+    for i in xrange(5, 8):
+        c[i] = i
+        c[i]
+    ok(c.protected_size, 5)
+    ok(len(c), 10)
+
+def test_segmented_ttl_sweep():
+    c = SegmentedLRUCache(10, ttl=.02)
+    for i in xrange(6):
+        c[i] = i
+        if i % 2:
+            c[i]
+    sleep(.03)
+    ok(c.sweep_expired(100), 6)
+    ok(len(c), 0)
+    ok(c.protected_size, 0)
+
+def test_clock_second_chance():
+    c = ClockLRUCache(3, use_bulk_purge=False)
+    c['a'] = 1
+    c['b'] = 2
+    c['c'] = 3
+    ok(c['a'], 1) # referenced, so it survives the next eviction
+    c['d'] = 4
+    ok(sorted(c.keys()), ['a', 'c', 'd'])
+    c['e'] = 5
+    ok(sorted(c.keys()), ['a', 'd', 'e'])
+    c['f'] = 6
+    ok(sorted(c.keys()), ['a', 'e', 'f'])
+    c['g'] = 7 # a's bit was cleared when it got its second chance
+    ok(sorted(c.keys()), ['e', 'f', 'g'])
+
+    c = ClockLRUCache(10, ttl=.01)
+    c['a'] = 1
+    sleep(.02)
+    ok(c.get('a', None), None)
+    ok(len(c), 0)
+
+def test_tinylfu_admission():
+    c = TinyLFUCache(10, use_bulk_purge=False)
+    for i in xrange(10):
+        c.get(i, None)
+        c[i] = i
+        for _j in xrange(3):
+            c[i]
+    assert c.frequency(0) >= 3
+    for i in xrange(100, 200): # one-off keys are not admitted
+        c.get(i, None)
+        c[i] = i
+    for i in xrange(10):
+        ok(c[i], i)
+    ok(len(c), 10)
+
+    # but popular new keys are
+    for _j in xrange(10):
+        c.get('new', None)
+    c['new'] = 1
+    ok(c['new'], 1)
+    ok(len(c), 10)
+
+def test_stats():
+    c = LRUCache(4, use_bulk_purge=False)
+    c['a'] = 1
+    c['a']
+    ok(c.stats()['hits'], 0) # disabled by default
+
+    c = LRUCache(4, use_bulk_purge=False, collect_stats=True, ttl=.02)
+    for i in xrange(6):
+        c[i] = i
+    c[5]
+    c.get(0, None)
+    c.get(1, None)
+    sleep(.03)
+    c.get(5, None)
+    stats = c.stats()
+    ok(stats['inserts'], 6)
+    ok(stats['hits'], 1)
+    ok(stats['misses'], 3)
+    ok(stats['hit_ratio'], .25)
+    ok(stats['evictions'], 2)
+    ok(stats['purges'], 2)
+    ok(stats['expirations'], 1)
+    ok(stats['size'], 3)
+    assert stats['purge_time'] >= 0
+
+    c.reset_stats()
+    ok(c.stats()['hits'], 0)
+
+def test_sharded_stats():
+    c = ShardedLRUCache(64, num_shards=4, collect_stats=True)
+    for i in xrange(10):
+        c[i] = i
+        c[i]
+        c.get(-i-1, None)
+    stats = c.stats()
+    ok(stats['inserts'], 10)
+    ok(stats['hits'], 10)
+    ok(stats['misses'], 10)
+    ok(stats['hit_ratio'], .5)
+
+class _SwitchingValue(object):
+    def __del__(self):
+        sleep(0) # lets the reader run mid-removal
+
+def test_clock_concurrent_removal():
+    c = ClockLRUCache(100)
+    bad_reads = []
+    done = []
+    def read():
+        get = c.get
+        while not done:
+            for key in ('live', 'deleted'):
+                val = get(key, 'MISS')
+                if val is None:
+                    bad_reads.append(key)
+    reader = Thread(target=read)
+    reader.start()
+    try:
+        for _i in xrange(300):
+            c['live'] = 1 # the oldest, so its value is dropped first
+            for i in xrange(20):
+                c[i] = _SwitchingValue()
+            c.clear()
+            c['deleted'] = _SwitchingValue()
+            del c['deleted']
+    finally:
+        done.append(1)
+        reader.join(5)
+    ok(bad_reads, [])
+
+def test_compact():
+    c = CompactLRUCache(4, use_bulk_purge=False)
+    _check_basic_dict_interface(c)
+    c.clear()
+    for i in xrange(1, 40):
+        c[i] = i
+        if i > 4:
+            ok(len(c), 4)
+            ok(c[i-3], i-3)
+            ok(c.get(i-4, None), None)
+            ok(c[i-2], i-2)
+            ok(c[i-1], i-1)
+            ok(c[i], i)
+
+    c = CompactLRUCache(10, proportion_remaining_after_purge=.5)
+    for i in xrange(11):
+        c[i] = i
+    ok(sorted(c.keys()), [6, 7, 8, 9, 10])
+
+    c = CompactLRUCache(10, ttl=.02)
+    c['a'] = 1
+    c.set('b', 2, ttl=0)
+    sleep(.03)
+    ok('a' in c, False)
+    ok(c.get('a', None), None)
+    ok(c['b'], 2)
+    ok(len(c), 1)
+
+class _ScaledCompactLRUCache(CompactLRUCache):
+    def __init__(self, n):
+        CompactLRUCache.__init__(self, n*5000)
+
+def test_compact_maxsize_fixed_at_creation():
+    try:
+        _ScaledCompactLRUCache(4)
+    except ValueError:
+        pass
+    else:
+        assert 0, 'an __init__ maxsize that differs should be rejected'
+
+    c = CompactLRUCache(10)
+    try:
+        c.__init__(10000)
+    except ValueError:
+        pass
+    else:
+        assert 0, 'an __init__ maxsize that differs should be rejected'
+    c.__init__(10)
+    for i in xrange(100):
+        c[i] = i
+    ok(len(c) <= 10, True)
+    ok(c[99], 99)
+
+def test_bulk_operations():
+    for c in (LRUCache(10, use_bulk_purge=False, collect_stats=True),
+              ShardedLRUCache(10, num_shards=2, use_bulk_purge=False,
+                              collect_stats=True)):
+        c.set_many([(i, i*10) for i in xrange(5)])
+        c.set_many({5: 50, 6: 60})
+        ok(len(c), 7)
+        hits, misses = c.get_many([0, 3, 6, 99, 100])
+        ok(hits, {0: 0, 3: 30, 6: 60})
+        ok(sorted(misses), [99, 100])
+        ok(c.stats()['hits'], 3)
+        ok(c.stats()['misses'], 2)
+        ok(c.delete_many([0, 1, 99]), 2)
+        ok(len(c), 5)
+
+    c = LRUCache(10, use_bulk_purge=False)
+    c.set_many((i, i) for i in xrange(15))
+    ok(len(c), 10)
+    ok(sorted(c.keys()), list(range(5, 15)))
+
+    c = LRUCache(10, weigher=lambda k, v: v, max_weight=100)
+    c.set_many([('a', 40), ('b', 40)], ttl=10)
+    ok(c.weight, 80)
+
+def test_memoize():
+    calls = []
+    @memoize(maxsize=10)
+    def add(a, b=1):
+        "adds"
+        calls.append((a, b))
+        return a + b
+    ok(add.__name__, 'add')
+    ok(add.__doc__, 'adds')
+    ok(add(1), 2)
+    ok(add(1), 2)
+    ok(add(1, b=2), 3)
+    ok(add(1, b=2), 3)
+    ok(add(b=2, a=1), 3)
+    ok(add(1, 2), 3)
+    ok(calls, [(1, 1), (1, 2), (1, 2), (1, 2)])
+    info = add.cache_info()
+    ok(info['hits'], 2)
+    ok(info['misses'], 4)
+    ok(info['size'], 4)
+    add.cache_clear()
+    ok(add.cache_info()['size'], 0)
+    ok(add(1), 2)
+    ok(len(calls), 5)
+
+def test_memoize_typed_and_ttl():
+    calls = []
+    @memoize(typed=True, ttl=.02)
+    def ident(a):
+        calls.append(a)
+        return a
+    ident(1)
+    ident(1.0)
+    ok(len(calls), 2)
+    ident(1)
+    ok(len(calls), 2)
+    sleep(.03)
+    ident(1)
+    ok(len(calls), 3)
+
+    @memoize()
+    def ident2(a):
+        calls.append(a)
+        return a
+    del calls[:]
+    ident2(1)
+    ident2(1.0)
+    ok(len(calls), 1)
+
+def test_memoize_cache_kws_and_recursion():
+    @memoize(collect_stats=False, use_bulk_purge=False)
+    def fib(n):
+        if n < 2:
+            return n
+        return fib(n-1) + fib(n-2)
+    ok(fib(30), 832040)
+
+    @memoize()
+    def loop(n):
+        return loop(n)
+    try:
+        loop(1)
+    except RuntimeError:
+        pass
+    else:
+        assert 0, 'a same-key recursive call should raise RuntimeError'
+    ok(len(loop.cache), 0)
+
+def test_dump_and_load():
+    path = tempfile.mktemp()
+    try:
+        c = LRUCache(10, use_bulk_purge=False)
+        for i in xrange(10):
+            c[i] = {'value': i}
+        c[0] # 1 is now the oldest
+        c.set('short', 1, ttl=.01)
+        ok(c.dump(path), 10)
+
+        c2 = LRUCache(10, use_bulk_purge=False)
+        sleep(.02)
+        ok(c2.load(path, batch_size=3), 9) # 'short' expired
+        ok(c2[5], {'value': 5})
+        ok(c2.get('short', None), None)
+        # the recency order survived, so 2 is now the oldest:
+        c2['new1'] = 1
+        c2['new2'] = 1
+        ok(1 in c2, False)
+        ok(2 in c2, False)
+        ok(0 in c2, True)
+
+        # loading into a smaller cache keeps the most recent entries
+        c3 = LRUCache(3, use_bulk_purge=False)
+        c3.load(path)
+        ok(sorted(c3.keys()), [0, 8, 9])
+
+        sharded = ShardedLRUCache(20, num_shards=4)
+        sharded.load(path)
+        ok(len(sharded), 9)
+        ok(sharded.dump(path), 9)
+        sharded.clear()
+        ok(sharded.load(path), 9)
+        ok(sharded[3], {'value': 3})
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def test_failed_dump():
+    path = tempfile.mktemp()
+    try:
+        c = LRUCache(10, use_bulk_purge=False)
+        c['a'] = 1
+        ok(c.dump(path), 1)
+        c['b'] = lambda: None # unpicklable
+        try:
+            c.dump(path)
+        except Exception:
+            pass
+        else:
+            assert 0, 'dumping an unpicklable value should fail'
+        ok(os.path.exists(path+'.tmp'), False)
+        c2 = LRUCache(10, use_bulk_purge=False)
+        ok(c2.load(path), 1) # the earlier dump is intact
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def test_removal_listener():
+    removed = []
+    def listener(key, val, cause):
+        len(c) # would deadlock if it were called within the lock
+        removed.append((key, val, cause))
+    c = LRUCache(2, use_bulk_purge=False, removal_listener=listener)
+    c['a'] = 1
+    c['a'] = 2
+    c['b'] = 3
+    c['c'] = 4
+    del c['b']
+    c.set('d', 5, ttl=.01)
+    sleep(.02)
+    ok(c.get('d', None), None)
+    c.clear()
+    ok(removed, [('a', 1, REPLACED), ('a', 2, EVICTED), ('b', 3, DELETED),
+                 ('d', 5, EXPIRED), ('c', 4, CLEARED)])
+
+    # a failing listener doesn't break the cache
+    c = LRUCache(2, removal_listener=lambda key, val, cause: 1/0)
+    c['a'] = 1
+    del c['a']
+    ok(len(c), 0)
+
+def test_refresh_ahead():
+    pool = DummyThreadPool()
+    loads = []
+    def loader(key):
+        loads.append(key)
+        return key + '!'
+    c = LRUCache(10, ttl=.2, loader=loader, refresh_ahead=.5, thread_pool=pool)
+    c['a'] = 'a'
+    ok(c['a'], 'a')
+    ok(pool.jobs, [])
+    sleep(.12)
+    ok(c['a'], 'a')
+    ok(c['a'], 'a')
+    ok(len(pool.jobs), 1) # only one refresh is queued per key
+    pool.jobs.pop()()
+    ok(loads, ['a'])
+    ok(c['a'], 'a!')
+    ok(pool.jobs, []) # the ttl was restarted
+    sleep(.12)
+    c['a']
+    ok(len(pool.jobs), 1)
@@ -0,0 +1,110 @@
+import os
+import tempfile
+from time import sleep
+
+from nose.tools import raises
+
+from dss.sys.SharedMemoryCache import SharedMemoryCache
+
+def ok(a, b):
+    assert a == b, (a, b)
+
+def _tmp_path():
+    fd, path = tempfile.mkstemp(prefix='dss_shm_test')
+    os.close(fd)
+    os.unlink(path)
+    return path
+
+def test_dict_interface():
+    path = _tmp_path()
+    try:
+        c = SharedMemoryCache(path, maxsize=64, slot_size=256)
+        ok(len(c), 0)
+        c['a'] = 1
+        c[('b', 2)] = {'x': [1, 2]}
+        ok(c['a'], 1)
+        ok(c.get(('b', 2)), {'x': [1, 2]})
+        ok(c.get('missing', None), None)
+        ok('a' in c, True)
+        ok(len(c), 2)
+        c['a'] = 'replaced'
+        ok(c['a'], 'replaced')
+        ok(len(c), 2)
+        del c['a']
+        ok('a' in c, False)
+        c.clear()
+        ok(len(c), 0)
+        c.close()
+    finally:
+        os.unlink(path)
+
+def test_eviction_and_ttl():
+    path = _tmp_path()
+    try:
+        c = SharedMemoryCache(path, maxsize=8, ways=8, slot_size=64)
+        ok(c.maxsize, 8)
+        for i in xrange(8):
+            c[i] = i
+        sleep(.001)
+        c[0] # 1 is now the least recently used
+        c[100] = 100
+        ok(len(c), 8)
+        ok(0 in c, True)
+        ok(1 in c, False)
+
+        c.set('short', 1, ttl=.01)
+        sleep(.02)
+        ok(c.get('short', None), None)
+        c.close()
+    finally:
+        os.unlink(path)
+
+def test_equal_keys_sharing_objects():
+    path = _tmp_path()
+    try:
+        c = SharedMemoryCache(path, maxsize=64)
+        a = ''.join(['ke', 'y'])
+        b = ''.join(['k', 'ey'])
+        assert a == b and a is not b
+        c[(a, a)] = 1
+        ok(c.get((a, b), 'MISS'), 1)
+        ok(c.get(('key', 'key'), 'MISS'), 1)
+        c[(b, a)] = 2
+        ok(len(c), 1)
+        c.close()
+    finally:
+        os.unlink(path)
+
+@raises(ValueError)
+def test_oversized_entry():
+    path = _tmp_path()
+    try:
+        c = SharedMemoryCache(path, slot_size=64)
+        c['a'] = 'x'*100
+    finally:
+        os.unlink(path)
+
+def test_shared_between_processes():
+    path = _tmp_path()
+    try:
+        c = SharedMemoryCache(path, maxsize=64)
+        c['parent'] = 1
+        pid = os.fork()
+        if not pid:
+            try:
+                other = SharedMemoryCache(path, maxsize=64)
+                other['child'] = other['parent'] + 1
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        ok(c['child'], 2)
+        c.close()
+
+        try:
+            SharedMemoryCache(path, maxsize=128)
+        except ValueError:
+            pass
+        else:
+            assert 0, 'opening with different settings should fail'
+    finally:
+        os.unlink(path)
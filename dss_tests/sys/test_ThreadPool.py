@@ -1,5 +1,12 @@
 from time import sleep
-from dss.sys.services.ThreadPool import ThreadPool
+from threading import Event, Thread
+from nose.tools import raises
+
+from dss.sys.services.ThreadPool import (
+    ThreadPool, Future, CancelledError, TimeoutError, _FutureJob)
+from dss.sys.services.PoolSizingStrategy import (
+    PoolSizingStrategy, UtilizationPoolSizingStrategy)
+from dss.sys.services.pool_sizing_simulator import SimulatedPool, compare_strategies
 
 # @@TR: Many more tests are needed here!
 
@@ -69,3 +76,227 @@ def test_init_and_settings():
             assert pool.active_thread_count == 0
         finally:
             pool.stop()
+
+def test_prioritized_jobs():
+    pool = ThreadPool(max_threads=1, min_threads=1, initial_threads=1,
+                      prioritized_job_queue=True, log_channel=DummyChannel())
+    try:
+        pool.start()
+        started, blocker = Event(), Event()
+        def block():
+            started.set()
+            blocker.wait(5)
+        pool.add_job(block)
+        started.wait(5)
+
+        out = []
+        pool.add_prioritized_job(lambda: out.append('bulk'), 10)
+        pool.add_job(lambda: out.append('normal'))
+        pool.add_prioritized_job(lambda: out.append('health check'), -10)
+        pool.add_high_priority_job(lambda: out.append('admin'))
+        blocker.set()
+        while len(out) < 4:
+            sleep(.001)
+        assert out == ['admin', 'health check', 'normal', 'bulk'], out
+    finally:
+        pool.stop()
+
+def test_job_queue_max_bytes():
+    pool = ThreadPool(max_threads=1, min_threads=1, initial_threads=1,
+                      job_queue_sizer=lambda job: 100, job_queue_max_bytes=200,
+                      log_channel=DummyChannel())
+    try:
+        pool.start()
+        started, blocker = Event(), Event()
+        def block():
+            started.set()
+            blocker.wait(5)
+        pool.add_job(block)
+        started.wait(5)
+
+        out = []
+        pool.add_job(lambda: out.append(1))
+        assert pool.job_queue_bytes == 100
+        pool.add_job(lambda: out.append(2))
+        assert pool.job_queue_bytes == 200
+        assert pool.job_queue_size == 2
+        blocker.set()
+        while len(out) < 2:
+            sleep(.001)
+        assert pool.job_queue_bytes == 0
+    finally:
+        pool.stop()
+
+def test_job_queue_stats():
+    pool = ThreadPool(max_threads=2, min_threads=2, initial_threads=2,
+                      collect_job_queue_stats=True, log_channel=DummyChannel())
+    try:
+        pool.start()
+        _run_counter_jobs(pool, n=10)
+        stats = pool.get_job_queue_stats()
+        assert stats['puts'] == 10, stats
+        assert stats['gets'] == 10, stats
+        assert stats['high_water'] >= 1, stats
+        assert stats['consumer_waits']['count'] >= 1, stats
+    finally:
+        pool.stop()
+
+def test_submit():
+    pool = ThreadPool(max_threads=1, min_threads=1, initial_threads=1,
+                      log_channel=DummyChannel())
+    try:
+        pool.start()
+        started, blocker = Event(), Event()
+        def block():
+            started.set()
+            blocker.wait(5)
+            return 'unblocked'
+        blocking = pool.submit(block)
+        started.wait(5)
+        assert blocking.running()
+
+        done = []
+        ok = pool.submit(lambda a, b: a+b, 1, 2)
+        ok.add_done_callback(done.append)
+        failed = pool.submit(lambda: 1/0)
+        cancelled = pool.submit(done.append, 'never')
+        assert cancelled.cancel()
+        assert cancelled.cancelled() and cancelled.done()
+        assert not blocking.cancel()
+        try:
+            ok.result(timeout=.01)
+        except TimeoutError:
+            pass
+        else:
+            assert 0, 'result should have timed out'
+
+        blocker.set()
+        assert blocking.result(5) == 'unblocked'
+        assert ok.result(5) == 3
+        assert done == [ok]
+        assert isinstance(failed.exception(5), ZeroDivisionError)
+        try:
+            cancelled.result()
+        except CancelledError:
+            pass
+        else:
+            assert 0, 'a cancelled job should raise CancelledError'
+        ok.add_done_callback(done.append) # called immediately once done
+        assert done == [ok, ok]
+    finally:
+        pool.stop()
+
+@raises(ZeroDivisionError)
+def test_submit_exception():
+    pool = ThreadPool(log_channel=DummyChannel())
+    try:
+        pool.start()
+        pool.submit(lambda: 1/0).result(5)
+    finally:
+        pool.stop()
+
+def test_future_concurrent_waiters():
+    pool = ThreadPool(log_channel=DummyChannel())
+    try:
+        pool.start()
+        for _i in xrange(20):
+            future = pool.submit(sleep, .001)
+            results, called = [], []
+            def wait():
+                future.add_done_callback(called.append)
+                results.append(future.result(5))
+            threads = [Thread(target=wait) for _j in xrange(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(10)
+            assert results == [None]*10, results
+            assert called == [future]*10, called
+    finally:
+        pool.stop()
+
+def test_future_job_base_exception():
+    # SystemExit, etc. are set on the future and still reach the worker loop
+    def exit():
+        raise SystemExit
+    future = Future()
+    try:
+        _FutureJob(future, exit, ()).run()
+    except SystemExit:
+        pass
+    else:
+        assert 0, 'run should re-raise SystemExit'
+    assert future.done() and not future.running()
+    assert isinstance(future.exception(), SystemExit)
+
+def test_map():
+    pool = ThreadPool(max_threads=3, min_threads=3, initial_threads=3,
+                      collect_job_queue_stats=True, log_channel=DummyChannel())
+    try:
+        pool.start()
+        assert list(pool.map(lambda x: x*2, xrange(10))) == range(0, 20, 2)
+        assert pool.get_job_queue_stats()['puts'] == 10
+        pool.map(str, range(100), chunksize=30) # 4 jobs in one putmany
+        assert pool.get_job_queue_stats()['puts'] == 14
+        assert list(pool.map(str, [])) == []
+
+        results = pool.map(lambda x: 10/x, [5, 2, 0, 1], chunksize=2)
+        assert results.next() == 2
+        assert results.next() == 5
+        try:
+            results.next()
+        except ZeroDivisionError:
+            pass
+        else:
+            assert 0, 'map should raise the exception from the job'
+
+        # the results ahead of the failing item in its chunk are returned
+        called = []
+        def fn(x):
+            called.append(x)
+            return 10/x
+        results = pool.map(fn, [5, 2, 0, 1, 10], chunksize=4)
+        assert results.next() == 2
+        assert results.next() == 5
+        try:
+            results.next()
+        except ZeroDivisionError:
+            pass
+        else:
+            assert 0, 'map should raise the exception from the job'
+        assert list(results) == [1]
+        assert 1 not in called # the rest of the chunk isn't run
+    finally:
+        pool.stop()
+
+class FixedSizeStrategy(PoolSizingStrategy):
+    def __init__(self, size):
+        PoolSizingStrategy.__init__(self)
+        self.size = size
+
+    def calculate_adjustment(self, pool, now):
+        return self.size - pool.current_pool_size
+
+def test_pool_sizing_strategy_setting():
+    strategy = FixedSizeStrategy(4)
+    pool = ThreadPool(pool_sizing_strategy=strategy, log_channel=DummyChannel())
+    assert pool.pool_sizing_strategy is strategy
+    assert isinstance(ThreadPool(log_channel=DummyChannel()).pool_sizing_strategy,
+                      UtilizationPoolSizingStrategy)
+
+def _make_job_timing_stats(num_jobs=4000, interval=.005, duration=.1):
+    # a steady load needing ~20 threads, in the format recorded by ThreadPool
+    return [(i*interval, 0, 0, duration) for i in xrange(num_jobs)]
+
+def test_pool_sizing_simulator():
+    stats = _make_job_timing_stats()
+    summary = SimulatedPool(FixedSizeStrategy(30)).run(stats)
+    assert summary['jobs'] == len(stats)
+    assert summary['max_pool_size'] == 30
+    assert summary['pool_size_changes'] == 1
+    assert summary['max_wait'] < 1.5
+
+    for summary in compare_strategies(stats):
+        assert summary['jobs'] == len(stats), summary
+        assert summary['max_pool_size'] >= 20, summary
+        assert summary['ave_wait'] < 1, summary
@@ -1,6 +1,11 @@
 from threading import Thread
+from time import time, sleep
 
-from dss.sys.lock import Lock
+from nose.tools import raises
+
+from dss.sys.lock import Lock, RLock, Condition, Semaphore, RWLock
+from dss.sys.lock import (enable_lock_profiling, disable_lock_profiling,
+                          get_lock_stats, reset_lock_stats)
 
 def test_single_threaded():
     l = Lock()
@@ -39,3 +44,163 @@ def test_multi_threaded():
         t.join()
     assert not l.locked()
     assert len(output) == runs
+
+def test_rlock():
+    l = RLock()
+    assert l.acquire() == 1
+    assert l.acquire(blocking=0) == 1
+    assert l.locked()
+    l.release()
+    assert l.locked()
+
+    acquired = []
+    t = Thread(target=lambda: acquired.append(l.acquire(blocking=0)))
+    t.start()
+    t.join()
+    assert acquired == [0]
+
+    l.release()
+    assert not l.locked()
+
+@raises(RuntimeError)
+def test_rlock_release_unowned():
+    RLock().release()
+
+def test_condition():
+    for lock in (None, Lock(), RLock()):
+        cond = Condition(lock)
+        cond.acquire()
+        start = time()
+        assert cond.wait(.01) == 0
+        assert time()-start >= .01
+        cond.release()
+
+        ready, done = [], []
+        def wait_for_ready():
+            cond.acquire()
+            try:
+                while not ready:
+                    cond.wait(5)
+                done.append(1)
+            finally:
+                cond.release()
+        threads = [Thread(target=wait_for_ready) for i in xrange(3)]
+        for t in threads:
+            t.start()
+        cond.acquire()
+        ready.append(1)
+        cond.notify_all()
+        cond.release()
+        for t in threads:
+            t.join(5)
+        assert len(done) == 3
+
+def test_semaphore():
+    s = Semaphore(2)
+    assert s.acquire() == 1
+    assert s.acquire() == 1
+    assert s.value == 0
+    assert s.acquire(blocking=0) == 0
+
+    t = Thread(target=lambda: (sleep(.01), s.release()))
+    t.start()
+    assert s.acquire() == 1
+    t.join()
+    s.release()
+    s.release()
+    assert s.value == 2
+
+def test_rwlock():
+    rw = RWLock()
+    rw.acquire_read()
+    rw.acquire_read()
+    assert rw.readers == 2
+
+    events = []
+    def write():
+        rw.acquire_write()
+        events.append('write')
+        rw.release_write()
+    def read():
+        rw.acquire_read()
+        events.append('read')
+        rw.release_read()
+
+    writer = Thread(target=write)
+    writer.start()
+    sleep(.01) # the writer is now waiting for the readers
+    reader = Thread(target=read)
+    reader.start()
+    sleep(.01) # and the new reader is waiting behind the writer
+    assert events == []
+    rw.release_read()
+    rw.release_read()
+    writer.join(5)
+    reader.join(5)
+    assert events == ['write', 'read'], events
+    assert not rw.readers and not rw.writer_active
+
+def test_lock_profiling():
+    hot, cold = Lock('test.hot'), RLock('test.cold')
+    assert hot.name == 'test.hot'
+    reset_lock_stats()
+    hot.acquire()
+    hot.release() # not recorded while profiling is off
+    enable_lock_profiling()
+    try:
+        cold.acquire()
+        cold.release()
+        hot.acquire()
+        assert hot.acquire(blocking=0) == 0
+        t = Thread(target=lambda: (sleep(.02), hot.release()))
+        t.start()
+        hot.acquire()
+        t.join()
+        hot.release()
+    finally:
+        disable_lock_profiling()
+
+    stats = dict((d['name'], d) for d in get_lock_stats())
+    assert stats['test.hot']['acquires'] == 2, stats
+    assert stats['test.hot']['contended'] == 2, stats
+    assert stats['test.hot']['max_wait'] >= .01, stats
+    assert stats['test.cold']['acquires'] == 1, stats
+    assert stats['test.cold']['contended'] == 0, stats
+    assert get_lock_stats(limit=1)[0]['name'] == 'test.hot'
+
+def test_acquire_timeout():
+    for l in (Lock(), Lock(spin=100), RLock()):
+        l.acquire()
+        acquired = []
+        def try_acquire():
+            start = time()
+            acquired.append(l.acquire(timeout=.02))
+            acquired.append(time()-start)
+        t = Thread(target=try_acquire)
+        t.start()
+        t.join()
+        assert acquired[0] == 0
+        assert .015 <= acquired[1] < 1, acquired
+        l.release()
+        assert l.acquire(timeout=.02) == 1
+        l.release()
+
+@raises(ValueError)
+def test_nonblocking_acquire_with_timeout():
+    Lock().acquire(blocking=0, timeout=1)
+
+def test_spinning_lock():
+    l = Lock(spin=1000)
+    counter = [0]
+    def run():
+        for i in xrange(2000):
+            l.acquire()
+            counter[0] += 1
+            l.release()
+    threads = [Thread(target=run) for i in xrange(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert counter[0] == 8000
+    assert not l.locked()
@@ -1,10 +1,17 @@
+import os
+import gc
+import select
 from threading import Thread, Event
-from time import time
+from time import time, sleep
 from collections import deque
 
 from nose.tools import raises
 
-from dss.sys.Queue import (AbstractQueue, BlockingQueue)
+from dss.sys.Queue import (AbstractQueue, BlockingQueue, PriorityBlockingQueue,
+                           SPSCQueue, WaitTimeHistogram, Empty, Full)
+from dss.sys.PollableQueue import PollableQueue
+from dss.sys.lock import (enable_lock_profiling, disable_lock_profiling,
+                          get_lock_stats)
 
 def test_abstractqueue():
     q = AbstractQueue()
@@ -112,6 +119,325 @@ def test_maxsize_2():
 def test_maxsize_20():
     test_maxsize(20)
 
+def test_timeouts():
+    q = BlockingQueue(maxsize=2)
+    for get in (q.get_nowait,
+                lambda: q.get(timeout=0),
+                lambda: q.get(timeout=.01),
+                lambda: q.getmany(timeout=.01)):
+        start = time()
+        try:
+            get()
+        except Empty:
+            pass
+        else:
+            assert 0, 'expected Empty'
+        assert time()-start < 1
+
+    q.put_nowait(1)
+    q.put(2, timeout=.01)
+    for put in (lambda: q.put_nowait(3),
+                lambda: q.put(3, timeout=.01),
+                lambda: q.putmany([3], timeout=.01)):
+        try:
+            put()
+        except Full:
+            pass
+        else:
+            assert 0, 'expected Full'
+    assert len(q) == 2
+    assert q.get_nowait() == 1
+    assert q.getmany(timeout=.01) == [2]
+
+    # a timed get is woken by a put from another thread
+    t = Thread(target=lambda: q.put(4))
+    t.start()
+    assert q.get(timeout=5) == 4
+    t.join()
+
+def test_max_bytes():
+    q = BlockingQueue(sizer=len, max_bytes=10)
+    assert q.max_bytes == 10
+    q.put('abcd')
+    q.putmany(['ef', 'ghi'])
+    assert q.queued_bytes == 9
+    assert not q.is_full
+    q.put('jklmn') # admitted while under the limit, but now it's full
+    assert q.queued_bytes == 14
+    assert q.is_full
+    for put in (lambda: q.put_nowait('o'),
+                lambda: q.putmany(['o'], timeout=.01)):
+        try:
+            put()
+        except Full:
+            pass
+        else:
+            assert 0, 'expected Full'
+    assert q.get() == 'abcd'
+    assert q.queued_bytes == 10
+    assert q.is_full
+    assert q.getmany(2) == ['ef', 'ghi']
+    assert q.queued_bytes == 5
+    q.put_nowait('o')
+
+    # a blocked put proceeds once a consumer frees up enough bytes
+    q.put('pqrs')
+    t = Thread(target=lambda: q.put('tu'))
+    t.start()
+    assert q.getmany(1) == ['jklmn']
+    t.join()
+    assert q.getmany() == ['o', 'pqrs', 'tu']
+    assert q.queued_bytes == 0
+
+    pq = PriorityBlockingQueue(sizer=len, max_bytes=4)
+    pq.put_prioritized('xyz', 1)
+    pq.put_prioritized('w', 0)
+    assert pq.queued_bytes == 4
+    assert pq.is_full
+    assert pq.get() == 'w'
+    assert pq.queued_bytes == 3
+
+def test_sizer_only_called_on_put():
+    calls = []
+    def sizer(item):
+        calls.append(item)
+        if item == 'bad':
+            raise ValueError(item)
+        return len(item)
+    q = BlockingQueue(sizer=sizer, max_bytes=10)
+    items = [1, 2, 3]
+    q.put('ab')
+    q.putmany([items])
+    q.putleft('c')
+    assert calls == ['ab', [1, 2, 3], 'c']
+    try:
+        q.put('bad')
+    except ValueError:
+        pass
+    else:
+        assert 0, 'expected ValueError'
+    assert len(q) == 3
+    assert q.queued_bytes == 6
+
+    # the size an item had when it was put is what's given back
+    items.append(4)
+    del calls[:]
+    assert q.getmany(2) == ['c', 'ab']
+    assert q.queued_bytes == 3
+    assert q.get() is items
+    assert q.queued_bytes == 0
+    assert not calls
+
+    # the mutex isn't left held, so other threads can still use it
+    t = Thread(target=lambda: q.put('de', timeout=1))
+    t.start()
+    t.join(5)
+    assert not t.isAlive()
+    assert q.get(timeout=1) == 'de'
+
+    pq = PriorityBlockingQueue(sizer=sizer)
+    pq.put_prioritized('xyz', 1)
+    pq.putmany(['w', 'uv'])
+    del calls[:]
+    assert pq.getmany() == ['w', 'uv', 'xyz']
+    assert pq.queued_bytes == 0
+    assert not calls
+
+@raises(ValueError)
+def test_max_bytes_requires_sizer():
+    BlockingQueue(max_bytes=10)
+
+def test_stats():
+    q = BlockingQueue(maxsize=2, collect_stats=1)
+    q.put(1)
+    q.putmany([2])
+    assert q.get() == 1
+    q.putleft(3)
+    assert q.getmany() == [3, 2]
+    try:
+        q.get_nowait()
+    except Empty:
+        pass
+
+    # a producer blocks on the full queue until a get
+    q.putmany([4, 5])
+    t = Thread(target=lambda: q.put(6))
+    t.start()
+    sleep(.05)
+    assert q.get(timeout=5) == 4
+    t.join()
+
+    stats = q.stats()
+    assert stats['puts'] == 6, stats
+    assert stats['gets'] == 4, stats
+    assert stats['high_water'] == 2, stats
+    assert stats['consumer_waits']['count'] == 1, stats # the get_nowait
+    assert stats['consumer_waits']['max'] == 0, stats
+    assert stats['producer_waits']['count'] == 1, stats
+    assert stats['producer_waits']['max'] >= .04, stats
+    q.reset_stats()
+    assert q.stats()['puts'] == 0
+
+    h = WaitTimeHistogram()
+    for wait in (0, .000003, .0004, .0005, 1):
+        h.record(wait)
+    assert h.count == 5
+    assert h.max == 1
+    assert [count for bound, count in h.buckets()] == [1, 1, 2, 1]
+    assert h.percentile(50) == 512/1e6
+    assert h.percentile(100) > 1
+
+def test_priority_queue():
+    q = PriorityBlockingQueue()
+    assert q.default_priority == 0
+    q.put('a')
+    q.put_prioritized('urgent', -1)
+    q.putmany(['b', 'c'])
+    q.put_prioritized('later', 5)
+    q.put_prioritized('urgent2', -1)
+    q.putleft('first')
+    assert len(q) == 7
+    assert q.get() == 'first'
+    assert q.getmany(3) == ['urgent', 'urgent2', 'a']
+    assert q.getmany() == ['b', 'c', 'later']
+    assert q.is_empty
+
+    q = PriorityBlockingQueue(maxsize=1)
+    q.put_prioritized(1, 1)
+    try:
+        q.put_prioritized(2, 0, timeout=0)
+    except Full:
+        pass
+    else:
+        assert 0, 'expected Full'
+    assert q.get(timeout=0) == 1
+
+def test_spsc_queue():
+    q = SPSCQueue(maxsize=3)
+    assert q.maxsize == 4 # rounded up to a power of two
+    assert q.is_empty
+    for i in xrange(10): # wraps around the ring
+        q.put(i)
+        q.put(i+1)
+        assert len(q) == 2
+        assert q.get() == i
+        assert q.get_nowait() == i+1
+    q.putmany(range(4))
+    assert q.is_full
+    try:
+        q.put(4, timeout=.01)
+    except Full:
+        pass
+    else:
+        assert 0, 'expected Full'
+    assert q.getmany(3) == [0, 1, 2]
+    assert q.getmany() == [3]
+    try:
+        q.get(timeout=.01)
+    except Empty:
+        pass
+    else:
+        assert 0, 'expected Empty'
+
+def test_spsc_queue_init():
+    q = SPSCQueue(maxsize=4)
+    q.put(1)
+    q.__init__(4) # mustn't reallocate, leaking or losing the ring
+    assert q.get() == 1
+    q = SPSCQueue.__new__(SPSCQueue) # __init__ skipped
+    assert q.maxsize == 1024
+    q.put(1)
+    assert q.get() == 1
+
+def test_spsc_queue_threads(iterations=20000):
+    q = SPSCQueue(maxsize=64)
+    received = []
+    def consume():
+        while len(received) < iterations:
+            received.extend(q.getmany(timeout=5))
+    consumer = Thread(target=consume)
+    consumer.start()
+    for i in xrange(iterations):
+        q.put(i)
+    consumer.join(10)
+    assert received == list(range(iterations))
+
+def test_getmany_linger():
+    from time import sleep
+    for q in (BlockingQueue(), SPSCQueue()):
+        # it gives up lingering after `linger` seconds
+        q.put(1)
+        start = time()
+        assert q.getmany(10, min_items=5, linger=.05) == [1]
+        assert time()-start >= .04
+
+        def produce():
+            for i in xrange(8):
+                sleep(.005)
+                q.put(i)
+        t = Thread(target=produce)
+        t.start()
+        batch = q.getmany(10, min_items=5, linger=5, timeout=5)
+        assert len(batch) >= 5, batch
+        assert batch == list(range(len(batch)))
+        t.join()
+        q.getmany()
+
+        # min_items is capped at maxitems
+        q.putmany([1, 2])
+        assert q.getmany(2, min_items=5, linger=5) == [1, 2]
+
+def _is_readable(q):
+    return bool(select.select([q], [], [], 0)[0])
+
+def test_pollable_queue():
+    q = PollableQueue()
+    assert not _is_readable(q)
+    assert q.drain() == []
+    q.put(1)
+    assert _is_readable(q)
+    q.putmany([2, 3])
+    assert q.drain() == [1, 2, 3]
+    assert not _is_readable(q)
+
+    # a partial drain leaves it readable
+    q.putmany(range(5))
+    assert q.drain(3) == [0, 1, 2]
+    assert _is_readable(q)
+    assert q.drain(3) == [3, 4]
+    assert not _is_readable(q)
+
+    # it's still a BlockingQueue
+    q.put(1)
+    assert q.get() == 1
+
+def test_lock_profiling():
+    q = BlockingQueue(1)
+    enable_lock_profiling()
+    try:
+        try:
+            q.get(timeout=.01)
+        except Empty:
+            pass
+        q.put(1)
+        q.get()
+    finally:
+        disable_lock_profiling()
+    names = [d['name'] for d in get_lock_stats()]
+    assert 'BlockingQueue._mutex' in names, names
+    assert not [name for name in names if 'sema' in name], names
+
+def test_pollable_queue_failed_init():
+    stdin_stat = os.fstat(0)
+    try:
+        PollableQueue(-1)
+    except AssertionError:
+        pass
+    else:
+        assert 0, 'a negative maxsize should fail'
+    gc.collect()
+    assert os.fstat(0) == stdin_stat # not closed by __dealloc__
+
 def test_multiple_threads(iterations=120, num_consumers=30):
     q = BlockingQueue(iterations)
     woken_thread_event = Event()
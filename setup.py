@@ -41,11 +41,13 @@ from distutils.extension import Extension
 
 ################################################################################
 extension_dependencies = {
-    'dss.sys.Queue':['dss.sys.lock'],
+    'dss.sys.Queue':['dss.sys.lock', 'dss.sys.time_of_day'],
     'dss.sys.LRUCache':[
         'dss.sys.lock',
         'dss.sys.time_of_day',
         ],
+    'dss.sys.SharedMemoryCache':['dss.sys.time_of_day'],
+    'dss.sys.PollableQueue':['dss.sys.Queue'],
 
     'dss.net.NetworkService':[
         'dss.sys.services.Service',
@@ -55,7 +57,7 @@ extension_dependencies = {
         'dss.sys.services.Service',
         'dss.sys.time_of_day',
         ],
-    'dss.net.IOEventHandler':[],
+    'dss.net.IOEventHandler':['dss.sys.lock'],
 
     'dss.net.Acceptor':[
         'dss.sys.services.Service',
@@ -110,6 +112,7 @@ extension_dependencies = {
         'dss.sys.lock',
         'dss.sys.time_of_day',
         'dss.sys.services.Service',
+        'dss.sys.services.PoolSizingStrategy',
         'dss.sys.Queue',
         ],
     }
@@ -117,6 +120,9 @@ extension_dependencies = {
 c_src_files = {'dss.sys.time_of_day':['dss/sys/_time_of_day.c'],
                }
 
+c_libraries = {'dss.sys.SharedMemoryCache':['pthread'],
+               }
+
 def get_src_file_paths(module_name):
     src_file_root = module_name.replace('.', os.path.sep)
     if CYTHON_INSTALLED:
@@ -144,7 +150,8 @@ def cython_ext(module_name):
     return Extension(
         module_name,
         get_src_file_paths(module_name),
-        depends=get_dep_file_paths(module_name))
+        depends=get_dep_file_paths(module_name),
+        libraries=c_libraries.get(module_name, []))
 
 def get_cython_extensions():
     return [cython_ext(modname)
@@ -153,7 +160,9 @@ def get_cython_extensions():
     dss.sys.time_of_day
     dss.sys.lock
     dss.sys.Queue
+    dss.sys.PollableQueue
     dss.sys.LRUCache
+    dss.sys.SharedMemoryCache
 
     dss.dsl.safe_strings
     dss.dsl.Markup
@@ -166,6 +175,7 @@ def get_cython_extensions():
     dss.dsl.xml.serializers
 
     dss.sys.services.ThreadPool
+    dss.sys.services.PoolSizingStrategy
     dss.sys.services.Service
 
     dss.net.Acceptor